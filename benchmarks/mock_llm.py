@@ -0,0 +1,278 @@
+import json
+import time
+import uuid
+import random
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence
+
+# NOTE THIS FILE SHOULD NOT IMPORT ANY LOCAL MODULES
+
+
+class MockLLMConfig:
+    """
+    How the mock server behaves. The latency of every response is drawn uniformly from latency +- jitter seconds,
+    and a rate_limit_ratio share of the requests is answered with a 429 and a retry-after of retry_after seconds.
+    The rate limit headers count remaining_requests down from requests_per_minute, and reset every minute.
+    A batch is in progress for batch_duration seconds, then a batch_error_ratio share of its requests fails.
+    The chat completions of the failing_models are answered with a 500, so the callers fall back to another model
+    """
+
+    def __init__(self, latency: float=0.05, jitter: float=0.0, rate_limit_ratio: float=0.0, retry_after: float=1, requests_per_minute: int=10000, tokens_per_minute: int=10_000_000, stream_chunk_size: int=16, batch_duration: float=0.0, batch_error_ratio: float=0.0, failing_models: Sequence[str]=(), seed: Optional[int]=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.stream_chunk_size = stream_chunk_size
+        self.batch_duration = batch_duration
+        self.batch_error_ratio = batch_error_ratio
+        self.failing_models = set(failing_models)
+        self.random = random.Random(seed)
+
+
+def extract_input(messages: List[Dict[str, str]]) -> Any:
+    """ The text the prompts render after the user prompt, parsed if it is json """
+    text = messages[-1]["content"].split("\n\n")[-1]
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+
+def fake_translation(data: Any, json_response: bool) -> str:
+    """ A response in the shape each of the prompts of nos expects """
+    if isinstance(data, list):
+        # tag_translation
+        return json.dumps({tag: f"EN {tag}" for tag in data}, ensure_ascii=False)
+    if isinstance(data, dict) and "title_raw" in data:
+        # novel_metadata_translation
+        return json.dumps({"title": f"EN {data['title_raw']}", "author": f"EN {data.get('author_raw')}", "description": f"EN {data.get('description_raw')}"}, ensure_ascii=False)
+    if isinstance(data, dict) and all(isinstance(value, dict) for value in data.values()):
+        # novel_metadata_translation_batch
+        return json.dumps({key: json.loads(fake_translation(value, True)) for key, value in data.items()}, ensure_ascii=False)
+    if json_response:
+        return json.dumps({"translation": f"EN {data}"}, ensure_ascii=False)
+    return f"EN {data}"
+
+
+def build_completion(body: Dict[str, Any]) -> Dict[str, Any]:
+    """ The chat completion of a request body """
+    response_format = body.get("response_format") or {}
+    content = fake_translation(extract_input(body["messages"]), response_format.get("type") == "json_object")
+    usage = {"prompt_tokens": sum(len(message["content"]) for message in body["messages"]) // 4, "completion_tokens": len(content) // 4 + 1}
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    return {
+        "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": usage,
+    }
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    server: "MockLLMServer"
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written separately, so with nagle every response would wait for a delayed ack
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/chat/completions"):
+            self.chat_completions(json.loads(body))
+        elif self.path.endswith("/files"):
+            self.send_json(200, self.server.create_file(*self.parse_upload(body)))
+        elif self.path.endswith("/batches"):
+            self.send_json(200, self.server.create_batch(json.loads(body)))
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].rstrip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in self.server.batches:
+            self.send_json(200, self.server.retrieve_batch(parts[-1]))
+        elif len(parts) >= 3 and parts[-1] == "content" and parts[-3] == "files" and parts[-2] in self.server.files:
+            self.send_bytes(200, self.server.files[parts[-2]]["content"], "application/octet-stream")
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+
+    def parse_upload(self, body: bytes):
+        """ The file and the purpose of a multipart upload """
+        message = BytesParser(policy=default_policy).parsebytes(b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body)
+        filename, content, purpose = "upload", b"", "batch"
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                filename, content = part.get_filename() or filename, part.get_payload(decode=True)
+            elif name == "purpose":
+                purpose = part.get_content().strip()
+        return filename, content, purpose
+
+
+    def chat_completions(self, body: Dict[str, Any]):
+        config = self.server.config
+        self.server.track_in_flight(1)
+        try:
+            time.sleep(max(0.0, config.latency + config.random.uniform(-config.jitter, config.jitter)))
+        finally:
+            self.server.track_in_flight(-1)
+
+        remaining_requests, remaining_tokens, reset_in = self.server.count_request()
+        headers = {
+            "x-ratelimit-limit-requests": str(config.requests_per_minute),
+            "x-ratelimit-remaining-requests": str(remaining_requests),
+            "x-ratelimit-limit-tokens": str(config.tokens_per_minute),
+            "x-ratelimit-remaining-tokens": str(remaining_tokens),
+            "x-ratelimit-reset-requests": f"{reset_in:.3f}s",
+        }
+        if body["model"] in config.failing_models:
+            self.send_json(500, {"error": {"message": f"Model {body['model']} failed", "type": "server_error"}}, headers)
+            return
+        if config.random.random() < config.rate_limit_ratio or remaining_requests <= 0:
+            headers["retry-after"] = str(config.retry_after)
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, headers)
+            return
+
+        completion = build_completion(body)
+        if body.get("stream"):
+            usage = completion["usage"] if (body.get("stream_options") or {}).get("include_usage") else None
+            self.send_stream(body["model"], completion["choices"][0]["message"]["content"], usage, headers)
+        else:
+            self.send_json(200, completion, headers)
+
+
+    def send_json(self, status: int, data: dict, headers: Optional[Dict[str, str]]=None):
+        self.send_bytes(status, json.dumps(data, ensure_ascii=False).encode(), "application/json", headers)
+
+
+    def send_bytes(self, status: int, payload: bytes, content_type: str, headers: Optional[Dict[str, str]]=None):
+        self.send_response(status)
+        for key, value in {**(headers or {}), "Content-Type": content_type, "Content-Length": str(len(payload))}.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def send_stream(self, model: str, content: str, usage: Optional[dict], headers: Dict[str, str]):
+        chunk_size = self.server.config.stream_chunk_size
+        events = [
+            {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+             "choices": [{"index": 0, "delta": {"content": content[start:start + chunk_size]}, "finish_reason": None}]}
+            for start in range(0, len(content), chunk_size)
+        ]
+        if usage is not None:
+            events.append({"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [], "usage": usage})
+        payload = "".join(f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events) + "data: [DONE]\n\n"
+        encoded = payload.encode()
+        self.send_response(200)
+        for key, value in {**headers, "Content-Type": "text/event-stream", "Content-Length": str(len(encoded))}.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(encoded)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    An OpenAI compatible server on localhost, served from a daemon thread. It has the chat completions, and the files
+    and batches endpoints the batch translations use. A batch is run when it is first retrieved after batch_duration
+    """
+
+    daemon_threads = True
+
+    def __init__(self, config: Optional[MockLLMConfig]=None, port: int=0):
+        super().__init__(("127.0.0.1", port), MockLLMHandler)
+        self.config = config or MockLLMConfig()
+        self.n_requests = 0
+        # The chat completions being answered right now, and the most of them at once
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def count_request(self):
+        """ The remaining requests and tokens of the current minute, and the seconds till it resets """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 60:
+                self._window_start, self._window_requests = now, 0
+            self.n_requests += 1
+            self._window_requests += 1
+            remaining_requests = self.config.requests_per_minute - self._window_requests
+            remaining_tokens = max(0, self.config.tokens_per_minute - self._window_requests * 1000)
+            return remaining_requests, remaining_tokens, 60 - (now - self._window_start)
+
+    def track_in_flight(self, delta: int):
+        with self._lock:
+            self.in_flight += delta
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def create_file(self, filename: str, content: bytes, purpose: str) -> Dict[str, Any]:
+        file_object = {
+            "id": f"file-{uuid.uuid4().hex}", "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed",
+        }
+        with self._lock:
+            self.files[file_object["id"]] = {**file_object, "content": content}
+        return file_object
+
+    def create_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        n_requests = len(self.files[body["input_file_id"]]["content"].splitlines())
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}", "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"], "status": "in_progress", "created_at": int(time.time()),
+            "output_file_id": None, "error_file_id": None, "request_counts": {"total": n_requests, "completed": 0, "failed": 0},
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+        return batch
+
+    def retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        with self._lock:
+            batch = self.batches[batch_id]
+            if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= self.config.batch_duration:
+                self.run_batch(batch)
+            return batch
+
+    def run_batch(self, batch: Dict[str, Any]):
+        """ Answer every request of the batch into the output and error files, like the provider does offline """
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]]["content"].decode().splitlines():
+            request = json.loads(line)
+            result: Dict[str, Any] = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"]}
+            if self.config.random.random() < self.config.batch_error_ratio:
+                result.update(response={"status_code": 500, "request_id": result["id"], "body": {"error": {"message": "Mock batch request failed"}}}, error=None)
+                errors.append(result)
+            else:
+                result.update(response={"status_code": 200, "request_id": result["id"], "body": build_completion(request["body"])}, error=None)
+                outputs.append(result)
+        for key, results in (("output_file_id", outputs), ("error_file_id", errors)):
+            if results:
+                content = "".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results).encode()
+                file_object = {"id": f"file-{uuid.uuid4().hex}", "object": "file", "bytes": len(content), "created_at": int(time.time()), "filename": f"{key}.jsonl", "purpose": "batch_output", "status": "processed"}
+                self.files[file_object["id"]] = {**file_object, "content": content}
+                batch[key] = file_object["id"]
+        batch["status"] = "completed"
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+
+    def start(self) -> "MockLLMServer":
+        threading.Thread(target=self.serve_forever, name="mock-llm", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
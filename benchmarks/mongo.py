@@ -0,0 +1,101 @@
+import os
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+from typing import Any, Callable, Dict, Optional
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+# NOTE THIS FILE SHOULD NOT IMPORT ANY LOCAL MODULES
+
+# The mongod binary the benchmarks start. It is looked up on the PATH by default
+MONGOD_BIN = os.environ.get("MONGOD_BIN", "mongod")
+
+BENCHMARK_DB_NAME = "nos_benchmark"
+BENCHMARK_DB_USERNAME = "nos_benchmark"
+BENCHMARK_DB_PASSWORD = "nos_benchmark"
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class DisposableMongo:
+    """
+    A mongod on a free localhost port whose data lives in a temporary directory, which is removed on exit.
+    The benchmarks user is created in the benchmark db, since nos always connects with a username and password.
+    env holds the MONGO_* variables of nos.config that point at it.
+    With a replica_set name it runs as a single node replica set, which change streams need
+    """
+
+    def __init__(self, mongod_bin: str=MONGOD_BIN, startup_timeout: float=30, replica_set: Optional[str]=None):
+        self.mongod_bin = mongod_bin
+        self.startup_timeout = startup_timeout
+        self.replica_set = replica_set
+        self.port = get_free_port()
+        self.dbpath: Optional[str] = None
+        self.process: Optional[subprocess.Popen] = None
+
+    @property
+    def env(self) -> Dict[str, str]:
+        return {
+            "MONGO_HOST": "127.0.0.1",
+            "MONGO_PORT": str(self.port),
+            "MONGO_USERNAME": BENCHMARK_DB_USERNAME,
+            "MONGO_PASSWORD": BENCHMARK_DB_PASSWORD,
+            "MONGO_DB_NAME": BENCHMARK_DB_NAME,
+            "MONGO_AUTH_SOURCE": BENCHMARK_DB_NAME,
+        }
+
+    def start(self) -> "DisposableMongo":
+        if shutil.which(self.mongod_bin) is None:
+            raise RuntimeError(f"{self.mongod_bin} was not found. Install mongodb or point MONGOD_BIN at a mongod binary")
+        self.dbpath = tempfile.mkdtemp(prefix="nos_benchmark_mongo_")
+        command = [self.mongod_bin, "--dbpath", self.dbpath, "--port", str(self.port), "--bind_ip", "127.0.0.1", "--quiet"]
+        if self.replica_set:
+            command += ["--replSet", self.replica_set]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        client: MongoClient = MongoClient("127.0.0.1", self.port, serverSelectionTimeoutMS=500, directConnection=True)
+        deadline = time.monotonic() + self.startup_timeout
+        self.wait_for(client, deadline, lambda: client.admin.command("ping"))
+        if self.replica_set:
+            client.admin.command("replSetInitiate", {"_id": self.replica_set, "members": [{"_id": 0, "host": f"127.0.0.1:{self.port}"}]})
+            self.wait_for(client, deadline, lambda: client.admin.command("hello")["isWritablePrimary"])
+        client[BENCHMARK_DB_NAME].command("createUser", BENCHMARK_DB_USERNAME, pwd=BENCHMARK_DB_PASSWORD, roles=["dbOwner"])
+        client.close()
+        return self
+
+    def wait_for(self, client: MongoClient, deadline: float, check: Callable[[], Any]):
+        """ Retry check till it returns something truthy """
+        while True:
+            try:
+                if check():
+                    return
+            except PyMongoError:
+                pass
+            if self.process is None or self.process.poll() is not None or time.monotonic() > deadline:
+                client.close()
+                self.stop()
+                raise RuntimeError(f"mongod did not start on port {self.port}")
+            time.sleep(0.2)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.dbpath is not None:
+            shutil.rmtree(self.dbpath, ignore_errors=True)
+
+    def __enter__(self) -> "DisposableMongo":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from benchmarks.mock_llm import MockLLMConfig, MockLLMServer
+from benchmarks.mongo import DisposableMongo
+
+# Run from the root of the repo, e.g. python -m benchmarks.run run_translation --latency 0.2 --rate-limit-ratio 0.05
+# Every run starts its own mongod (see MONGOD_BIN) and mock llm server. REDIS_URL is used as is, the rate limiter
+# lets every request through when redis is not running
+
+# Every run appends a line per scenario here, so a regression shows up against the runs of the earlier commits
+DEFAULT_HISTORY_PATH = Path(__file__).parent / "history.jsonl"
+# A metric that moved by more than this share against the previous run is flagged
+REGRESSION_THRESHOLD = 0.1
+# The metrics where lower is better, e.g. the latencies and what the cold start sets up. For the rest, e.g. the rates, higher is better
+LOWER_IS_BETTER_SUFFIXES = ("_ms", "seconds", "_on_import")
+
+
+def get_git_commit() -> Dict[str, object]:
+    root = Path(__file__).parent.parent
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": dirty}
+
+
+def load_history(path: Path) -> List[dict]:
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(path: Path, records: List[dict]):
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def compare_to_previous(record: dict, history: List[dict]) -> List[str]:
+    """ The changes of the metrics of a scenario against its last run on another commit """
+    previous = next((
+        old for old in reversed(history)
+        if old["scenario"] == record["scenario"] and old["params"] == record["params"] and old.get("commit") != record.get("commit")
+    ), None)
+    if previous is None:
+        return []
+    lines = []
+    for name, value in record["metrics"].items():
+        old_value = previous["metrics"].get(name)
+        if not old_value or not isinstance(value, (int, float)):
+            continue
+        change = (value - old_value) / abs(old_value)
+        worse = change > 0 if name.endswith(LOWER_IS_BETTER_SUFFIXES) else change < 0
+        flag = "REGRESSION" if worse and abs(change) > REGRESSION_THRESHOLD else ""
+        lines.append(f"    {name}: {old_value:.3f} -> {value:.3f} ({change:+.1%}) {flag}".rstrip())
+    commit = (previous.get("commit") or "unknown")[:10]
+    return [f"  against {commit}:", *lines]
+
+
+def run(scenario_names: Sequence[str], mock_config: MockLLMConfig, repeat: int, history_path: Optional[Path]) -> List[dict]:
+    from benchmarks import scenarios
+
+    history = load_history(history_path) if history_path else []
+    git_info = get_git_commit()
+    records = []
+    with DisposableMongo() as mongo:
+        os.environ.update(mongo.env)
+        os.environ.setdefault("MAIN_LOGGER_NAME", "main")
+        os.environ.setdefault("LOG_LEVEL", "ERROR")
+        os.environ["METRICS_PORT"] = "0"
+        mock_llm = MockLLMServer(mock_config).start()
+        try:
+            scenarios.setup_benchmark_db(mock_llm)
+            for name in scenario_names:
+                for iteration in range(repeat):
+                    scenarios.reset_scenario_collections()
+                    ctx = scenarios.BenchmarkContext(mock_llm, seed=iteration)
+                    start_time = time.perf_counter()
+                    metrics = scenarios.SCENARIOS[name](ctx)
+                    record = {
+                        "scenario": name,
+                        "timestamp": time.time(),
+                        **git_info,
+                        "python": platform.python_version(),
+                        "params": {"latency": mock_config.latency, "jitter": mock_config.jitter, "rate_limit_ratio": mock_config.rate_limit_ratio},
+                        "wall_seconds": time.perf_counter() - start_time,
+                        "metrics": metrics,
+                    }
+                    records.append(record)
+                    print(f"{name} [{iteration + 1}/{repeat}] " + ", ".join(f"{key}={value:.3f}" for key, value in metrics.items()))
+                    for line in compare_to_previous(record, history):
+                        print(line)
+        finally:
+            mock_llm.stop()
+
+    if history_path:
+        append_history(history_path, records)
+    return records
+
+
+def main(argv: Optional[Sequence[str]]=None):
+    from benchmarks.scenarios import SCENARIOS
+
+    parser = argparse.ArgumentParser(description="Run the benchmarks against a disposable mongod and a mock llm server")
+    parser.add_argument("scenarios", nargs="*", help=f"The scenarios to run, all but the 100k ones by default: {', '.join(SCENARIOS)}")
+    parser.add_argument("--latency", type=float, default=0.05, help="The seconds the mock llm server takes per response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="The response latency varies by up to this many seconds")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="The share of the requests that get a 429")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--history", type=Path, default=DEFAULT_HISTORY_PATH, help="The jsonl file the results are appended to")
+    parser.add_argument("--no-save", action="store_true", help="Do not append the results to the history")
+    args = parser.parse_args(argv)
+
+    scenario_names = args.scenarios or [name for name in SCENARIOS if not name.endswith("_100k")]
+    unknown = [name for name in scenario_names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    mock_config = MockLLMConfig(latency=args.latency, jitter=args.jitter, rate_limit_ratio=args.rate_limit_ratio)
+    run(scenario_names, mock_config, args.repeat, None if args.no_save else args.history)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,238 @@
+import sys
+import json
+import time
+import random
+import subprocess
+import datetime
+import statistics
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from benchmarks.mock_llm import MockLLMServer
+
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+# The collections the scenarios write to. They are dropped before every scenario, the providers and prompts are kept
+SCENARIO_COLLECTIONS = ("novels", "chapters", "translator_metadata", "llm_response_cache", "translation_entities", "translation_rollups", "rollup_watermarks")
+# The modules cold_start imports, each in a fresh interpreter. The schemas and nos.config should import without
+# connecting to the db or importing celery
+COLD_START_MODULES = ("nos.schemas.scraping_schema", "nos.schemas.prompt_schemas", "nos.config", "nos.celery_tasks.tasks")
+# Run with python -c, prints how long importing the module took and what it set up on the way
+COLD_START_SCRIPT = """
+import sys, json, time, importlib
+start_time = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start_time
+config = sys.modules.get("nos.config")
+print(json.dumps({"seconds": elapsed, "db_connected": bool(config and config.db.connected), "celery_imported": "celery" in sys.modules}))
+"""
+BENCHMARK_PROMPT_NAMES = ("tag_translation", "novel_metadata_translation", "novel_metadata_translation_batch", "chapter_translation")
+
+Metrics = Dict[str, float]
+
+# Every scenario seeds what it needs into the benchmark db, runs the code under test against the mock llm server and
+# returns its metrics. nos is only imported inside the scenarios, once run.py has pointed the environment at the
+# disposable mongod and the mock server
+
+
+class BenchmarkContext:
+
+    def __init__(self, mock_llm: MockLLMServer, seed: int=0):
+        self.mock_llm = mock_llm
+        self.random = random.Random(seed)
+
+
+def summarize_latencies(samples: List[float], prefix: str="") -> Metrics:
+    """ The mean, p50 and p95 of latencies in seconds, as milliseconds """
+    ordered = sorted(samples)
+    return {
+        f"{prefix}mean_ms": statistics.fmean(ordered) * 1000,
+        f"{prefix}p50_ms": ordered[len(ordered) // 2] * 1000,
+        f"{prefix}p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+    }
+
+
+def setup_benchmark_db(mock_llm: MockLLMServer):
+    """ Seed the mock provider and the prompts. This runs once, before any module caches the providers or the prompts """
+    from nos.config import db
+    from nos.ensure_indexes import ensure_indexes
+    from nos.schemas.prompt_schemas import PromptSchema
+    from nos.schemas.secrets_schema import Provider, ProviderRateLimitInfo
+
+    ensure_indexes(db)
+    Provider(
+        url=mock_llm.url,
+        key="benchmark",
+        provider="mock",
+        name="mock",
+        model_names=["mock-a", "mock-b"],
+        max_concurrent_requests=16,
+        rate_limit_info=ProviderRateLimitInfo(rate_limit_reset_time=datetime.datetime.now() - datetime.timedelta(minutes=1)),
+    ).update(db)
+    for prompt_name in BENCHMARK_PROMPT_NAMES:
+        PromptSchema.load(db, query={"prompt_name": prompt_name}, load_from_file=True).update(db) # type: ignore
+
+
+def reset_scenario_collections():
+    from nos.config import db
+    for collection_name in SCENARIO_COLLECTIONS:
+        db[collection_name].delete_many({})
+
+
+def seed_novels(ctx: BenchmarkContext, n_novels: int, n_distinct_tags: int=2000, tags_per_novel: int=5, batch_size: int=5000) -> int:
+    """ Insert untranslated novels, each with tags_per_novel of n_distinct_tags raw tags """
+    from nos.config import db
+    from nos.schemas.scraping_schema import NovelRawData
+
+    tags = [f"标签{idx}" for idx in range(n_distinct_tags)]
+    for start in range(0, n_novels, batch_size):
+        docs = []
+        for idx in range(start, min(n_novels, start + batch_size)):
+            docs.append({
+                "source_name": "benchmark",
+                "novel_source_id": str(idx),
+                "novel_url": f"https://www.1qxs.com/xs/{idx}.html",
+                "chapter_list_url": f"https://www.1qxs.com/list/{idx}.html",
+                "image_url": f"https://img.1qxs.com/cover/{idx}.jpg",
+                "title_raw": f"小说{idx}",
+                "author_raw": f"作者{idx % 97}",
+                "description_raw": "少年踏上修仙之路，" * 8,
+                "classification_raw": ["玄幻"],
+                "tags_raw": ctx.random.sample(tags, tags_per_novel),
+                "all_data_parsed": False,
+                "fingerprint": f"benchmark-{idx}",
+            })
+        db[NovelRawData._collection_name].insert_many(docs, ordered=False)
+    return n_novels
+
+
+def bench_run_translation(ctx: BenchmarkContext, n_calls: int=200) -> Metrics:
+    """ Sequential Translator.run_translation calls, without and then with the response cache """
+    from nos.translators.models import Translator
+
+    translator = Translator()
+    inputs = [{"title_raw": f"小说{idx}", "author_raw": "作者", "description_raw": "少年踏上修仙之路"} for idx in range(n_calls)]
+    uncached, cached = [], []
+    for text in inputs:
+        start_time = time.perf_counter()
+        translator.run_translation(text, "novel_metadata_translation", use_cache=False)
+        uncached.append(time.perf_counter() - start_time)
+    for text in inputs:
+        translator.run_translation(text, "novel_metadata_translation", use_cache=True)
+    for text in inputs:
+        start_time = time.perf_counter()
+        translator.run_translation(text, "novel_metadata_translation", use_cache=True)
+        cached.append(time.perf_counter() - start_time)
+
+    mock_latency = ctx.mock_llm.config.latency
+    return {
+        "calls_per_second": n_calls / sum(uncached),
+        **summarize_latencies(uncached),
+        "overhead_p50_ms": summarize_latencies(uncached)["p50_ms"] - mock_latency * 1000,
+        **summarize_latencies(cached, prefix="cache_hit_"),
+    }
+
+
+def bench_translate_novel_metadata(ctx: BenchmarkContext, n_novels: int=200) -> Metrics:
+    """ The translate_novel_metadata task run in process, one novel after the other """
+    from nos.config import db
+    from nos.celery_tasks.tasks import translate_novel_metadata
+    from nos.schemas.scraping_schema import NovelData
+
+    seed_novels(ctx, n_novels)
+    novel_ids = [str(doc["_id"]) for doc in db[NovelData._collection_name].find({}, projection={"_id": 1})]
+    start_time = time.perf_counter()
+    for novel_id in novel_ids:
+        translate_novel_metadata(novel_id)
+    elapsed = time.perf_counter() - start_time
+    return {"novels_per_second": n_novels / elapsed, "seconds": elapsed}
+
+
+def bench_beat_update_tags_of_novels(ctx: BenchmarkContext, n_novels: int) -> Metrics:
+    """ A cold run of beat_update_tags_of_novels: every tag is translated, then every novel gets its tags """
+    from nos.celery_tasks.beat_tasks import beat_update_tags_of_novels
+
+    seed_novels(ctx, n_novels)
+    n_requests = ctx.mock_llm.n_requests
+    start_time = time.perf_counter()
+    _, newly_translated = beat_update_tags_of_novels()
+    elapsed = time.perf_counter() - start_time
+    return {
+        "seconds": elapsed,
+        "novels_per_second": n_novels / elapsed,
+        "tags_translated": len(newly_translated),
+        "llm_requests": ctx.mock_llm.n_requests - n_requests,
+    }
+
+
+def bench_dispatch_novel_metadata_translation(ctx: BenchmarkContext, n_novels: int=2000) -> Metrics:
+    """
+    dispatch_novel_metadata_translation till every novel is claimed. The tasks are published to an in-memory broker
+    and result backend, and the dispatch size is fixed to DISPATCHER_MAX_NOVELS_PER_RUN since there are no workers to size it to
+    """
+    from unittest import mock
+    from nos.config import celery_app
+    from nos.celery_tasks import dispatchers
+
+    seed_novels(ctx, n_novels)
+    celery_app.conf.broker_url = "memory://"
+    celery_app.conf.result_backend = "cache+memory://"
+    run_times = []
+    with mock.patch.object(dispatchers, "get_novel_metadata_dispatch_size", return_value=dispatchers.DISPATCHER_MAX_NOVELS_PER_RUN):
+        while True:
+            start_time = time.perf_counter()
+            n_dispatched = dispatchers.dispatch_novel_metadata_translation()
+            run_times.append(time.perf_counter() - start_time)
+            if not n_dispatched:
+                break
+    return {"novels_per_second": n_novels / sum(run_times), "runs": len(run_times), **summarize_latencies(run_times[:-1] or run_times, prefix="run_")}
+
+
+def bench_parse_novel(ctx: BenchmarkContext, n_pages: int=2000) -> Metrics:
+    """ Scrape1qxs.parse_novel over the saved novel pages """
+    from scrapy.http import HtmlResponse
+    from nos.scraping.scrape_novel import Scrape1qxs
+
+    spider = Scrape1qxs()
+    pages = [
+        (f"https://www.1qxs.com/xs/{path.stem.split('_')[-1]}.html", path.read_bytes())
+        for path in sorted(FIXTURES_DIR.glob("novel_*.html"))
+    ]
+    start_time = time.perf_counter()
+    n_items = 0
+    for idx in range(n_pages):
+        url, body = pages[idx % len(pages)]
+        # A new response every time, so the parsed selector is not reused
+        n_items += len(list(spider.parse_novel(HtmlResponse(url=url, body=body, encoding="utf-8"))))
+    elapsed = time.perf_counter() - start_time
+    return {"pages_per_second": n_pages / elapsed, "items_per_page": n_items / n_pages}
+
+
+def bench_cold_start(ctx: BenchmarkContext, n_runs: int=5) -> Metrics:
+    """ The median time to import each of COLD_START_MODULES in a new interpreter, like a worker or a cli does on start """
+    root = Path(__file__).parent.parent
+    metrics: Metrics = {}
+    n_connected = 0
+    for module in COLD_START_MODULES:
+        samples = []
+        for _ in range(n_runs):
+            output = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT, module], cwd=root, capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            samples.append(result["seconds"])
+        n_connected += result["db_connected"]
+        short_name = module.rsplit(".", 1)[-1]
+        metrics[f"{short_name}_import_ms"] = statistics.median(samples) * 1000
+        metrics[f"{short_name}_celery_on_import"] = float(result["celery_imported"])
+    metrics["db_connections_on_import"] = n_connected
+    return metrics
+
+
+SCENARIOS: Dict[str, Callable[[BenchmarkContext], Metrics]] = {
+    "run_translation": bench_run_translation,
+    "translate_novel_metadata": bench_translate_novel_metadata,
+    "beat_update_tags_of_novels_10k": lambda ctx: bench_beat_update_tags_of_novels(ctx, 10_000),
+    "beat_update_tags_of_novels_100k": lambda ctx: bench_beat_update_tags_of_novels(ctx, 100_000),
+    "dispatch_novel_metadata_translation": bench_dispatch_novel_metadata_translation,
+    "parse_novel": bench_parse_novel,
+    "cold_start": bench_cold_start,
+}
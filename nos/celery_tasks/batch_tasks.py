@@ -0,0 +1,203 @@
+import os
+import datetime
+from typing import Dict, List, Optional, Union
+
+from nos.config import celery_app, db, logger
+from nos.celery_tasks.beat_tasks import get_missing_tags_query, collect_untranslated_tags, estimate_tag_tokens, save_tag_translations, TAG_TRANSLATION_CHUNK_TOKEN_BUDGET
+from nos.celery_tasks.dispatchers import get_dispatchable_query, REDISPATCH_AFTER
+from nos.celery_tasks.tasks import get_novel_metadata_input, apply_novel_metadata_translation
+from nos.schemas.batch_schema import BatchRequest, TranslationBatchJob
+from nos.schemas.enums import BatchJobStatus, TranlsationStatus
+from nos.schemas.scraping_schema import NovelData
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translator_schemas import LLMCallResponseSchema, TranslatorMetadata
+from nos.translators.batch import BatchTranslator, BATCH_FINAL_STATUSES
+from nos.translators.prompt_registry import get_prompt_registry
+from nos.utils.token_utils import pack_by_token_budget
+
+
+# The most novels submitted in a single batch job
+BATCH_MAX_NOVELS = int(os.environ.get("BATCH_MAX_NOVELS", 5000))
+# The most batch jobs running at once. A new job is only submitted once one of them is done
+BATCH_MAX_IN_FLIGHT_JOBS = int(os.environ.get("BATCH_MAX_IN_FLIGHT_JOBS", 1))
+# The novels of a batch are claimed for this long, so the live dispatcher does not translate them again meanwhile.
+# It is a bit longer than the completion window of the batch
+BATCH_CLAIM_DURATION = datetime.timedelta(hours=25)
+
+NOVEL_METADATA_PROMPT_NAME = "novel_metadata_translation"
+TAG_TRANSLATION_PROMPT_NAME = "tag_translation"
+
+
+def get_batch_provider() -> Optional[Provider]:
+    """ The highest priority provider with a batch endpoint. Its live rate limits do not apply to the batches """
+    providers: List[Provider] = Provider.load(db, query={"supports_batch": True}, many=True, sort={"priority": -1}) or [] # type: ignore
+    return providers[0] if providers else None
+
+
+def claim_novels_for_batch(limit: int) -> List[NovelData]:
+    """
+    Claim the untranslated novels the same way the live dispatcher does, in bulk with a claim token, so a batch of
+    thousands of novels takes three round trips. The claim is dated into the future, so the novels only become
+    dispatchable again after BATCH_CLAIM_DURATION
+    """
+    now = datetime.datetime.now()
+    claimed_until = now + BATCH_CLAIM_DURATION - REDISPATCH_AFTER
+    return NovelData.claim_many(
+        db,
+        query=get_dispatchable_query({"all_data_parsed": False}, now),
+        update={"$set": {"dispatched_at": claimed_until}},
+        limit=limit,
+        projection={"title_raw": 1, "author_raw": 1, "description_raw": 1},
+    )
+
+
+def release_novels(novels: List[NovelData]):
+    """ Let the live dispatcher pick the novels up again """
+    for novel in novels:
+        novel.dispatched_at = None
+    NovelData.bulk_update(db, novels, fields=["dispatched_at"])
+
+
+@celery_app.task
+def submit_batch_translation():
+    """
+    This is beat task that is supposed to run every hour. It collects the untranslated novels and tags, writes them
+    as the requests of a batch job and submits it to the batch endpoint of a provider.
+    Nothing is submitted when no provider has supports_batch, or when BATCH_MAX_IN_FLIGHT_JOBS are still running
+    """
+    provider = get_batch_provider()
+    if provider is None:
+        logger.debug("No provider supports batches. Skipping the batch submission")
+        return
+    n_in_flight = db[TranslationBatchJob._collection_name].count_documents({"status": BatchJobStatus.SUBMITTED.value})
+    if n_in_flight >= BATCH_MAX_IN_FLIGHT_JOBS:
+        logger.info(f"{n_in_flight} batch jobs are still running. Skipping the batch submission")
+        return
+
+    translator = BatchTranslator(provider)
+    lines, requests = [], []
+
+    # The tags are collected before the novels are claimed, so a failure here leaves no novel claimed
+    _, untranslated_tags = collect_untranslated_tags(get_missing_tags_query())
+    untranslated_tags = sorted(set(untranslated_tags) - TranslationBatchJob.get_in_flight_tags(db))
+    for idx, chunk in enumerate(pack_by_token_budget(untranslated_tags, estimate_tag_tokens, TAG_TRANSLATION_CHUNK_TOKEN_BUDGET)):
+        line, prompt = translator.build_request(f"tags-{idx}", TAG_TRANSLATION_PROMPT_NAME, chunk)
+        lines.append(line)
+        requests.append(BatchRequest(custom_id=line["custom_id"], prompt_name=TAG_TRANSLATION_PROMPT_NAME, prompt_id=prompt.id, tags=chunk)) # type: ignore
+
+    novels = claim_novels_for_batch(BATCH_MAX_NOVELS)
+    for novel in novels:
+        line, prompt = translator.build_request(f"novel-{novel.id}", NOVEL_METADATA_PROMPT_NAME, get_novel_metadata_input(novel))
+        lines.append(line)
+        requests.append(BatchRequest(custom_id=line["custom_id"], prompt_name=NOVEL_METADATA_PROMPT_NAME, prompt_id=prompt.id, novel_id=novel.id)) # type: ignore
+
+    if not lines:
+        logger.info("Nothing to translate in a batch")
+        return
+
+    try:
+        batch = translator.submit(lines)
+    except Exception:
+        release_novels(novels)
+        raise
+
+    job = TranslationBatchJob(
+        provider_id=provider.id, # type: ignore
+        provider_name=provider.name,
+        model_name=translator.model_name,
+        batch_id=batch.id,
+        input_file_id=batch.input_file_id,
+        provider_status=batch.status,
+        requests=requests,
+    )
+    job.update(db)
+    logger.info(f"Submitted batch job {job.id} with {len(novels)} novels and {len(untranslated_tags)} tags")
+    return str(job.id)
+
+
+def save_batch_result(job: TranslationBatchJob, request: BatchRequest, result: Optional[Union[LLMCallResponseSchema, str]]) -> bool:
+    """ Record the result of a request as a TranslatorMetadata and save the translation. Returns whether it succeeded """
+    response = result if isinstance(result, LLMCallResponseSchema) else LLMCallResponseSchema(**{})
+    error_message = None if isinstance(result, LLMCallResponseSchema) else (result or "The request is missing from the results of the batch")
+    response.start_time = job.created_at
+    response.end_time = job.completed_at
+    translator_metadata = TranslatorMetadata(
+        status=TranlsationStatus.COMPLETED if error_message is None else TranlsationStatus.FAILED,
+        error_message=error_message,
+        novel_id=request.novel_id,
+        provider_name=job.provider_name,
+        model_name=job.model_name,
+        prompt_id=request.prompt_id,
+        llm_call_metadata=response,
+    )
+    translator_metadata.update(db)
+
+    if request.novel_id is not None:
+        novel: Optional[NovelData] = NovelData.load(db, query={"_id": request.novel_id}) # type: ignore
+        if novel is None:
+            logger.warning(f"Novel {request.novel_id} of batch job {job.id} no longer exists")
+            return False
+        # A failed novel goes back to the live dispatcher
+        novel.dispatched_at = None
+        return apply_novel_metadata_translation(novel, translator_metadata)
+
+    # The novels get the translated tags from the next run of the tag beat
+    response_content = response.response_content
+    translated = {k: response_content[k] for k in request.tags or [] if isinstance(response_content, dict) and isinstance(response_content.get(k), str)}
+    if translated:
+        save_tag_translations(translated)
+    return error_message is None and len(translated) == len(request.tags or [])
+
+
+def poll_batch_job(job: TranslationBatchJob):
+    """ Check on a submitted batch, and save its results once it is done """
+    provider: Optional[Provider] = Provider.load(db, query={"_id": job.provider_id}) # type: ignore
+    if provider is None:
+        logger.error(f"The provider of batch job {job.id} no longer exists")
+        job.status = BatchJobStatus.FAILED
+        job.update(db, fields=["status"])
+        return
+
+    translator = BatchTranslator(provider, job.model_name)
+    batch = translator.retrieve(job.batch_id)
+    job.provider_status = batch.status
+    if batch.status not in BATCH_FINAL_STATUSES:
+        logger.debug(f"Batch job {job.id} is {batch.status}: {batch.request_counts}")
+        job.update(db, fields=["provider_status"])
+        return
+
+    # An expired or cancelled batch still has the results of the requests it finished
+    response_formats: Dict[str, Optional[Dict]] = {
+        request.custom_id: get_prompt_registry().get(request.prompt_name).prompt.model_parameters.response_format
+        for request in job.requests
+    }
+    results = translator.get_results(batch, response_formats)
+
+    job.output_file_id = batch.output_file_id
+    job.error_file_id = batch.error_file_id
+    job.completed_at = datetime.datetime.now()
+    job.n_succeeded = job.n_failed = 0
+    for request in job.requests:
+        try:
+            succeeded = save_batch_result(job, request, results.get(request.custom_id))
+        except Exception as e:
+            logger.error(f"Could not save the result of {request.custom_id} of batch job {job.id}: {e}")
+            succeeded = False
+        if succeeded:
+            job.n_succeeded += 1
+        else:
+            job.n_failed += 1
+
+    job.status = BatchJobStatus.COMPLETED if batch.status == "completed" else BatchJobStatus.FAILED
+    job.update(db, fields=["status", "provider_status", "output_file_id", "error_file_id", "completed_at", "n_succeeded", "n_failed"])
+    logger.info(f"Batch job {job.id} is {batch.status}: {job.n_succeeded} requests succeeded, {job.n_failed} failed")
+
+
+@celery_app.task
+def poll_batch_translations():
+    """ This is beat task that is supposed to run every 10 mins """
+    for job in TranslationBatchJob.load_in_flight(db):
+        try:
+            poll_batch_job(job)
+        except Exception as e:
+            logger.error(f"Could not poll batch job {job.id}: {e}")
@@ -1,100 +1,176 @@
+import os
 import json
+import asyncio
+from datetime import datetime
 from pathlib import Path
-from typing import List, Optional
+from bson import ObjectId
+from typing import List, Optional, Dict, Tuple
 
 from nos.config import celery_app, db, logger
-from nos.schemas.enums import TranslationEntityType
+from nos.schemas.enums import TranslationEntityType, TranlsationStatus
 from nos.schemas.prompt_schemas import PromptSchema
 from nos.schemas.secrets_schema import Provider
 from nos.schemas.scraping_schema import NovelData
+from nos.schemas.batch_schema import TranslationBatchJob
 from nos.schemas.translation_entities_schema import TranslationEntity
-from nos.translators.models import Translator
-
-
-@celery_app.task
-def beat_update_tags_of_novels():
-    """ This is a beat task that is supposed to run periodically and update the tags for novels."""
-
-    
-    # Load all the newly added novels (missing tag field)
-    novel_data_records: List[NovelData] = NovelData.load(
-        db=db,
-        query={
-            "tags_raw": {"$exists": True, "$ne": []},
-            "$or": [
-                {"tags": {"$exists": False}},  # Field doesn't exist
-                {"tags": {"$in": [None, []]}}  # Field is None or empty list
-            ]
-        },
-        many=True
-    ) # type: ignore
-        
+from nos.schemas.mixins import DEFAULT_BULK_BATCH_SIZE
+from nos.translators.async_models import AsyncTranslator
+from nos.utils.token_utils import estimate_tokens, pack_by_token_budget
+
+
+# The output of a chunk of tags must stay well within the max_tokens of the tag_translation prompt
+TAG_TRANSLATION_CHUNK_TOKEN_BUDGET = int(os.environ.get("TAG_TRANSLATION_CHUNK_TOKEN_BUDGET", 2000))
+TAG_TRANSLATION_MAX_ATTEMPTS = int(os.environ.get("TAG_TRANSLATION_MAX_ATTEMPTS", 3))
+
+
+def get_missing_tags_query(novel_ids: Optional[List[str]]=None) -> dict:
+    """
+    The novels that have raw tags but no translated tags yet. If novel_ids are given, those novels whatever their
+    translated tags are, since they are only passed when their raw tags changed
+    """
+    query: dict = {"tags_raw": {"$exists": True, "$ne": []}}
+    if novel_ids is not None:
+        query["_id"] = {"$in": [ObjectId(n) for n in novel_ids]}
+        return query
+    query["$or"] = [
+        {"tags": {"$exists": False}},  # Field doesn't exist
+        {"tags": {"$in": [None, []]}}  # Field is None or empty list
+    ]
+    return query
+
+
+def collect_untranslated_tags(query: dict) -> Tuple[Dict[str, str], List[str]]:
+    """ The existing translations of the tags of the novels in the query, and the tags that have none yet """
     # Get all the unique tags
-    all_tags = []
-    for nd in novel_data_records:
-        all_tags.extend(nd.tags_raw)
-    all_tags = set(all_tags)
+    all_tags = set()
+    n_novels = 0
+    for nd in NovelData.iter_load(db, query=query, projection={"tags_raw": 1}, raw=True):
+        all_tags.update(nd["tags_raw"])
+        n_novels += 1
     
-    logger.debug(f"Found {len(novel_data_records)} novels with missing tags")
+    logger.debug(f"Found {n_novels} novels with missing tags")
     logger.debug(f"Found {len(all_tags)} unique tags")
-    logger.debug(f"All unique tags: {all_tags}")
         
-    # Get all the translated tags
-    all_translated_tags: List[TranslationEntity] = TranslationEntity.load(
-        db=db,
-        query={"type": TranslationEntityType.TAGS.value},
-        many=True
-    ) # type: ignore
+    # Get the translations of only these tags
+    translated_kv_pairs = {
+        te["key"]: te["value"]
+        for te in TranslationEntity.iter_load(
+            db,
+            query={"type": TranslationEntityType.TAGS.value, "key": {"$in": list(all_tags)}},
+            projection={"key": 1, "value": 1, "_id": 0},
+            raw=True
+        )
+    }
 
     # Get list of untranslated tags
-    translated_keys = set([k.key for k in all_translated_tags])
-    translated_kv_pairs = {k.key: k.value for k in all_translated_tags}
-    untranslated_keys = list(all_tags - translated_keys)
-    
+    untranslated_keys = list(all_tags - set(translated_kv_pairs))
     logger.debug(f"Found {len(untranslated_keys)} untranslated tags")
-    logger.debug(f"Untranslated keys: {untranslated_keys}")
-    
-    untranslated_kv_pairs = {k: None for k in untranslated_keys}
+    return translated_kv_pairs, untranslated_keys
+
 
+@celery_app.task
+def beat_update_tags_of_novels(novel_ids: Optional[List[str]]=None):
+    """
+    This is a beat task that is supposed to run periodically and update the tags for novels.
+    The novels are streamed twice with only the tags_raw field, once to collect the unique tags and once to
+    write the translated tags, so memory stays flat as the catalogue grows.
+    If novel_ids are given, only those novels are updated, even if they already have translated tags. The novel
+    watcher uses this to update the tags of a novel as soon as it is scraped or its raw tags change
+    """
+
+    query = get_missing_tags_query(novel_ids)
+    translated_kv_pairs, untranslated_keys = collect_untranslated_tags(query)
+    # The tags of the submitted batch jobs are translated by them
+    untranslated_keys = list(set(untranslated_keys) - TranslationBatchJob.get_in_flight_tags(db))
+    logger.debug(f"{len(untranslated_keys)} untranslated keys")
+
+    newly_translated_kv_pairs = {}
     if len(untranslated_keys) > 0:
-        translator = Translator()
-        response = translator.run_translation(untranslated_keys, "tag_translation")
-        
-        newly_translated_kv_pairs = response.llm_call_metadata.response_content
-        # Log this data
-        logger.debug(f"Newly translated kv pairs: {newly_translated_kv_pairs}")
-        assert isinstance(newly_translated_kv_pairs, dict)
-        for k in untranslated_kv_pairs:
-            untranslated_kv_pairs[k] = newly_translated_kv_pairs[k]  # Ensure that the key exists. if it doesnot, then let it fail
-            
-    # create and save the entities
-    translation_entities = [{
-        "key": k,
-        "value": v,
-        "type": TranslationEntityType.TAGS
-    } for k, v in untranslated_kv_pairs.items()]
-    
-    for translation_entity in translation_entities:
-        translation_entity.update(db=db)
-        
-    logger.debug(f"Updated {len(translation_entities)} translation entities")
+        newly_translated_kv_pairs = asyncio.run(_translate_tags(untranslated_keys))
+        logger.debug(f"Translated {len(newly_translated_kv_pairs)} keys")
 
-    all_tags_kv_pairs = {**translated_kv_pairs, **untranslated_kv_pairs}
-    # We are ensuring that all the untranslate dtags have been translated
-    assert all(all_tags_kv_pairs[k] is not None for k in all_tags_kv_pairs)
-        
-    for nd in novel_data_records:
-        # Update the tags for each nd
-        nd.tags = []
-        for k in nd.tags_raw:
-            value = all_tags_kv_pairs[k]
-            if value is not None:
-                nd.tags.append(value)
-        nd.update(db=db)
-
-    logger.debug(f"Updated {len(novel_data_records)} novels with tags")
+    all_tags_kv_pairs = {**translated_kv_pairs, **newly_translated_kv_pairs}
+
+    # A novel is only updated once all of its tags are translated. The rest are picked up by the next run.
+    # The novels are sorted by _id so that the ones being updated are not visited again by the cursor
+    novels_to_update: List[NovelData] = []
+    n_updated = 0
+    for nd in NovelData.iter_load(db, query=query, projection={"tags_raw": 1}, sort={"_id": 1}):
+        if not all(k in all_tags_kv_pairs for k in nd.tags_raw): # type: ignore
+            continue
+        nd.tags = [all_tags_kv_pairs[k] for k in nd.tags_raw] # type: ignore
+        novels_to_update.append(nd) # type: ignore
+        if len(novels_to_update) >= DEFAULT_BULK_BATCH_SIZE:
+            NovelData.bulk_update(db, novels_to_update, fields=["tags"])
+            n_updated += len(novels_to_update)
+            novels_to_update = []
+    NovelData.bulk_update(db, novels_to_update, fields=["tags"])
+    n_updated += len(novels_to_update)
+
+    logger.debug(f"Updated {n_updated} novels with tags")
     
-    return all_tags_kv_pairs, untranslated_kv_pairs
+    return all_tags_kv_pairs, newly_translated_kv_pairs
+
+
+def estimate_tag_tokens(tag: str) -> int:
+    """ Every tag shows up in the output twice, once as the key and once translated, plus the json punctuation """
+    return 2 * estimate_tokens(tag) + 8
+
+
+def save_tag_translations(kv_pairs: Dict[str, str]):
+    translation_entities = [TranslationEntity(key=k, value=v, type=TranslationEntityType.TAGS) for k, v in kv_pairs.items()]
+    TranslationEntity.bulk_upsert(db, translation_entities, key_fields=["type", "key"])
+
+
+async def _translate_tag_chunk(translator: AsyncTranslator, chunk: List[str]) -> Dict[str, str]:
+    """
+    Translate a chunk of tags and save the translations as soon as they arrive. The tags are collected as they
+    stream in, so a response that is cut short or turns invalid halfway still keeps the tags before it. Tags that
+    are missing from the response are retried on their own, so a bad response only costs the tags it dropped
+    """
+    translated: Dict[str, str] = {}
+    for attempt in range(1, TAG_TRANSLATION_MAX_ATTEMPTS + 1):
+        pending = [k for k in chunk if k not in translated]
+        streamed: Dict[str, str] = {}
+
+        def on_item(key, value):
+            if key in pending and isinstance(value, str):
+                streamed[key] = value
+
+        try:
+            response = await translator.run_translation(pending, "tag_translation", on_item=on_item)
+            response_content = response.llm_call_metadata.response_content
+            if response.status != TranlsationStatus.COMPLETED or not isinstance(response_content, dict):
+                logger.error(f"Attempt {attempt} to translate a chunk of {len(pending)} tags failed: {response.error_message}")
+            else:
+                streamed.update({k: response_content[k] for k in pending if isinstance(response_content.get(k), str)})
+        except Exception as e:
+            logger.error(f"Attempt {attempt} to translate a chunk of {len(pending)} tags failed: {e}")
+
+        if streamed:
+            await asyncio.to_thread(save_tag_translations, streamed)
+            translated.update(streamed)
+        if len(translated) == len(chunk):
+            break
+        logger.debug(f"Attempt {attempt} left {len(chunk) - len(translated)} tags of the chunk untranslated")
+
+    return translated
+
+
+async def _translate_tags(untranslated_keys: List[str]) -> Dict[str, str]:
+    """ Split the tags into token budgeted chunks and translate them concurrently """
+    translator = AsyncTranslator()
+    chunks = pack_by_token_budget(untranslated_keys, estimate_tag_tokens, TAG_TRANSLATION_CHUNK_TOKEN_BUDGET)
+    logger.debug(f"Translating {len(untranslated_keys)} tags in {len(chunks)} chunks")
+
+    results = await asyncio.gather(*[_translate_tag_chunk(translator, chunk) for chunk in chunks], return_exceptions=True)
+    translated: Dict[str, str] = {}
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error(f"A chunk of tags failed to translate: {result}")
+            continue
+        translated.update(result)
+    return translated
 
 
 @celery_app.task
@@ -113,12 +189,14 @@ def beat_update_prompts():
         if prompt_from_db is None:
             # Directly save the prompt from file to the db
             prompt_from_file.update(db=db)
+            PromptSchema.bump_registry_version(db)
             logger.debug(f"Prompt {prompt_file.stem} saved to db")
             continue
         
         if prompt_from_file.fingerprint != prompt_from_db.fingerprint:
             logger.debug(f"Prompt {prompt_file.stem} has changed. Updating db")
             prompt_from_file.update(db=db)
+            PromptSchema.bump_registry_version(db)
             continue
         
         logger.debug(f"Prompt {prompt_file.stem} has not changed. Skipping")
@@ -134,19 +212,9 @@ def beat_update_providers():
         secrets_json = json.load(f)
     providers = Provider.load_from_secrets_json(secrets_json)
     logger.debug(f"Found {len(providers)} providers")
-    # Check if the providers exist in the db
+    # Upsert all the providers in one go. Only the config fields are written to existing providers so that
+    # the usage counters, which the workers increment concurrently, are left untouched
     for provider in providers:
-        provider_from_db: Optional[Provider] = Provider.load(db, query={"key": provider.key}, many=False) # type: ignore
-        if provider_from_db is None:
-            provider.update(db=db)
-            logger.debug(f"Provider {provider.name} saved to db")
-        else:
-            # Copy over the values from json to db and update the db
-            provider_from_db.model_names = provider.model_names
-            provider_from_db.name = provider.name
-            provider_from_db.priority = provider.priority
-            provider_from_db.update(db=db)
-            logger.debug(f"Provider {provider.name} updated in db")
-
-            
-
+        provider.updated_at = datetime.now()
+    Provider.bulk_upsert(db, providers, key_fields=["key"], update_fields=["model_names", "name", "priority", "max_concurrent_requests", "requests_per_minute", "request_budget", "supports_batch", "updated_at"])
+    logger.debug(f"Upserted {len(providers)} providers in the db")
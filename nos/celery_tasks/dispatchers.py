@@ -1,61 +1,195 @@
-
+import os
 import datetime
 from typing import List, Optional
+from bson import ObjectId
 
-
-from nos.config import celery_app, logger, db
-from nos.celery_tasks.tasks import translate_novel_metadata
+from nos.config import celery_app, logger, db, REDIS_URL
+from nos.celery_tasks.tasks import translate_novels_metadata, translate_novel_metadata_batch, translate_chapter, NOVEL_METADATA_BATCH_MAX_NOVELS, NOVEL_METADATA_CONCURRENT_MAX_NOVELS
+from nos.schemas.chapter_schema import ChapterData
+from nos.schemas.enums import TranlsationStatus
 from nos.schemas.scraping_schema import NovelData
+from nos.schemas.secrets_schema import Provider
+from nos.utils.metrics import DISPATCHED, DISPATCH_SIZE, TRANSLATION_QUEUE_DEPTH
+from nos.utils.redis_utils import get_redis_client
+
+
+# Send the dispatched novels as tasks that pack several novels into each llm request
+NOVEL_METADATA_BATCH_MODE = os.environ.get("NOVEL_METADATA_BATCH_MODE", "false").lower() == "true"
+# The most chapters dispatched every run. The segments of each chapter are translated concurrently
+CHAPTER_DISPATCH_LIMIT = int(os.environ.get("CHAPTER_DISPATCH_LIMIT", 10))
+
+TRANSLATIONS_QUEUE = "translations"
+# The dispatchers keep about this many tasks queued per worker slot, enough to keep the workers busy till the next tick
+DISPATCHER_QUEUED_TASKS_PER_SLOT = int(os.environ.get("DISPATCHER_QUEUED_TASKS_PER_SLOT", 2))
+# The most novels dispatched every run, however much capacity there is
+DISPATCHER_MAX_NOVELS_PER_RUN = int(os.environ.get("DISPATCHER_MAX_NOVELS_PER_RUN", 200))
+# How long (in seconds) the worker concurrency is cached in redis. Inspecting the workers is a broadcast that can take seconds
+DISPATCHER_WORKER_CONCURRENCY_CACHE_TTL = int(os.environ.get("DISPATCHER_WORKER_CONCURRENCY_CACHE_TTL", 120))
+WORKER_CONCURRENCY_CACHE_KEY = "nos:dispatchers:translation_worker_concurrency"
+# A dispatched item that is not translated within this long is dispatched again
+REDISPATCH_AFTER = datetime.timedelta(hours=1)
 
 
+def get_translation_worker_concurrency() -> int:
+    """ The total number of processes consuming the translations queue, across all the workers. Cached in redis """
+    redis_client = get_redis_client(REDIS_URL)
+    cached = redis_client.get(WORKER_CONCURRENCY_CACHE_KEY)
+    if cached is not None:
+        return int(cached) # type: ignore
 
-def check_active_celery_workers():
     inspect = celery_app.control.inspect()
-    active_queues = inspect.active_queues()
-    if active_queues is None:
-        logger.info("No active queues")
-        return False
-    
-
-    logger.info(f"Active queues: {active_queues}")
-    
-    for host in active_queues:
-        for queue in active_queues[host]:   
-            if queue['name'] == "translations":
-                return True
-    
-    return False
+    active_queues = inspect.active_queues() or {}
+    stats = inspect.stats() or {}
+    concurrency = 0
+    for host, queues in active_queues.items():
+        if any(queue['name'] == TRANSLATIONS_QUEUE for queue in queues):
+            concurrency += stats.get(host, {}).get("pool", {}).get("max-concurrency", 1)
 
+    logger.info(f"{concurrency} worker processes are consuming the {TRANSLATIONS_QUEUE} queue")
+    redis_client.set(WORKER_CONCURRENCY_CACHE_KEY, concurrency, ex=DISPATCHER_WORKER_CONCURRENCY_CACHE_TTL)
+    return concurrency
 
-@celery_app.task
-def dispatch_novel_metadata_translation():
-    """ This is beat task that is supposed to run every 5 mins """
 
-    if not check_active_celery_workers():
-        logger.error("No active celery workers. Skipping dispatch")
-        return
-    
-    query = {
-        "all_data_parsed": False,
+def get_translation_queue_depth() -> int:
+    """ The number of tasks waiting in the translations queue. With the redis broker, the queue is a redis list """
+    queue_depth: int = get_redis_client(REDIS_URL).llen(TRANSLATIONS_QUEUE) # type: ignore
+    TRANSLATION_QUEUE_DEPTH.set(queue_depth)
+    return queue_depth
+
+
+def get_provider_request_budget() -> Optional[int]:
+    """ The requests left across the providers that are not rate limited. None if any of them has an unknown budget """
+    providers: List[Provider] = Provider.load(
+        db=db,
+        query={"rate_limit_info.rate_limit_reset_time": {"$lt": datetime.datetime.now()}},
+        many=True,
+    ) or [] # type: ignore
+    remaining_requests = [provider.get_remaining_requests() for provider in providers]
+    if any(remaining is None for remaining in remaining_requests):
+        return None
+    return sum(remaining_requests) # type: ignore
+
+
+def get_free_translation_slots() -> int:
+    """ The number of tasks that can be queued now without flooding the translations queue """
+    concurrency = get_translation_worker_concurrency()
+    if concurrency == 0:
+        return 0
+    queue_depth = get_translation_queue_depth()
+    free_slots = max(0, concurrency * DISPATCHER_QUEUED_TASKS_PER_SLOT - queue_depth)
+    logger.debug(f"{concurrency} worker processes, {queue_depth} queued tasks, {free_slots} free slots")
+    return free_slots
+
+
+def get_novels_per_task() -> int:
+    return NOVEL_METADATA_BATCH_MAX_NOVELS if NOVEL_METADATA_BATCH_MODE else NOVEL_METADATA_CONCURRENT_MAX_NOVELS
+
+
+def get_novel_metadata_dispatch_size() -> int:
+    """ Size the dispatch to the free worker slots and the request budget of the providers """
+    free_slots = get_free_translation_slots()
+    dispatch_size = min(free_slots * get_novels_per_task(), DISPATCHER_MAX_NOVELS_PER_RUN)
+
+    request_budget = get_provider_request_budget()
+    if request_budget is not None:
+        # A request translates a single novel, or up to a batch of novels in the batch mode
+        novels_per_request = NOVEL_METADATA_BATCH_MAX_NOVELS if NOVEL_METADATA_BATCH_MODE else 1
+        dispatch_size = min(dispatch_size, request_budget * novels_per_request)
+    return dispatch_size
+
+
+def record_dispatch(kind: str, n_items: int):
+    DISPATCHED.inc(n_items, kind=kind)
+    DISPATCH_SIZE.observe(n_items, kind=kind)
+
+
+def get_dispatchable_query(status_query: dict, now: datetime.datetime) -> dict:
+    return {
+        **status_query,
         "$or": [
-            {"dispatched_at": {"$exists": False}},
-            {"dispatched_at": {"$lt": datetime.datetime.now() - datetime.timedelta(hours=1)}}
+            {"dispatched_at": None},
+            {"dispatched_at": {"$lt": now - REDISPATCH_AFTER}}
         ]
     }
 
-    novels: Optional[List[NovelData]] = NovelData.load(db=db, query=query, many=True, limit=3) # type: ignore
 
-    if novels is None:
+def claim_novels_for_metadata_translation(limit: int, novel_ids: Optional[List[ObjectId]]=None) -> List[NovelData]:
+    """ Claim up to limit untranslated novels, only among novel_ids if given. Only the ids of the novels are loaded """
+    now = datetime.datetime.now()
+    status_query: dict = {"all_data_parsed": False}
+    if novel_ids is not None:
+        status_query["_id"] = {"$in": novel_ids}
+    return NovelData.claim_many(
+        db,
+        query=get_dispatchable_query(status_query, now),
+        update={"$set": {"dispatched_at": now}},
+        limit=limit,
+        projection={"_id": 1},
+    )
+
+
+def send_novel_metadata_tasks(novels: List[NovelData]):
+    """
+    Send the novels in chunks, so every task keeps many llm requests in flight through the AsyncTranslator instead
+    of holding a worker process for a single blocking request
+    """
+    task = translate_novel_metadata_batch if NOVEL_METADATA_BATCH_MODE else translate_novels_metadata
+    novels_per_task = get_novels_per_task()
+    for start in range(0, len(novels), novels_per_task):
+        task.delay([str(novel.id) for novel in novels[start:start + novels_per_task]])
+    record_dispatch("novel_metadata", len(novels))
+
+
+@celery_app.task
+def dispatch_novel_metadata_translation():
+    """
+    This is beat task that is supposed to run every minute. The number of novels dispatched is sized to the free
+    worker slots and the provider budget, and the novels are claimed in bulk with a claim token, so overlapping runs
+    never dispatch the same novel twice
+    """
+
+    dispatch_size = get_novel_metadata_dispatch_size()
+    if dispatch_size == 0:
+        logger.info("No capacity to translate novels. Skipping dispatch")
+        return
+
+    novels = claim_novels_for_metadata_translation(dispatch_size)
+
+    if not novels:
         logger.info("No novels to dispatch")
         return
-    
+
     logger.info(f"Dispatching {len(novels)} novels")
+    send_novel_metadata_tasks(novels)
+    return len(novels)
+
+
+@celery_app.task
+def dispatch_chapter_translation():
+    """ This is beat task that is supposed to run every 5 mins. The failed chapters are dispatched again to resume their pending segments """
 
-    for novel in novels:
+    dispatch_size = min(get_free_translation_slots(), CHAPTER_DISPATCH_LIMIT)
+    if dispatch_size == 0:
+        logger.info("No capacity to translate chapters. Skipping dispatch")
+        return
+
+    # Only the ids are needed, the chapters themselves can be large
+    now = datetime.datetime.now()
+    chapters: List[ChapterData] = ChapterData.claim_many(
+        db,
+        query=get_dispatchable_query({"translation_status": {"$ne": TranlsationStatus.COMPLETED.value}}, now),
+        update={"$set": {"dispatched_at": now}},
+        limit=dispatch_size,
+        projection={"_id": 1},
+    )
+
+    if not chapters:
+        logger.info("No chapters to dispatch")
+        return
 
-        translate_novel_metadata.delay(str(novel.id))
-        novel.dispatched_at = datetime.datetime.now()
-        novel.update(db=db)
-        logger.info(f"Dispatched novel {novel.id} for translation")
+    logger.info(f"Dispatching {len(chapters)} chapters")
 
-    
\ No newline at end of file
+    for chapter in chapters:
+        translate_chapter.delay(str(chapter.id))
+    record_dispatch("chapter", len(chapters))
+    return len(chapters)
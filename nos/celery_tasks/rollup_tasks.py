@@ -0,0 +1,121 @@
+import os
+import datetime
+from bson import ObjectId
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from nos.config import celery_app, db, logger
+from nos.schemas.enums import RollupGranularity
+from nos.schemas.rollup_schema import TranslationRollup, RollupWatermark, ROLLUP_KEY_FIELDS, get_bucket_start, get_latency_bucket
+from nos.schemas.translator_schemas import TranslatorMetadata
+
+
+# The translator metadata rolled up per batch, and the most batches per run of the beat task
+ROLLUP_BATCH_SIZE = int(os.environ.get("ROLLUP_BATCH_SIZE", 5000))
+ROLLUP_MAX_BATCHES_PER_RUN = int(os.environ.get("ROLLUP_MAX_BATCHES_PER_RUN", 20))
+# Translator metadata younger than this (in seconds) waits for the next run. The ids are generated by the clients, so a
+# document can be inserted a little after another one with a later id, and it would be skipped otherwise
+ROLLUP_SETTLE_SECONDS = int(os.environ.get("ROLLUP_SETTLE_SECONDS", 120))
+ROLLUP_WATERMARK_NAME = "translator_metadata"
+DUPLICATE_KEY_ERROR = 11000
+
+ROLLUP_PROJECTION = {
+    **{field: 1 for field in ROLLUP_KEY_FIELDS},
+    "cache_hit": 1,
+    "llm_call_metadata.input_tokens": 1,
+    "llm_call_metadata.output_tokens": 1,
+    "llm_call_metadata.total_time_taken": 1,
+    "llm_call_metadata.end_time": 1,
+}
+
+RollupKey = Tuple
+
+
+def get_call_time(doc: dict) -> datetime.datetime:
+    """ When the call ended. The older documents without an end_time fall back to the creation time of their id """
+    end_time = (doc.get("llm_call_metadata") or {}).get("end_time")
+    return end_time or doc["_id"].generation_time.astimezone().replace(tzinfo=None)
+
+
+def accumulate_rollups(docs: Iterable[dict]) -> Dict[RollupKey, Dict[str, float]]:
+    """ The $inc of every hourly and daily rollup the translator metadata documents add to """
+    incs: Dict[RollupKey, Dict[str, float]] = defaultdict(lambda: defaultdict(int))
+    for doc in docs:
+        llm_call_metadata = doc.get("llm_call_metadata") or {}
+        call_time = get_call_time(doc)
+        for granularity in RollupGranularity:
+            inc = incs[(granularity.value, get_bucket_start(call_time, granularity), *(doc.get(field) for field in ROLLUP_KEY_FIELDS))]
+            inc["n_calls"] += 1
+            if doc.get("cache_hit"):
+                inc["n_cache_hits"] += 1
+                continue
+            inc["input_tokens"] += llm_call_metadata.get("input_tokens") or 0
+            inc["output_tokens"] += llm_call_metadata.get("output_tokens") or 0
+            latency = llm_call_metadata.get("total_time_taken")
+            if latency is not None:
+                inc["latency_sum"] += latency
+                inc[f"latency_counts.{get_latency_bucket(latency)}"] += 1
+    return incs
+
+
+def write_rollups(incs: Dict[RollupKey, Dict[str, float]], applied_up_to: ObjectId):
+    """
+    Upsert the rollups with the increments of a batch ending at applied_up_to. A rollup the batch was applied to
+    already does not match the filter, so its upsert fails on the unique index and is skipped
+    """
+    operations = []
+    for key, inc in incs.items():
+        granularity, bucket_start, *key_values = key
+        query = {"granularity": granularity, "bucket_start": bucket_start, **dict(zip(ROLLUP_KEY_FIELDS, key_values))}
+        query["$or"] = [{"applied_up_to": None}, {"applied_up_to": {"$lt": applied_up_to}}]
+        operations.append(UpdateOne(query, {"$inc": dict(inc), "$set": {"applied_up_to": applied_up_to}}, upsert=True))
+    if not operations:
+        return
+    try:
+        db[TranslationRollup._collection_name].bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        logger.warning(f"{len(errors)} rollups were already updated up to {applied_up_to}")
+
+
+def rollup_translator_metadata_batch(cutoff_id: ObjectId) -> int:
+    """ Roll up the next ROLLUP_BATCH_SIZE translator metadata after the watermark. Returns how many there were """
+    last_id = RollupWatermark.load_last_id(db, ROLLUP_WATERMARK_NAME)
+    id_query: dict = {"$lt": cutoff_id}
+    if last_id is not None:
+        id_query["$gt"] = last_id
+    docs = list(TranslatorMetadata.iter_load(db, query={"_id": id_query}, projection=ROLLUP_PROJECTION, raw=True, sort={"_id": 1}, limit=ROLLUP_BATCH_SIZE))
+    if not docs:
+        return 0
+    write_rollups(accumulate_rollups(docs), docs[-1]["_id"]) # type: ignore
+    RollupWatermark.save_last_id(db, ROLLUP_WATERMARK_NAME, docs[-1]["_id"]) # type: ignore
+    return len(docs)
+
+
+def rollup_translator_metadata(max_batches: Optional[int]=ROLLUP_MAX_BATCHES_PER_RUN) -> int:
+    """ Roll up the translator metadata that is older than ROLLUP_SETTLE_SECONDS. With max_batches None, all of it """
+    cutoff_id = ObjectId.from_datetime(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=ROLLUP_SETTLE_SECONDS))
+    n_rolled_up = n_batches = 0
+    while max_batches is None or n_batches < max_batches:
+        n_docs = rollup_translator_metadata_batch(cutoff_id)
+        n_rolled_up += n_docs
+        n_batches += 1
+        if n_docs < ROLLUP_BATCH_SIZE:
+            break
+    return n_rolled_up
+
+
+@celery_app.task
+def beat_rollup_translator_metadata():
+    """
+    This is beat task that is supposed to run every 5 mins. Only the translator metadata inserted since the last run
+    is read. Overlapping runs are safe, a batch is only ever added to a rollup once
+    """
+    n_rolled_up = rollup_translator_metadata()
+    logger.info(f"Rolled up {n_rolled_up} translator metadata")
+    return n_rolled_up
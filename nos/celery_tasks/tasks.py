@@ -1,53 +1,344 @@
+import os
+import json
+import time
+import asyncio
 from bson import ObjectId
-from typing import Optional
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, before_task_publish, task_prerun, task_postrun
+from typing import Optional, List, Dict
 
 from nos.config import celery_app, db, logger
+from nos.ensure_indexes import ensure_indexes
+from nos.schemas.chapter_schema import ChapterData, ChapterSegment
 from nos.schemas.enums import TranlsationStatus
 from nos.schemas.scraping_schema import NovelData
-from nos.translators.models import Translator
+from nos.schemas.translator_schemas import TranslatorMetadata
+from nos.exceptions.translator_exceptions import NoProvidersAvailable
+from nos.translators.models import get_worker_translator
+from nos.translators.http_clients import close_http_clients
+from nos.translators.async_models import AsyncTranslator
+from nos.translators.provider_pool import flush_provider_pool
+from nos.utils.metrics import start_metrics_server, start_metrics_flusher, flush_metrics, TASK_QUEUE_LAG, TASK_DURATION
+from nos.utils.token_utils import estimate_tokens, pack_by_token_budget, split_into_segments, PARAGRAPH_SEPARATOR
+
+
+# The usage counters of the providers are written behind, so flush them before the worker process exits
+worker_process_shutdown.connect(flush_provider_pool)
+worker_process_shutdown.connect(close_http_clients)
+# The worker processes hand their metrics to the main process of the worker, which serves them
+worker_process_init.connect(start_metrics_flusher)
+worker_process_shutdown.connect(flush_metrics)
+
+
+@worker_process_init.connect
+def setup_worker_translator(**kwargs):
+    """ Create the translator of the worker process up front, so the first task does not pay for it """
+    try:
+        get_worker_translator()
+    except NoProvidersAvailable:
+        # It is created by the first task that needs it instead
+        logger.warning("No providers are available yet. The worker translator will be created on first use")
+
+
+@worker_init.connect
+def ensure_indexes_on_worker_init(**kwargs):
+    ensure_indexes(db)
+
+
+@worker_init.connect
+def start_metrics_server_on_worker_init(**kwargs):
+    try:
+        start_metrics_server()
+    except OSError as e:
+        # Another worker on this host serves the port already
+        logger.warning(f"Could not serve the metrics: {e}")
+
+
+# The wall clock time a task was sent at, to measure how long it waited in the queue
+SENT_AT_HEADER = "nos_sent_at"
+_task_start_times: Dict[str, float] = {}
+
+
+@before_task_publish.connect
+def set_sent_at_header(headers: Optional[Dict]=None, **kwargs):
+    if headers is not None:
+        headers[SENT_AT_HEADER] = time.time()
+
+
+@task_prerun.connect
+def record_task_start(task_id: Optional[str]=None, task=None, **kwargs):
+    if task is None or task_id is None:
+        return
+    sent_at = getattr(task.request, SENT_AT_HEADER, None) or (task.request.headers or {}).get(SENT_AT_HEADER)
+    if sent_at is not None:
+        TASK_QUEUE_LAG.observe(max(0.0, time.time() - sent_at), task=task.name)
+    _task_start_times[task_id] = time.monotonic()
+
+
+@task_postrun.connect
+def record_task_end(task_id: Optional[str]=None, task=None, state: Optional[str]=None, **kwargs):
+    start_time = _task_start_times.pop(task_id, None) # type: ignore
+    if task is not None and start_time is not None:
+        TASK_DURATION.observe(time.monotonic() - start_time, task=task.name, state=state or "UNKNOWN")
+
+
+NOVEL_METADATA_BATCH_INPUT_TOKEN_BUDGET = int(os.environ.get("NOVEL_METADATA_BATCH_INPUT_TOKEN_BUDGET", 6000))
+NOVEL_METADATA_BATCH_OUTPUT_TOKEN_BUDGET = int(os.environ.get("NOVEL_METADATA_BATCH_OUTPUT_TOKEN_BUDGET", 6000))
+NOVEL_METADATA_BATCH_MAX_NOVELS = int(os.environ.get("NOVEL_METADATA_BATCH_MAX_NOVELS", 10))
+# The most novels a translate_novels_metadata task translates concurrently, one llm request per novel
+NOVEL_METADATA_CONCURRENT_MAX_NOVELS = int(os.environ.get("NOVEL_METADATA_CONCURRENT_MAX_NOVELS", 20))
+NOVEL_METADATA_OUTPUT_KEYS = ("title", "author", "description")
+# The (estimated) input tokens of each segment of a chapter. The translation is a bit longer than the raw text, so keep it well under max_tokens of the prompt
+CHAPTER_SEGMENT_TOKEN_BUDGET = int(os.environ.get("CHAPTER_SEGMENT_TOKEN_BUDGET", 1500))
+
+
+def get_novel_metadata_input(novel: NovelData) -> dict:
+    return {
+        "title_raw": novel.title_raw,
+        "author_raw": novel.author_raw,
+        "description_raw": novel.description_raw,
+    }
+
+
+def apply_novel_metadata(novel: NovelData, response_content: Optional[Dict]) -> bool:
+    """ Save the translated metadata onto the novel. Returns whether the translated metadata was valid """
+    if isinstance(response_content, dict) and all(isinstance(response_content.get(k), str) for k in NOVEL_METADATA_OUTPUT_KEYS):
+        novel.title = response_content["title"]
+        novel.author = response_content["author"]
+        novel.description = response_content["description"]
+        novel.all_data_parsed = True
+        novel.update(db=db)
+        logger.info(f"Translation completed for novel {novel.id}")
+        return True
+
+    logger.error(f"Translation failed for novel {novel.id}")
+    novel.all_data_parsed = False
+    novel.update(db=db)
+    return False
+
+
+def apply_novel_metadata_translation(novel: NovelData, translation_metadata: TranslatorMetadata) -> bool:
+    """ Save the translated metadata onto the novel. Returns whether the translation was successfull """
+    if translation_metadata.status == TranlsationStatus.COMPLETED:
+        return apply_novel_metadata(novel, translation_metadata.llm_call_metadata.response_content) # type: ignore
+    return apply_novel_metadata(novel, None)
 
 
 @celery_app.task(queue="translations")
 def translate_novel_metadata(novel_id: str):
     """
-    Basically translate the metadata of the novel 
+    Basically translate the metadata of the novel
     """
-    
+
     novel: Optional[NovelData] = NovelData.load(db=db, query={"_id": ObjectId(novel_id)}) # type: ignore
-    
+
     if novel is None:
         raise Exception(f"Novel {novel_id} not found. Maybe someone deleted it manually?")
-    
+
     logger.info(f"Translating metadata of novel {novel_id}")
-        
-    t = Translator()
 
-    data = {
-        "title_raw": novel.title_raw,
-        "author_raw": novel.author_raw,
-        "description_raw": novel.description_raw,
-    }
-    
-    translation_metadata = t.run_translation(
-        text=data,
+    translation_metadata = get_worker_translator().run_translation(
+        text=get_novel_metadata_input(novel),
         prompt_name="novel_metadata_translation",
         novel_id=novel.id,
     )
-    
-    if translation_metadata.status == TranlsationStatus.COMPLETED:
-        response_content = translation_metadata.llm_call_metadata.response_content
-        assert isinstance(response_content, dict)
-        novel.title = response_content["title"]
-        novel.author = response_content["author"]
-        novel.description = response_content["description"]
-        novel.all_data_parsed = True
-        novel.update(db=db)
-        logger.info(f"Translation completed for novel {novel_id}")
-    else:
-        logger.error(f"Translation failed for novel {novel_id}")
-        novel.all_data_parsed = False
-        novel.update(db=db)
+
+    if not apply_novel_metadata_translation(novel, translation_metadata):
         raise Exception(f"Translation failed for novel {novel_id}")
 
 
-    
\ No newline at end of file
+async def _translate_novels_metadata(novels: List[NovelData]) -> List[bool]:
+    translator = AsyncTranslator()
+    results = await translator.run_translations_many([
+        {
+            "text": get_novel_metadata_input(novel),
+            "prompt_name": "novel_metadata_translation",
+            "novel_id": novel.id,
+        }
+        for novel in novels
+    ])
+
+    succeeded = []
+    for novel, result in zip(novels, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Translation failed for novel {novel.id}: {result}")
+            succeeded.append(False)
+            continue
+        try:
+            succeeded.append(await asyncio.to_thread(apply_novel_metadata_translation, novel, result))
+        except Exception as e:
+            logger.error(f"Could not save the translation for novel {novel.id}: {e}")
+            succeeded.append(False)
+    return succeeded
+
+
+@celery_app.task(queue="translations")
+def translate_novels_metadata(novel_ids: List[str]):
+    """
+    Translate the metadata of many novels concurrently through the AsyncTranslator. Each novel is
+    saved independently, so one failed translation does not fail the others
+    """
+    novels: List[NovelData] = NovelData.load(db=db, query={"_id": {"$in": [ObjectId(n) for n in novel_ids]}}, many=True) or [] # type: ignore
+    if len(novels) != len(novel_ids):
+        logger.warning(f"Only found {len(novels)} of the {len(novel_ids)} novels to translate")
+
+    logger.info(f"Translating metadata of {len(novels)} novels")
+    succeeded = asyncio.run(_translate_novels_metadata(novels))
+    logger.info(f"Translated metadata of {sum(succeeded)}/{len(novels)} novels")
+    return sum(succeeded)
+
+
+def estimate_novel_metadata_tokens(novel: NovelData) -> int:
+    """ The english output is roughly as long as the raw input, so a single estimate is used for both budgets """
+    return estimate_tokens(json.dumps(get_novel_metadata_input(novel), ensure_ascii=False))
+
+
+def pack_novel_metadata_batches(novels: List[NovelData]) -> List[List[NovelData]]:
+    """ Pack the novels into batches that fit within both the input and the output token budgets """
+    budget = min(NOVEL_METADATA_BATCH_INPUT_TOKEN_BUDGET, NOVEL_METADATA_BATCH_OUTPUT_TOKEN_BUDGET)
+    return pack_by_token_budget(novels, estimate_novel_metadata_tokens, budget, max_items=NOVEL_METADATA_BATCH_MAX_NOVELS)
+
+
+async def _translate_novel_metadata_batches(batches: List[List[NovelData]]) -> List[bool]:
+    translator = AsyncTranslator()
+    results = await translator.run_translations_many([
+        {
+            "text": {str(novel.id): get_novel_metadata_input(novel) for novel in batch},
+            "prompt_name": "novel_metadata_translation_batch",
+            "novel_ids": [novel.id for novel in batch],
+        }
+        for batch in batches
+    ])
+
+    succeeded = []
+    for batch, result in zip(batches, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Translation failed for a batch of {len(batch)} novels: {result}")
+            response_content = {}
+        elif result.status != TranlsationStatus.COMPLETED or not isinstance(result.llm_call_metadata.response_content, dict):
+            logger.error(f"Translation failed for a batch of {len(batch)} novels: {result.error_message}")
+            response_content = {}
+        else:
+            response_content = result.llm_call_metadata.response_content
+
+        # Every novel is saved on its own, so a novel missing from the response does not fail the rest
+        for novel in batch:
+            try:
+                succeeded.append(await asyncio.to_thread(apply_novel_metadata, novel, response_content.get(str(novel.id))))
+            except Exception as e:
+                logger.error(f"Could not save the translation for novel {novel.id}: {e}")
+                succeeded.append(False)
+    return succeeded
+
+
+@celery_app.task(queue="translations")
+def translate_novel_metadata_batch(novel_ids: List[str]):
+    """
+    Translate the metadata of many novels by packing several of them into each llm request, so the system
+    prompt is only sent once per batch. The batches are sized by the NOVEL_METADATA_BATCH_* token budgets
+    and are translated concurrently
+    """
+    novels: List[NovelData] = NovelData.load(db=db, query={"_id": {"$in": [ObjectId(n) for n in novel_ids]}}, many=True) or [] # type: ignore
+    if len(novels) != len(novel_ids):
+        logger.warning(f"Only found {len(novels)} of the {len(novel_ids)} novels to translate")
+
+    batches = pack_novel_metadata_batches(novels)
+    logger.info(f"Translating metadata of {len(novels)} novels in {len(batches)} batches")
+    succeeded = asyncio.run(_translate_novel_metadata_batches(batches))
+    logger.info(f"Translated metadata of {sum(succeeded)}/{len(novels)} novels")
+    return sum(succeeded)
+
+
+def prepare_chapter_segments(chapter: ChapterData):
+    """ Split the chapter into segments the first time it is picked up. A resumed chapter keeps its segments """
+    if chapter.segments:
+        return
+    chapter.segments = [
+        ChapterSegment(segment_idx=idx, text_raw=text)
+        for idx, text in enumerate(split_into_segments(chapter.content_raw, CHAPTER_SEGMENT_TOKEN_BUDGET))
+    ]
+    chapter.update(db=db, fields=["segments"])
+    logger.debug(f"Split chapter {chapter.id} into {len(chapter.segments)} segments")
+
+
+async def _translate_chapter_segment(translator: AsyncTranslator, chapter: ChapterData, segment: ChapterSegment) -> bool:
+    """ Translate a single segment and save it right away, so the segment is not translated again if the chapter is interrupted """
+    try:
+        result = await translator.run_translation(
+            text=segment.text_raw,
+            prompt_name="chapter_translation",
+            novel_id=chapter.novel_id,
+            chapter_id=chapter.id,
+        )
+    except Exception as e:
+        logger.error(f"Translation failed for segment {segment.segment_idx} of chapter {chapter.id}: {e}")
+        return False
+
+    response_content = result.llm_call_metadata.response_content
+    segment.translator_metadata_id = result.id
+    if result.status == TranlsationStatus.COMPLETED and isinstance(response_content, str) and response_content.strip():
+        segment.text = response_content.strip()
+        segment.status = TranlsationStatus.COMPLETED
+    else:
+        logger.error(f"Translation failed for segment {segment.segment_idx} of chapter {chapter.id}: {result.error_message}")
+        segment.status = TranlsationStatus.FAILED
+    await asyncio.to_thread(chapter.save_segment, db, segment)
+    return segment.status == TranlsationStatus.COMPLETED
+
+
+async def _translate_chapter_title(translator: AsyncTranslator, chapter: ChapterData) -> bool:
+    try:
+        result = await translator.run_translation(text=chapter.title_raw, prompt_name="chapter_translation", novel_id=chapter.novel_id, chapter_id=chapter.id)
+    except Exception as e:
+        logger.error(f"Translation failed for the title of chapter {chapter.id}: {e}")
+        return False
+
+    response_content = result.llm_call_metadata.response_content
+    if result.status != TranlsationStatus.COMPLETED or not isinstance(response_content, str) or not response_content.strip():
+        logger.error(f"Translation failed for the title of chapter {chapter.id}: {result.error_message}")
+        return False
+    chapter.title = response_content.strip()
+    await asyncio.to_thread(chapter.update, db, ["title"])
+    return True
+
+
+async def _translate_chapter(chapter: ChapterData, segments: List[ChapterSegment]) -> List[bool]:
+    translator = AsyncTranslator()
+    coroutines = [_translate_chapter_segment(translator, chapter, segment) for segment in segments]
+    if chapter.title is None:
+        coroutines.append(_translate_chapter_title(translator, chapter))
+    return await asyncio.gather(*coroutines)
+
+
+@celery_app.task(queue="translations")
+def translate_chapter(chapter_id: str):
+    """
+    Translate a chapter. The chapter is split into token budgeted segments on its paragraph boundaries, the
+    segments are translated concurrently through the AsyncTranslator and are joined in order once all of them
+    are translated. Every segment is saved as soon as it is translated, so a chapter that failed or was
+    interrupted only translates its remaining segments the next time it is dispatched
+    """
+    chapter: Optional[ChapterData] = ChapterData.load(db=db, query={"_id": ObjectId(chapter_id)}) # type: ignore
+
+    if chapter is None:
+        raise Exception(f"Chapter {chapter_id} not found. Maybe someone deleted it manually?")
+
+    prepare_chapter_segments(chapter)
+    pending_segments = [segment for segment in chapter.segments if segment.status != TranlsationStatus.COMPLETED]
+    logger.info(f"Translating {len(pending_segments)}/{len(chapter.segments)} segments of chapter {chapter_id}")
+
+    chapter.translation_status = TranlsationStatus.STARTED
+    chapter.update(db=db, fields=["translation_status"])
+
+    asyncio.run(_translate_chapter(chapter, pending_segments))
+
+    if chapter.title is not None and all(segment.status == TranlsationStatus.COMPLETED for segment in chapter.segments):
+        chapter.content = PARAGRAPH_SEPARATOR.join(segment.text for segment in sorted(chapter.segments, key=lambda s: s.segment_idx)) # type: ignore
+        chapter.translation_status = TranlsationStatus.COMPLETED
+    else:
+        chapter.translation_status = TranlsationStatus.FAILED
+    chapter.update(db=db, fields=["content", "translation_status"])
+
+    if chapter.translation_status != TranlsationStatus.COMPLETED:
+        n_completed = sum(segment.status == TranlsationStatus.COMPLETED for segment in chapter.segments)
+        raise Exception(f"Translation failed for chapter {chapter_id}, {n_completed}/{len(chapter.segments)} segments are translated")
+    logger.info(f"Translation completed for chapter {chapter_id}")
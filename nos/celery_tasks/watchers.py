@@ -0,0 +1,162 @@
+import os
+import time
+from threading import Event
+from typing import List, Optional, Set
+
+from bson import ObjectId
+from pymongo.database import Database
+from pymongo.errors import OperationFailure, PyMongoError
+
+from nos.config import logger, db
+from nos.celery_tasks.beat_tasks import beat_update_tags_of_novels
+from nos.celery_tasks.dispatchers import claim_novels_for_metadata_translation, get_novel_metadata_dispatch_size, send_novel_metadata_tasks
+from nos.schemas.change_stream_schema import ChangeStreamState
+from nos.schemas.scraping_schema import NovelData
+
+
+# The changes are dispatched once this many novels are pending, or NOVEL_WATCHER_MAX_WAIT seconds after the first of them
+NOVEL_WATCHER_BATCH_SIZE = int(os.environ.get("NOVEL_WATCHER_BATCH_SIZE", 20))
+NOVEL_WATCHER_MAX_WAIT = float(os.environ.get("NOVEL_WATCHER_MAX_WAIT", 2))
+NOVEL_WATCHER_NAME = "novel_translation_dispatcher"
+# The server no longer has the oplog entry of the resume token
+CHANGE_STREAM_HISTORY_LOST_CODES = (280, 286)
+
+NOVEL_CHANGES_PIPELINE = [
+    {"$match": {"$or": [
+        {"operationType": "insert"},
+        # A novel whose translation was reset, or whose tags changed when it was scraped again
+        {"operationType": "update", "updateDescription.updatedFields.all_data_parsed": False},
+        {"operationType": "update", "updateDescription.updatedFields.tags_raw": {"$exists": True}},
+    ]}},
+    {"$project": {
+        "operationType": 1,
+        "documentKey": 1,
+        "fullDocument.all_data_parsed": 1,
+        "fullDocument.tags_raw": 1,
+        "updateDescription.updatedFields.all_data_parsed": 1,
+        "updateDescription.updatedFields.tags_raw": 1,
+    }},
+]
+
+
+class NovelWatcher:
+    """
+    Dispatches the translation of a novel as soon as it is scraped, instead of waiting for the next beat run.
+    It watches a change stream on the novels collection for new novels, novels whose all_data_parsed was reset
+    and novels whose tags_raw changed. The novels are sized to the same capacity and claimed in bulk with the same
+    claim token as the beat dispatcher, which stays on as a safety net, so a novel is never dispatched by both and
+    the novels there is no capacity for are left to it.
+    The resume token is saved after every dispatch, so a restarted watcher continues where it stopped.
+
+    NOTE: Change streams need mongo to run as a replica set. A single node replica set is enough
+    """
+
+    def __init__(self, db: Database, batch_size: int=NOVEL_WATCHER_BATCH_SIZE, max_wait: float=NOVEL_WATCHER_MAX_WAIT, name: str=NOVEL_WATCHER_NAME):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.name = name
+
+        self.metadata_novel_ids: List[ObjectId] = []
+        self.tags_novel_ids: Set[ObjectId] = set()
+        self.first_pending_time: Optional[float] = None
+        self._stopped = Event()
+
+
+    def handle_change(self, change: dict):
+        novel_id = change["documentKey"]["_id"]
+        if change["operationType"] == "insert":
+            document = change.get("fullDocument", {})
+            if not document.get("all_data_parsed", False):
+                self.metadata_novel_ids.append(novel_id)
+            if document.get("tags_raw"):
+                self.tags_novel_ids.add(novel_id)
+        else:
+            updated_fields = change.get("updateDescription", {}).get("updatedFields", {})
+            if updated_fields.get("all_data_parsed") is False:
+                self.metadata_novel_ids.append(novel_id)
+            if updated_fields.get("tags_raw"):
+                self.tags_novel_ids.add(novel_id)
+
+        if self.first_pending_time is None and (self.metadata_novel_ids or self.tags_novel_ids):
+            self.first_pending_time = time.monotonic()
+
+
+    def should_dispatch(self) -> bool:
+        if self.first_pending_time is None:
+            return False
+        n_pending = len(set(self.metadata_novel_ids) | self.tags_novel_ids)
+        return n_pending >= self.batch_size or time.monotonic() - self.first_pending_time >= self.max_wait
+
+
+    def dispatch(self):
+        if self.metadata_novel_ids:
+            novel_ids = list(dict.fromkeys(self.metadata_novel_ids))
+            # The novels left unclaimed are still untranslated, so the beat dispatcher picks them up once there is capacity
+            dispatch_size = min(len(novel_ids), get_novel_metadata_dispatch_size())
+            novels = claim_novels_for_metadata_translation(dispatch_size, novel_ids=novel_ids) if dispatch_size > 0 else []
+            if novels:
+                send_novel_metadata_tasks(novels)
+            logger.info(f"Dispatched {len(novels)}/{len(novel_ids)} changed novels for translation")
+
+        if self.tags_novel_ids:
+            beat_update_tags_of_novels.delay([str(novel_id) for novel_id in self.tags_novel_ids])
+            logger.info(f"Dispatched the tags of {len(self.tags_novel_ids)} changed novels for translation")
+
+        self.metadata_novel_ids = []
+        self.tags_novel_ids = set()
+        self.first_pending_time = None
+
+
+    def stop(self):
+        """ Stop watching once the change in hand is handled. This can be called from another thread """
+        self._stopped.set()
+
+
+    def watch(self):
+        """ Watch the novels until the stream dies or stop is called. The pending changes are dispatched before the resume token is saved """
+        resume_token = ChangeStreamState.load_resume_token(self.db, self.name)
+        saved_resume_token = resume_token
+        logger.info(f"Watching the novels {'from the saved resume token' if resume_token else 'from now'}")
+
+        with self.db[NovelData._collection_name].watch(
+            NOVEL_CHANGES_PIPELINE,
+            resume_after=resume_token,
+            max_await_time_ms=int(self.max_wait * 1000),
+        ) as stream:
+            while stream.alive and not self._stopped.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    self.handle_change(change)
+                    if not self.should_dispatch():
+                        continue
+                elif self.first_pending_time is not None:
+                    # The stream went idle, so the pending changes are not worth holding back
+                    self.first_pending_time = 0
+
+                if self.should_dispatch():
+                    self.dispatch()
+                # The resume token also moves on while the stream is idle
+                if self.first_pending_time is None and stream.resume_token != saved_resume_token:
+                    ChangeStreamState.save_resume_token(self.db, self.name, stream.resume_token)
+                    saved_resume_token = stream.resume_token
+
+
+    def run(self, retry_interval: float=5):
+        """ Watch till stop is called. On errors the watcher resumes from the saved resume token """
+        while not self._stopped.is_set():
+            try:
+                self.watch()
+            except OperationFailure as e:
+                if e.code not in CHANGE_STREAM_HISTORY_LOST_CODES:
+                    raise
+                # The changes in between are picked up by the beat dispatchers
+                logger.error(f"The resume token of {self.name} is too old, watching from now: {e}")
+                ChangeStreamState.save_resume_token(self.db, self.name, None)
+            except PyMongoError as e:
+                logger.error(f"The change stream of {self.name} failed, resuming in {retry_interval} seconds: {e}")
+                time.sleep(retry_interval)
+
+
+if __name__ == "__main__":
+    NovelWatcher(db).run()
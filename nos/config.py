@@ -1,44 +1,47 @@
+
 # Standard library imports
-import json
 import os
-from dotenv import load_dotenv
 from datetime import timedelta
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Optional
+from pymongo.database import Database
 
 # Project imports
-from nos.schemas.secrets_schema import Provider
 from nos.schemas.config_schemas import DBConfigSchema
 from nos.utils.logging_utils import get_logger
-from nos.utils.db_utils import get_db_client
+from nos.utils.db_utils import get_db_client, LazyDatabase
+
+if TYPE_CHECKING:
+    import logging
+    from celery import Celery
+
+    celery_app: Celery
+    logger: logging.Logger
 
+# Importing this module has no side effects. The db is connected on first use (again in every forked process), and the
+# celery app and the logger are built the first time they are imported from here, see __getattr__
 
-logger = get_logger("main")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
 
-logger.info("Starting the main script")
 
-# Load the db
-logger.info("Loading the db")
-db_config = DBConfigSchema.load()
-db = get_db_client(
-    host=db_config.host,
-    port=db_config.port,
-    username=db_config.username,
-    pwd=db_config.pwd,
-    db_name=db_config.db_name,
-    db_auth_source=db_config.db_auth_source
-)
+def connect_db() -> Database:
+    db_config = DBConfigSchema.load()
+    return get_db_client(
+        host=db_config.host,
+        port=db_config.port,
+        username=db_config.username,
+        pwd=db_config.pwd,
+        db_name=db_config.db_name,
+        db_auth_source=db_config.db_auth_source
+    )
 
-# Celery setup
-from celery import Celery
 
-celery_app = Celery(
-    "celery_app",
-    broker="redis://localhost:6379/0",
-    backend="redis://localhost:6379/0",
-    include=["nos.celery_tasks.beat_tasks", "nos.celery_tasks.dispatchers", "nos.celery_tasks.tasks"]
-)
+db: Database = LazyDatabase(connect_db) # type: ignore
 
 
-celery_app.conf.beat_schedule = {
+CELERY_INCLUDE = ["nos.celery_tasks.beat_tasks", "nos.celery_tasks.dispatchers", "nos.celery_tasks.tasks", "nos.celery_tasks.batch_tasks", "nos.celery_tasks.rollup_tasks"]
+
+BEAT_SCHEDULE = {
     "beat-tags-translation-and-update": {
         'task': "nos.celery_tasks.beat_tasks.beat_update_tags_of_novels",
         'schedule': timedelta(minutes=1),
@@ -53,6 +56,59 @@ celery_app.conf.beat_schedule = {
     },
     "dispatch-novel-metadata-translation": {
         'task': "nos.celery_tasks.dispatchers.dispatch_novel_metadata_translation",
+        'schedule': timedelta(minutes=1),
+    },
+    "dispatch-chapter-translation": {
+        'task': "nos.celery_tasks.dispatchers.dispatch_chapter_translation",
+        'schedule': timedelta(minutes=5),
+    },
+    "submit-batch-translation": {
+        'task': "nos.celery_tasks.batch_tasks.submit_batch_translation",
+        'schedule': timedelta(hours=1),
+    },
+    "poll-batch-translations": {
+        'task': "nos.celery_tasks.batch_tasks.poll_batch_translations",
+        'schedule': timedelta(minutes=10),
+    },
+    "beat-rollup-translator-metadata": {
+        'task': "nos.celery_tasks.rollup_tasks.beat_rollup_translator_metadata",
         'schedule': timedelta(minutes=5),
     }
-}
\ No newline at end of file
+}
+
+
+_celery_app: Optional["Celery"] = None
+_celery_app_lock = Lock()
+
+
+def get_celery_app() -> "Celery":
+    """ The celery app, built on first use. Unlike the db it is kept across forks, the workers need the parent's app """
+    global _celery_app
+    if _celery_app is None:
+        with _celery_app_lock:
+            if _celery_app is None:
+                from celery import Celery
+
+                app = Celery("celery_app", broker=REDIS_URL, backend=REDIS_URL, include=CELERY_INCLUDE)
+                app.conf.beat_schedule = BEAT_SCHEDULE
+                _celery_app = app
+    return _celery_app
+
+
+def get_main_logger() -> "logging.Logger":
+    return get_logger("main")
+
+
+def __getattr__(name: str) -> Any:
+    """
+    Builds celery_app and logger on first access, e.g. from nos.config import celery_app. app is what celery -A nos.config
+    looks for. The result is cached in the module, so this runs once per name
+    """
+    if name in ("celery_app", "app"):
+        value: Any = get_celery_app()
+    elif name == "logger":
+        value = get_main_logger()
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
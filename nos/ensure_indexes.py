@@ -0,0 +1,53 @@
+from typing import List, Type
+
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+from nos.config import logger, db
+from nos.schemas.batch_schema import TranslationBatchJob
+from nos.schemas.chapter_schema import ChapterData
+from nos.schemas.change_stream_schema import ChangeStreamState
+from nos.schemas.mixins import DBFuncMixin
+from nos.schemas.prompt_schemas import PromptSchema
+from nos.schemas.rollup_schema import TranslationRollup, RollupWatermark
+from nos.schemas.scraping_schema import NovelData
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translation_entities_schema import TranslationEntity
+from nos.schemas.translator_schemas import LLMResponseCacheEntry
+
+
+# Every model whose collection declares indexes. NovelData covers the indexes of NovelRawData as well
+INDEXED_MODELS: List[Type[DBFuncMixin]] = [
+    NovelData,
+    ChapterData,
+    PromptSchema,
+    Provider,
+    TranslationEntity,
+    LLMResponseCacheEntry,
+    ChangeStreamState,
+    TranslationBatchJob,
+    TranslationRollup,
+    RollupWatermark,
+]
+
+
+def ensure_indexes(db: Database) -> bool:
+    """
+    Create the declared indexes of every collection. This is idempotent and is run when a worker starts.
+    A collection whose indexes cannot be created (e.g. duplicates for a unique index, or a changed TTL) is
+    logged and skipped so that the others still get their indexes. Returns whether all of them succeeded
+    """
+    all_succeeded = True
+    for model in INDEXED_MODELS:
+        try:
+            names = model.ensure_indexes(db)
+            if names:
+                logger.info(f"Ensured indexes {names} on {model._collection_name}")
+        except OperationFailure as e:
+            all_succeeded = False
+            logger.error(f"Could not create the indexes on {model._collection_name}: {e}")
+    return all_succeeded
+
+
+if __name__ == "__main__":
+    ensure_indexes(db)
@@ -0,0 +1,92 @@
+import argparse
+import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from pymongo.database import Database
+
+from nos.config import db
+from nos.celery_tasks.rollup_tasks import rollup_translator_metadata
+from nos.schemas.enums import RollupGranularity
+from nos.schemas.prompt_schemas import PromptSchema
+from nos.schemas.rollup_schema import TranslationRollup, get_bucket_start
+
+
+# The fields a report can be grouped by
+REPORT_GROUP_FIELDS = ("bucket_start", "provider_name", "model_name", "prompt", "status")
+
+
+def load_rollups(db: Database, granularity: RollupGranularity, since: datetime.datetime, until: Optional[datetime.datetime]=None) -> List[TranslationRollup]:
+    bucket_query: dict = {"$gte": get_bucket_start(since, granularity)}
+    if until is not None:
+        bucket_query["$lt"] = until
+    return TranslationRollup.load(db, query={"granularity": granularity.value, "bucket_start": bucket_query}, many=True, sort={"bucket_start": 1}) or [] # type: ignore
+
+
+def get_prompt_names(db: Database, rollups: List[TranslationRollup]) -> Dict:
+    prompt_ids = list({rollup.prompt_id for rollup in rollups})
+    prompts = db[PromptSchema._collection_name].find({"_id": {"$in": prompt_ids}}, projection={"prompt_name": 1})
+    return {prompt["_id"]: prompt.get("prompt_name", str(prompt["_id"])) for prompt in prompts}
+
+
+def summarize_rollups(rollups: List[TranslationRollup], group_by: Sequence[str], prompt_names: Dict) -> List[Tuple[Tuple, TranslationRollup]]:
+    """ Merge the rollups that have the same values of the group_by fields """
+    groups: Dict[Tuple, TranslationRollup] = {}
+    for rollup in rollups:
+        values = {
+            "bucket_start": rollup.bucket_start,
+            "provider_name": rollup.provider_name,
+            "model_name": rollup.model_name,
+            "prompt": prompt_names.get(rollup.prompt_id, str(rollup.prompt_id)),
+            "status": rollup.status,
+        }
+        key = tuple(values[field] for field in group_by)
+        if key not in groups:
+            groups[key] = rollup.model_copy(update={"latency_counts": {}, "n_calls": 0, "n_cache_hits": 0, "input_tokens": 0, "output_tokens": 0, "latency_sum": 0})
+        groups[key].merge(rollup)
+    return sorted(groups.items(), key=lambda item: tuple(str(value) for value in item[0]))
+
+
+def format_report(summary: List[Tuple[Tuple, TranslationRollup]], group_by: Sequence[str]) -> str:
+    def format_seconds(seconds: Optional[float]) -> str:
+        return "-" if seconds is None else f"{seconds:.2f}"
+
+    header = [*group_by, "calls", "cache_hits", "input_tokens", "output_tokens", "avg_latency", "p50", "p95"]
+    rows = [header]
+    for key, rollup in summary:
+        n_llm_calls = rollup.n_llm_calls
+        rows.append([
+            *(value.strftime("%Y-%m-%d %H:%M") if isinstance(value, datetime.datetime) else str(value) for value in key),
+            str(rollup.n_calls),
+            str(rollup.n_cache_hits),
+            str(rollup.input_tokens),
+            str(rollup.output_tokens),
+            format_seconds(rollup.latency_sum / n_llm_calls if n_llm_calls else None),
+            format_seconds(rollup.get_latency_percentile(50)),
+            format_seconds(rollup.get_latency_percentile(95)),
+        ])
+    widths = [max(len(row[idx]) for row in rows) for idx in range(len(header))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+def main(argv: Optional[Sequence[str]]=None):
+    parser = argparse.ArgumentParser(description="Report the translation throughput, tokens and latency from the hourly and daily rollups")
+    parser.add_argument("--granularity", choices=[granularity.value for granularity in RollupGranularity], default=RollupGranularity.HOUR.value)
+    parser.add_argument("--hours", type=float, default=24, help="How far back the report goes")
+    parser.add_argument("--group-by", default="provider_name,model_name,prompt,status", help=f"A comma separated list of {', '.join(REPORT_GROUP_FIELDS)}")
+    parser.add_argument("--refresh", action="store_true", help="Roll up all the new translator metadata first")
+    args = parser.parse_args(argv)
+
+    group_by = [field.strip() for field in args.group_by.split(",") if field.strip()]
+    unknown_fields = set(group_by) - set(REPORT_GROUP_FIELDS)
+    if unknown_fields:
+        parser.error(f"Cannot group by {', '.join(sorted(unknown_fields))}")
+
+    if args.refresh:
+        rollup_translator_metadata(max_batches=None)
+    granularity = RollupGranularity(args.granularity)
+    rollups = load_rollups(db, granularity, datetime.datetime.now() - datetime.timedelta(hours=args.hours))
+    print(format_report(summarize_rollups(rollups, group_by, get_prompt_names(db, rollups)), group_by))
+
+
+if __name__ == "__main__":
+    main()
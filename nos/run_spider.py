@@ -1,12 +1,39 @@
-from typing import Optional
+from typing import List, Optional
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 from nos.scraping.scrape_novel import Scrape1qxs
+from nos.scraping.scrape_chapters import Scrape1qxsChapters
+from nos.utils.metrics import start_metrics_server
 
 
 
-def run_spider(max_pages: int = 100, max_novels_per_page: int = 20) -> None:
+def run_spider(max_pages: int = 100, max_novels_per_page: int = 20, incremental: bool = False, max_pages_without_new_novels: int = 3) -> None:
     settings = get_project_settings()
+    if incremental:
+        # The pages are cached on disk and revalidated with conditional requests (ETag/Last-Modified). The known novels
+        # are skipped, so this mostly saves on the listing pages, which are fetched again on every run
+        settings.set("HTTPCACHE_ENABLED", True)
+        settings.set("HTTPCACHE_POLICY", "scrapy.extensions.httpcache.RFC2616Policy")
+        settings.set("HTTPCACHE_DIR", "httpcache")
     process = CrawlerProcess(settings)
-    process.crawl(Scrape1qxs, max_pages=max_pages, max_novels_per_page=max_novels_per_page)
+    process.crawl(
+        Scrape1qxs,
+        max_pages=max_pages,
+        max_novels_per_page=max_novels_per_page,
+        incremental=incremental,
+        max_pages_without_new_novels=max_pages_without_new_novels,
+    )
+    start_metrics_server()
+    process.start()
+
+
+def run_chapter_spider(novel_ids: Optional[List[str]] = None, max_novels: int = 10, max_chapters_per_novel: Optional[int] = None) -> None:
+    process = CrawlerProcess(get_project_settings())
+    process.crawl(
+        Scrape1qxsChapters,
+        novel_ids=",".join(novel_ids) if novel_ids else None,
+        max_novels=max_novels,
+        max_chapters_per_novel=max_chapters_per_novel,
+    )
+    start_metrics_server()
     process.start()
@@ -0,0 +1,64 @@
+from typing import List, Optional, ClassVar, Set
+from pydantic import BaseModel, ConfigDict, Field
+from pymongo import IndexModel, ASCENDING
+from pymongo.database import Database
+from bson import ObjectId
+from datetime import datetime
+
+from nos.schemas.enums import BatchJobStatus
+from nos.schemas.mixins import DBFuncMixin
+
+
+class BatchRequest(BaseModel):
+    """ A single chat completion of a batch job, and the work it translates """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    custom_id: str = Field(description="The id of the request within the batch. The results are matched back to the requests by it")
+    prompt_name: str
+    prompt_id: ObjectId
+    novel_id: Optional[ObjectId] = Field(default=None, description="The novel whose metadata the request translates")
+    tags: Optional[List[str]] = Field(default=None, description="The tags the request translates")
+
+
+class TranslationBatchJob(DBFuncMixin):
+    """
+    A batch of translations submitted to the batch endpoint of a provider. The batch runs offline on the separate
+    capacity of the provider and is polled until it is done, then its results are saved like those of the live tasks
+    """
+
+    _collection_name: ClassVar[str] = "translation_batch_jobs"
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)]),
+    ]
+
+    provider_id: ObjectId
+    provider_name: str
+    model_name: str
+
+    batch_id: str = Field(description="The id of the batch at the provider")
+    input_file_id: str = Field(description="The id of the uploaded jsonl file of the requests")
+    output_file_id: Optional[str] = Field(default=None, description="The id of the jsonl file of the successful results")
+    error_file_id: Optional[str] = Field(default=None, description="The id of the jsonl file of the failed requests")
+
+    status: BatchJobStatus = Field(default=BatchJobStatus.SUBMITTED)
+    provider_status: Optional[str] = Field(default=None, description="The status of the batch as the provider last reported it")
+    requests: List[BatchRequest] = Field(default_factory=list)
+    n_succeeded: int = 0
+    n_failed: int = 0
+
+    created_at: datetime = Field(default_factory=datetime.now)
+    completed_at: Optional[datetime] = None
+
+    @classmethod
+    def load_in_flight(cls, db: Database) -> List["TranslationBatchJob"]:
+        return cls.load(db, query={"status": BatchJobStatus.SUBMITTED.value}, many=True, sort={"created_at": 1}) or [] # type: ignore
+
+    @classmethod
+    def get_in_flight_tags(cls, db: Database) -> Set[str]:
+        """ The tags a submitted batch is translating, so the live tag translation leaves them alone """
+        tags: Set[str] = set()
+        for job in cls.iter_load(db, query={"status": BatchJobStatus.SUBMITTED.value}, projection={"requests.tags": 1}, raw=True):
+            for request in job.get("requests", []):
+                tags.update(request.get("tags") or [])
+        return tags
@@ -0,0 +1,34 @@
+from datetime import datetime
+from typing import ClassVar, Dict, List, Optional
+
+from pydantic import Field
+from pymongo import IndexModel, ASCENDING
+from pymongo.database import Database
+
+from nos.schemas.mixins import DBFuncMixin
+
+
+class ChangeStreamState(DBFuncMixin):
+    """ The resume token of a change stream watcher, so that a restarted watcher picks up the changes it missed """
+
+    _collection_name: ClassVar[str] = "change_stream_state"
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("name", ASCENDING)], unique=True),
+    ]
+
+    name: str = Field(description="The name of the watcher")
+    resume_token: Optional[Dict] = Field(default=None, description="The resume token of the last change the watcher handled")
+    updated_at: datetime = Field(default_factory=datetime.now, description="When the resume token was last saved")
+
+    @classmethod
+    def load_resume_token(cls, db: Database, name: str) -> Optional[Dict]:
+        data = db[cls._collection_name].find_one({"name": name}, projection={"resume_token": 1})
+        return data.get("resume_token") if data else None
+
+    @classmethod
+    def save_resume_token(cls, db: Database, name: str, resume_token: Optional[Dict]):
+        db[cls._collection_name].update_one(
+            {"name": name},
+            {"$set": {"resume_token": resume_token, "updated_at": datetime.now()}},
+            upsert=True
+        )
@@ -0,0 +1,73 @@
+from typing import Dict, List, Optional, ClassVar
+from pydantic import BaseModel, ConfigDict, Field
+from pymongo import IndexModel, ASCENDING
+from pymongo.database import Database
+from bson import ObjectId
+from datetime import datetime
+
+from nos.schemas.enums import TranlsationStatus
+from nos.schemas.mixins import DBFuncMixin
+
+
+class ChapterSegment(BaseModel):
+    """ A token budgeted piece of a chapter. The segments of a chapter are translated independently and joined in order """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    segment_idx: int = Field(description="The position of the segment within the chapter")
+    text_raw: str = Field(description="The raw chinese text of the segment")
+    text: Optional[str] = Field(default=None, description="The translated text of the segment")
+    status: TranlsationStatus = Field(default=TranlsationStatus.PENDING, description="The translation status of this segment")
+    translator_metadata_id: Optional[ObjectId] = Field(default=None, description="The id of the translator_metadata of the last translation of this segment")
+
+
+class ChapterData(DBFuncMixin):
+    """
+    A single chapter of a novel. The chapter is split into segments before it is translated, and the status of
+    every segment is saved as soon as it is translated, so an interrupted chapter resumes from its pending segments
+    """
+
+    _collection_name: ClassVar[str] = "chapters"
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("fingerprint", ASCENDING)], unique=True),
+        IndexModel([("novel_id", ASCENDING), ("chapter_idx", ASCENDING)]),
+        IndexModel([("translation_status", ASCENDING), ("dispatched_at", ASCENDING)]),
+    ]
+
+    # Info about the chapter
+    novel_id: ObjectId = Field(description="The id of the novel this chapter belongs to")
+    source_name: str
+    chapter_source_id: str
+    chapter_url: str
+    chapter_idx: int = Field(description="The position of the chapter in the chapter list of the novel")
+
+    # Raw data
+    title_raw: str
+    content_raw: str = Field(description="The raw chinese text of the chapter. The paragraphs are separated by blank lines")
+    fingerprint: str
+
+    # Translated data. None basically means that it has not been translated into english
+    title: Optional[str] = Field(default=None, description="This is the translated title of the chapter")
+    content: Optional[str] = Field(default=None, description="The translated segments joined in order. Only set once every segment is translated")
+    segments: List[ChapterSegment] = Field(default=[], description="The segments of content_raw. Empty until the chapter is first picked up for translation")
+    translation_status: TranlsationStatus = Field(default=TranlsationStatus.PENDING, description="The translation status of the whole chapter")
+
+    # Some tags for dispatchers
+    dispatched_at: Optional[datetime] = Field(default=None, description='When a dispatcher picks up this chapter and dispatches it for translation')
+
+    # The fields that come from the scraper. Only these are refreshed when an existing chapter is scraped again
+    _raw_fields: ClassVar[List[str]] = [
+        "novel_id", "source_name", "chapter_source_id", "chapter_url", "chapter_idx", "title_raw", "content_raw",
+    ]
+    # The fields that are reset when a raw field changed, so that the chapter is translated again
+    _reset_on_change: ClassVar[Dict[str, dict]] = {
+        "title_raw": {"title": None, "translation_status": TranlsationStatus.PENDING.value, "dispatched_at": None},
+        "content_raw": {"content": None, "segments": [], "translation_status": TranlsationStatus.PENDING.value, "dispatched_at": None},
+    }
+
+    def save_segment(self, db: Database, segment: ChapterSegment):
+        """ Save a single segment in place, without touching the other segments which may be translated concurrently """
+        db[self._collection_name].update_one(
+            {"_id": self.id},
+            {"$set": {f"segments.{segment.segment_idx}": segment.model_dump()}}
+        )
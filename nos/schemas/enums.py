@@ -1,10 +1,32 @@
 from enum import Enum
 
 class TranlsationStatus(str, Enum):
+    PENDING = "pending"
     STARTED = "started"
     COMPLETED = "completed"
     FAILED = "failed"
     
 
 class TranslationEntityType(str, Enum):
-    TAGS = "tags"
\ No newline at end of file
+    TAGS = "tags"
+
+
+class CacheTier(str, Enum):
+    MEMORY = "memory"
+    DB = "db"
+
+
+class UpsertStatus(str, Enum):
+    INSERTED = "inserted"
+    UPDATED = "updated"
+    UNCHANGED = "unchanged"
+
+class BatchJobStatus(str, Enum):
+    SUBMITTED = "submitted"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class RollupGranularity(str, Enum):
+    HOUR = "hour"
+    DAY = "day"
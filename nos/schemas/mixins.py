@@ -1,10 +1,21 @@
 from bson import ObjectId
 from pydantic import Field, BaseModel, ConfigDict
+from pymongo import InsertOne, UpdateOne, IndexModel
+from pymongo.collection import Collection
 from pymongo.database import Database
-from typing import Optional, Union, List, Any, TypeVar, Type, ClassVar
+from pymongo.errors import BulkWriteError
+from typing import Optional, Union, List, Dict, Any, Tuple, TypeVar, Type, ClassVar, Iterator
+
+from nos.schemas.enums import UpsertStatus
 
 T = TypeVar("T", bound="DBFuncMixin")
 
+DEFAULT_BULK_BATCH_SIZE = 1000
+DEFAULT_ITER_BATCH_SIZE = 500
+DUPLICATE_KEY_ERROR_CODE = 11000
+# The field claim_many marks the documents it claimed with, to load them back
+CLAIM_TOKEN_FIELD = "claim_token"
+
 
 class DBFuncMixin(BaseModel):
 
@@ -13,11 +24,13 @@ class DBFuncMixin(BaseModel):
 
     id: Optional[ObjectId] = Field(default=None, description="The id of the object", alias="_id", exclude=True)
     _collection_name: ClassVar[str]
+    _indexes: ClassVar[List[IndexModel]] = []
 
-    def update(self, db: Database):
+    def update(self, db: Database, fields: Optional[List[str]]=None):
+        """ If fields is given, only those fields are $set on an existing document """
         # If _id is None, insert it else update it
         collection = db[self._collection_name]
-        data_to_dump = self.model_dump()  
+        data_to_dump = self.model_dump() if fields is None or self.id is None else self.model_dump(include=set(fields))
 
         if self.id is None:
             self.id = collection.insert_one(data_to_dump).inserted_id # type: ignore
@@ -27,22 +40,241 @@ class DBFuncMixin(BaseModel):
                 {"$set": data_to_dump} # type: ignore
         )
             
+    @classmethod
+    def ensure_indexes(cls, db: Database) -> List[str]:
+        """ Create the declared indexes of the collection. This is idempotent, existing indexes are left as is """
+        if not cls._indexes:
+            return []
+        return db[cls._collection_name].create_indexes(cls._indexes)
+
     def delete(self, db: Database):
         collection = db[self._collection_name]
         collection.delete_one({"_id": self.id})
             
     @classmethod
-    def load(cls: Type[T], db: Database, query: dict, many: bool=False, sort: Optional[dict]=None, limit: Optional[int]=None) -> Optional[Union[T, List[T]]]:
+    def load(cls: Type[T], db: Database, query: dict, many: bool=False, sort: Optional[dict]=None, limit: Optional[int]=None, projection: Optional[Union[List[str], dict]]=None) -> Optional[Union[T, List[T]]]:
+        """ With a projection the documents are partial, so they are loaded without validation """
         if many:
-            data = db[cls._collection_name].find(query)
+            data = db[cls._collection_name].find(query, projection=projection)
             if sort:
                 data = data.sort(sort)
             if limit:
                 data = data.limit(limit)
         else:
-            data = db[cls._collection_name].find_one(query)
+            data = db[cls._collection_name].find_one(query, projection=projection)
         if not data:
             return None
         
-        return cls(**data) if not many else [cls(**item) for item in data] # type: ignore
-    
\ No newline at end of file
+        if not many:
+            return cls._from_document(data, partial=projection is not None) # type: ignore
+        return [cls._from_document(item, partial=projection is not None) for item in data] # type: ignore
+
+
+    @classmethod
+    def iter_load(cls: Type[T], db: Database, query: dict, projection: Optional[Union[List[str], dict]]=None, raw: bool=False, batch_size: int=DEFAULT_ITER_BATCH_SIZE, sort: Optional[dict]=None, limit: Optional[int]=None) -> Iterator[Union[T, dict]]:
+        """
+        A generator over the documents matching the query, fetched from the server batch_size documents at a time,
+        so memory stays flat however many documents match.
+        - With a projection, only those fields are transferred and the objects are partial models built without validation
+        - With raw, the documents are yielded as they come from the db
+        """
+        cursor = db[cls._collection_name].find(query, projection=projection, batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        for item in cursor:
+            yield item if raw else cls._from_document(item, partial=projection is not None)
+
+
+    @classmethod
+    def claim_many(cls: Type[T], db: Database, query: dict, update: dict, limit: int, projection: Optional[Union[List[str], dict]]=None, sort: Optional[list]=None) -> List[T]:
+        """
+        Atomically claim up to limit documents matching the query in three round trips, however many there are:
+        1. Find the ids of up to limit matching documents
+        2. Apply the update with update_many, along with a claim token unique to this call, to those of them that still
+           match the query
+        3. Load the documents that carry the claim token
+        The update must make the document stop matching the query (e.g. by setting a dispatched_at), so that concurrent
+        callers never claim the same document. A document another caller claimed in between is skipped, so fewer than
+        limit documents may be claimed while more match. Returns the claimed documents after the update
+        """
+        collection = db[cls._collection_name]
+        cursor = collection.find(query, projection={"_id": 1})
+        if sort:
+            cursor = cursor.sort(sort)
+        ids = [data["_id"] for data in cursor.limit(limit)]
+        if not ids:
+            return []
+
+        claim_token = ObjectId()
+        collection.update_many(
+            {**query, "_id": {"$in": ids}},
+            {**update, "$set": {**update.get("$set", {}), CLAIM_TOKEN_FIELD: claim_token}},
+        )
+        # The ids keep the lookup on the _id index
+        claimed = {data["_id"]: data for data in collection.find({"_id": {"$in": ids}, CLAIM_TOKEN_FIELD: claim_token}, projection=projection)}
+        return [cls._from_document(claimed[_id], partial=projection is not None) for _id in ids if _id in claimed]
+
+
+    @classmethod
+    def _from_document(cls: Type[T], data: dict, partial: bool=False) -> T:
+        if partial:
+            return cls.model_construct(**data)
+        return cls(**data)
+
+
+    @classmethod
+    def bulk_update(cls: Type[T], db: Database, objs: List[T], fields: Optional[List[str]]=None, batch_size: int=DEFAULT_BULK_BATCH_SIZE) -> List[ObjectId]:
+        """
+        The bulk version of update. Objects without an id are inserted and the rest are $set (only the fields, if given),
+        in unordered bulk writes of at most batch_size operations. Returns the ids of the objects in the same order
+        """
+        collection = db[cls._collection_name]
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            operations = []
+            for obj in batch:
+                if obj.id is None:
+                    # The id is generated here, so that it can be set on the object without a round trip
+                    obj.id = ObjectId()
+                    operations.append(InsertOne({"_id": obj.id, **obj.model_dump()}))
+                else:
+                    data_to_dump = obj.model_dump() if fields is None else obj.model_dump(include=set(fields))
+                    operations.append(UpdateOne({"_id": obj.id}, {"$set": data_to_dump}))
+            try:
+                collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                # Forget the ids of the documents that failed to insert
+                for error in e.details.get("writeErrors", []):
+                    if isinstance(operations[error["index"]], InsertOne):
+                        batch[error["index"]].id = None
+                raise
+        return [obj.id for obj in objs] # type: ignore
+
+
+    @classmethod
+    def bulk_upsert(cls: Type[T], db: Database, objs: List[T], key_fields: List[str], update_fields: Optional[List[str]]=None, batch_size: int=DEFAULT_BULK_BATCH_SIZE) -> List[Optional[ObjectId]]:
+        """
+        Upsert the objects matching on the key_fields, in unordered bulk writes of at most batch_size operations.
+        - update_fields are $set on existing documents. If None, every field is $set
+        - The remaining fields are only written when the document is inserted ($setOnInsert)
+        The ids of newly inserted documents are set on the objects, also when the batch partly fails with a BulkWriteError.
+        Returns the ids of the objects in the same order, which is None for an existing document whose id was not known beforehand
+        """
+        collection = db[cls._collection_name]
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            operations = []
+            for obj in batch:
+                data = obj.model_dump()
+                query = {k: data.pop(k) for k in key_fields}
+                set_fields = data if update_fields is None else {k: v for k, v in data.items() if k in update_fields}
+                set_on_insert_fields = {k: v for k, v in data.items() if k not in set_fields}
+                update = {}
+                if set_fields:
+                    update["$set"] = set_fields
+                if set_on_insert_fields:
+                    update["$setOnInsert"] = set_on_insert_fields
+                operations.append(UpdateOne(query, update, upsert=True))
+
+            try:
+                result = collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                # The rest of the batch is still written, so the ids of the documents that were inserted are set before raising
+                for upserted in e.details.get("upserted", []):
+                    batch[upserted["index"]].id = upserted["_id"]
+                raise
+            for idx, upserted_id in result.upserted_ids.items():
+                batch[idx].id = upserted_id
+        return [obj.id for obj in objs]
+
+
+    @classmethod
+    def bulk_upsert_changes(cls: Type[T], db: Database, objs: List[T], key_fields: List[str], update_fields: List[str], reset_on_change: Optional[Dict[str, dict]]=None, batch_size: int=DEFAULT_BULK_BATCH_SIZE) -> List[Optional[UpsertStatus]]:
+        """
+        Like bulk_upsert, but the existing documents are read first, so that every object gets its UpsertStatus and
+        the documents whose update_fields did not change are not written at all.
+        - reset_on_change maps an update field to the fields that are $set along with it when its value changed, e.g.
+          to queue the document for translation again
+        - An object whose document was inserted by another writer in between is read and written again once.
+          The status of an object that still failed to write is None
+        The ids of the objects are set, except for the ones that failed. Returns the statuses in the same order
+        """
+        collection = db[cls._collection_name]
+        statuses: List[Optional[UpsertStatus]] = [None] * len(objs)
+        for start in range(0, len(objs), batch_size):
+            idxs = list(range(start, min(len(objs), start + batch_size)))
+            for _ in range(2):
+                batch_statuses, retry_idxs = cls._write_changes(collection, [objs[idx] for idx in idxs], key_fields, update_fields, reset_on_change or {})
+                for idx, status in zip(idxs, batch_statuses):
+                    statuses[idx] = status
+                idxs = [idxs[retry_idx] for retry_idx in retry_idxs]
+                if not idxs:
+                    break
+        return statuses
+
+
+    @classmethod
+    def _write_changes(cls: Type[T], collection: Collection, batch: List[T], key_fields: List[str], update_fields: List[str], reset_on_change: Dict[str, dict]) -> Tuple[List[Optional[UpsertStatus]], List[int]]:
+        """ A single batch of bulk_upsert_changes. Returns the statuses, and the positions that are worth writing again """
+        data = [obj.model_dump() for obj in batch]
+        keys = [tuple(item[k] for k in key_fields) for item in data]
+        if len(key_fields) == 1:
+            key_query: dict = {key_fields[0]: {"$in": [key[0] for key in keys]}}
+        else:
+            key_query = {"$or": [dict(zip(key_fields, key)) for key in keys]}
+        existing = {
+            tuple(doc.get(k) for k in key_fields): doc
+            for doc in collection.find(key_query, projection=dict.fromkeys([*key_fields, *update_fields], 1))
+        }
+
+        statuses: List[Optional[UpsertStatus]] = [None] * len(batch)
+        operations = []
+        # The position in the batch of every operation
+        operation_idxs: List[int] = []
+        for idx, (obj, item, key) in enumerate(zip(batch, data, keys)):
+            doc = existing.get(key)
+            if doc is None:
+                set_fields = {k: item[k] for k in update_fields}
+                set_on_insert_fields = {k: v for k, v in item.items() if k not in set_fields and k not in key_fields}
+                operations.append(UpdateOne(dict(zip(key_fields, key)), {"$set": set_fields, "$setOnInsert": set_on_insert_fields}, upsert=True))
+                operation_idxs.append(idx)
+                continue
+
+            obj.id = doc["_id"]
+            changed_fields = {k: item[k] for k in update_fields if doc.get(k) != item[k]}
+            if not changed_fields:
+                statuses[idx] = UpsertStatus.UNCHANGED
+                continue
+            reset_fields = {}
+            for k in changed_fields:
+                reset_fields.update(reset_on_change.get(k, {}))
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {**reset_fields, **changed_fields}}))
+            operation_idxs.append(idx)
+            statuses[idx] = UpsertStatus.UPDATED
+
+        if not operations:
+            return statuses, []
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+            upserted_ids, write_errors = result.upserted_ids, []
+        except BulkWriteError as e:
+            upserted_ids = {upserted["index"]: upserted["_id"] for upserted in e.details.get("upserted", [])}
+            write_errors = e.details.get("writeErrors", [])
+
+        error_codes = {operation_idxs[error["index"]]: error.get("code") for error in write_errors}
+        retry_idxs = []
+        for operation_idx, idx in enumerate(operation_idxs):
+            if operation_idx in upserted_ids:
+                batch[idx].id = upserted_ids[operation_idx]
+                statuses[idx] = UpsertStatus.INSERTED
+            elif idx in error_codes:
+                statuses[idx] = None
+                # Another writer inserted the same key first, the next attempt finds its document
+                if error_codes[idx] == DUPLICATE_KEY_ERROR_CODE:
+                    retry_idxs.append(idx)
+            elif statuses[idx] is None:
+                # The upsert matched a document that another writer inserted after it was read
+                retry_idxs.append(idx)
+        return statuses, retry_idxs
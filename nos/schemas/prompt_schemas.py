@@ -1,15 +1,18 @@
 import yaml
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from pathlib import Path
-from typing import Optional, TypeVar, Type, Union, List, Dict, Any, ClassVar
+from typing import Optional, TypeVar, Type, Union, List, Dict, Any, ClassVar, Literal
+from pymongo import ReturnDocument, IndexModel, ASCENDING, DESCENDING
 from pymongo.database import Database
 
-from nos.config import logger
+from nos.utils.logging_utils import get_logger
 from nos.utils.file_utils import get_file_hash
 
 
 from nos.schemas.mixins import DBFuncMixin
 
+logger = get_logger("main")
+
 T = TypeVar("T", bound="PromptSchema")
 
 
@@ -17,6 +20,16 @@ class ModelParameters(BaseModel):
     temperature: float
     max_tokens: int
     response_format: Optional[Dict[str, str]] = None
+    stream: bool = Field(default=False, description="Stream the completion. A JSON response is then parsed as it comes in and aborted as soon as it is invalid")
+
+
+class RoutingConstraints(BaseModel):
+    """ Limits on where the router may send the requests of a prompt. The model and provider names may be fnmatch patterns """
+    models: Optional[List[str]] = None
+    providers: Optional[List[str]] = None
+    max_latency: Optional[float] = Field(default=None, description="Endpoints slower than this many seconds are only used when nothing faster is left")
+    prefer: Literal["latency", "throughput"] = Field(default="latency", description="Rank the endpoints by their latency, or by their output tokens per second for long outputs")
+    hedge_percentile: Optional[float] = Field(default=None, ge=0, le=100, description="If set, a request still running after this latency percentile of its endpoint is duplicated to the next best route and the first answer wins. Only the AsyncTranslator hedges")
 
 
 class PromptContent(BaseModel):
@@ -27,6 +40,10 @@ class PromptSchema(DBFuncMixin):
 
 
     _collection_name: ClassVar[str] = "prompts"
+    _registry_collection_name: ClassVar[str] = "prompt_registry"
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("prompt_name", ASCENDING), ("_id", DESCENDING)]),
+    ]
 
     prompt_name: str
     prompt_version: str
@@ -35,6 +52,7 @@ class PromptSchema(DBFuncMixin):
     description: str
     model_parameters: ModelParameters
     prompt_content: PromptContent
+    routing: RoutingConstraints = RoutingConstraints()
     
     fingerprint: str
 
@@ -67,4 +85,21 @@ class PromptSchema(DBFuncMixin):
 
         prompt_record = cls(**prompt)
         return prompt_record
-        
\ No newline at end of file
+
+
+    @classmethod
+    def get_registry_version(cls, db: Database) -> int:
+        """ The registry version is bumped every time a prompt with a new fingerprint is saved to the db """
+        state = db[cls._registry_collection_name].find_one({"_id": cls._collection_name})
+        return state["version"] if state else 0
+
+
+    @classmethod
+    def bump_registry_version(cls, db: Database) -> int:
+        state = db[cls._registry_collection_name].find_one_and_update(
+            {"_id": cls._collection_name},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return state["version"]
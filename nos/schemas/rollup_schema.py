@@ -0,0 +1,130 @@
+import math
+from bson import ObjectId
+from datetime import datetime
+from typing import ClassVar, Dict, List, Optional
+
+from pydantic import Field
+from pymongo import IndexModel, ASCENDING
+from pymongo.database import Database
+
+from nos.schemas.enums import RollupGranularity
+from nos.schemas.mixins import DBFuncMixin
+
+
+# The latency sketch counts the calls in buckets whose bounds grow by LATENCY_BUCKET_GROWTH, starting at
+# LATENCY_BUCKET_MIN seconds. A percentile estimated from it is within about 12% of the true value
+LATENCY_BUCKET_MIN = 0.05
+LATENCY_BUCKET_GROWTH = 1.25
+LATENCY_BUCKET_COUNT = 48
+
+# The fields a rollup is keyed on, besides the granularity and the bucket_start
+ROLLUP_KEY_FIELDS = ("provider_name", "model_name", "prompt_id", "status")
+
+
+def get_latency_bucket(seconds: float) -> int:
+    """ The index of the bucket of the latency sketch that seconds falls in """
+    if seconds <= LATENCY_BUCKET_MIN:
+        return 0
+    return min(LATENCY_BUCKET_COUNT - 1, math.ceil(math.log(seconds / LATENCY_BUCKET_MIN, LATENCY_BUCKET_GROWTH)))
+
+
+def get_latency_bucket_bound(idx: int) -> float:
+    """ The upper bound (in seconds) of a bucket of the latency sketch """
+    return LATENCY_BUCKET_MIN * LATENCY_BUCKET_GROWTH ** idx
+
+
+def get_latency_bucket_midpoint(idx: int) -> float:
+    """ The geometric middle of a bucket of the latency sketch """
+    return LATENCY_BUCKET_MIN if idx == 0 else get_latency_bucket_bound(idx) / math.sqrt(LATENCY_BUCKET_GROWTH)
+
+
+def estimate_latency_percentile(latency_counts: Dict[str, int], percentile: float) -> Optional[float]:
+    """ The percentile (0-100) of a latency sketch, as the middle of the bucket it falls in. None if it is empty """
+    total = sum(latency_counts.values())
+    if total == 0:
+        return None
+    rank = percentile / 100 * total
+    cumulative = 0
+    for idx in sorted(int(key) for key in latency_counts):
+        cumulative += latency_counts[str(idx)]
+        if cumulative >= rank:
+            return get_latency_bucket_midpoint(idx)
+    return get_latency_bucket_midpoint(max(int(key) for key in latency_counts))
+
+
+def get_bucket_start(timestamp: datetime, granularity: RollupGranularity) -> datetime:
+    if granularity == RollupGranularity.DAY:
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+class TranslationRollup(DBFuncMixin):
+    """
+    The translator metadata of an hour or a day, summed per provider/model/prompt/status. The rollups are updated
+    with $inc as new translator metadata comes in, so reporting over them does not scan the translator metadata.
+    A rollup remembers the last translator metadata it was updated with, so a batch that is rolled up again after
+    a crash is not counted twice
+    """
+
+    _collection_name: ClassVar[str] = "translation_rollups"
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("granularity", ASCENDING), ("bucket_start", ASCENDING), *[(field, ASCENDING) for field in ROLLUP_KEY_FIELDS]], unique=True),
+    ]
+
+    granularity: RollupGranularity
+    bucket_start: datetime = Field(description="The start of the hour or day")
+    provider_name: str
+    model_name: str
+    prompt_id: ObjectId
+    status: str
+
+    n_calls: int = 0
+    n_cache_hits: int = Field(default=0, description="The calls served from the llm response cache. They have no tokens or latency")
+    input_tokens: int = 0
+    output_tokens: int = 0
+    latency_sum: float = Field(default=0, description="The total seconds of the llm calls that were not cache hits")
+    latency_counts: Dict[str, int] = Field(default_factory=dict, description="The latency sketch. The number of llm calls per bucket index, see get_latency_bucket")
+    applied_up_to: Optional[ObjectId] = Field(default=None, description="The id of the last translator metadata of the batch that last updated the rollup")
+
+    @property
+    def n_llm_calls(self) -> int:
+        return self.n_calls - self.n_cache_hits
+
+    def get_latency_percentile(self, percentile: float) -> Optional[float]:
+        return estimate_latency_percentile(self.latency_counts, percentile)
+
+    def merge(self, other: "TranslationRollup"):
+        """ Add the counts of another rollup to this one, e.g. to sum the rollups of a week """
+        self.n_calls += other.n_calls
+        self.n_cache_hits += other.n_cache_hits
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.latency_sum += other.latency_sum
+        for key, count in other.latency_counts.items():
+            self.latency_counts[key] = self.latency_counts.get(key, 0) + count
+
+
+class RollupWatermark(DBFuncMixin):
+    """ The id of the last translator metadata that was rolled up """
+
+    _collection_name: ClassVar[str] = "rollup_watermarks"
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("name", ASCENDING)], unique=True),
+    ]
+
+    name: str
+    last_id: Optional[ObjectId] = None
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+    @classmethod
+    def load_last_id(cls, db: Database, name: str) -> Optional[ObjectId]:
+        data = db[cls._collection_name].find_one({"name": name}, projection={"last_id": 1})
+        return data.get("last_id") if data else None
+
+    @classmethod
+    def save_last_id(cls, db: Database, name: str, last_id: ObjectId):
+        db[cls._collection_name].update_one(
+            {"name": name},
+            {"$set": {"last_id": last_id, "updated_at": datetime.now()}},
+            upsert=True
+        )
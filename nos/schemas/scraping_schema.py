@@ -1,11 +1,17 @@
-from typing import List, Optional, ClassVar
+from typing import Dict, List, Optional, ClassVar
 from pydantic import BaseModel, Field
+from pymongo import IndexModel, ASCENDING, ReturnDocument
 from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
 from datetime import datetime
 
+from nos.schemas.enums import UpsertStatus
 from nos.schemas.mixins import DBFuncMixin
-from nos.config import logger
+from nos.utils.logging_utils import get_logger
+
+
+logger = get_logger("main")
 
 
 class NovelRawData(DBFuncMixin):
@@ -15,6 +21,10 @@ class NovelRawData(DBFuncMixin):
 
     # DB related fields
     _collection_name: ClassVar[str] = "novels" 
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("fingerprint", ASCENDING)], unique=True),
+        IndexModel([("source_name", ASCENDING), ("novel_source_id", ASCENDING)]),
+    ]
 
     # Info about the novel
     source_name: str  # Basically whether its 1qxs, 69shu or any other source
@@ -34,24 +44,85 @@ class NovelRawData(DBFuncMixin):
     all_data_parsed: bool = Field(default=False, description="This will be set to True after the raw data is fully translated")
     fingerprint: str
 
+    # The fields that come from the scraper. Only these are refreshed when an existing novel is scraped again
+    _raw_fields: ClassVar[List[str]] = [
+        "source_name", "novel_source_id", "novel_url", "chapter_list_url", "image_url",
+        "title_raw", "author_raw", "description_raw", "classification_raw", "tags_raw",
+    ]
+    # The fields that are reset when a raw field changed, so that the novel is queued for translation again.
+    # dispatched_at and tags are fields of NovelData, which lives in the same collection
+    _reset_on_change: ClassVar[Dict[str, dict]] = {
+        "title_raw": {"all_data_parsed": False, "dispatched_at": None},
+        "author_raw": {"all_data_parsed": False, "dispatched_at": None},
+        "description_raw": {"all_data_parsed": False, "dispatched_at": None},
+        "tags_raw": {"tags": []},
+    }
+
     def update(self, db: Database):
-        # If _id is None, insert it else update it
+        # If _id is None, upsert it on the fingerprint else update it
         collection = db[self._collection_name]
         if self.id is None:
-            # Check if the fingerprint already exists
-            data = collection.find_one({"fingerprint": self.fingerprint})
-            if data is not None:
-                logger.debug(f"The fingerprint {self.fingerprint} already exists at {data['_id']}")
-                self.id = data["_id"]
-            else:
-                logger.debug(f"The fingerprint {self.fingerprint} does not exist, inserting it")
-                self.id = collection.insert_one(self.model_dump(exclude={"id"})).inserted_id # type: ignore
+            self.upsert(db)
         else:
             collection.update_one(
                 {"_id": self.id},
                 {"$set": self.model_dump(exclude={"id"})} # type: ignore
         )
-    
+
+    def upsert(self, db: Database, retry: bool=True) -> UpsertStatus:
+        """
+        Atomically insert the novel, or refresh the raw fields of the novel with the same fingerprint, in a single
+        find_one_and_update. The object is updated in place with the stored document (its id and, for an existing
+        novel, the fields that were not refreshed) and the returned status tells whether the novel was new or changed.
+        A changed novel also gets the _reset_on_change fields of its changed raw fields, so it is translated again
+        """
+        collection = db[self._collection_name]
+        data = self.model_dump(exclude={"id", "fingerprint"})
+        raw_data = {k: data[k] for k in self._raw_fields}
+        new_id = ObjectId()
+        try:
+            before = collection.find_one_and_update(
+                {"fingerprint": self.fingerprint},
+                {
+                    "$set": raw_data,
+                    # The id is generated here, so that it is known even though the document before the update is returned
+                    "$setOnInsert": {"_id": new_id, **{k: v for k, v in data.items() if k not in raw_data}},
+                },
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+            )
+        except DuplicateKeyError:
+            # A concurrent upsert inserted the same fingerprint first, so the next attempt updates its novel
+            if not retry:
+                raise
+            return self.upsert(db, retry=False)
+
+        if before is None:
+            logger.debug(f"The fingerprint {self.fingerprint} does not exist, inserted it at {new_id}")
+            self.id = new_id
+            return UpsertStatus.INSERTED
+
+        self.id = before["_id"]
+        for k, v in before.items():
+            if k not in raw_data and k in type(self).model_fields:
+                setattr(self, k, v)
+        changed_fields = [k for k, v in raw_data.items() if before.get(k) != v]
+        if not changed_fields:
+            logger.debug(f"The fingerprint {self.fingerprint} already exists at {self.id}, nothing changed")
+            return UpsertStatus.UNCHANGED
+
+        reset_fields = {}
+        for k in changed_fields:
+            reset_fields.update(self._reset_on_change.get(k, {}))
+        if reset_fields:
+            collection.update_one({"_id": self.id}, {"$set": reset_fields})
+            for k, v in reset_fields.items():
+                if k in type(self).model_fields:
+                    setattr(self, k, v)
+        logger.debug(f"The fingerprint {self.fingerprint} already exists at {self.id}, refreshed its raw data {changed_fields}")
+        return UpsertStatus.UPDATED
+
+
 class NovelData(NovelRawData):
 
     """ The full data. None basically means that they have not been translated into english """
@@ -63,4 +134,10 @@ class NovelData(NovelRawData):
     
 
     # Some tags for dispatchers
-    dispatched_at: Optional[datetime] = Field(default=None, description='When a dispatcher picks up this novel and dispatches it for translation')
\ No newline at end of file
+    dispatched_at: Optional[datetime] = Field(default=None, description='When a dispatcher picks up this novel and dispatches it for translation')
+
+    _indexes: ClassVar[List[IndexModel]] = NovelRawData._indexes + [
+        IndexModel([("all_data_parsed", ASCENDING), ("dispatched_at", ASCENDING)]),
+        IndexModel([("tags", ASCENDING)]),
+        IndexModel([("tags_raw", ASCENDING)]),
+    ]
\ No newline at end of file
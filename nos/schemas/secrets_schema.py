@@ -1,4 +1,5 @@
 from pydantic import BaseModel, Field
+from pymongo import IndexModel, ASCENDING
 from typing import List, ClassVar, Optional, Type, TypeVar
 from datetime import datetime, timedelta
 
@@ -21,15 +22,23 @@ class ProviderRateLimitInfo(BaseModel):
 class Provider(DBFuncMixin):
 
     _collection_name: ClassVar[str] = "providers"
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("key", ASCENDING)], unique=True),
+        IndexModel([("rate_limit_info.rate_limit_reset_time", ASCENDING)]),
+    ]
     """ These 3 values should not be updated."""
     url: str
     key: str
     provider: str
 
-    """ These 3 values can be updated """
+    """ These values can be updated """
     name: str
     model_names: List[str]
     priority: int = Field(default=0, description="The priority of the provider. The higher the value, the more weigth it gets")
+    max_concurrent_requests: int = Field(default=4, description="The maximum number of requests that can be in flight to this provider at once from a single AsyncTranslator")
+    requests_per_minute: Optional[int] = Field(default=None, description="The request rate limit of the provider. If None, it is learnt from the rate limit headers of the responses")
+    supports_batch: bool = Field(default=False, description="Whether the provider has an OpenAI compatible batch endpoint. The bulk translations are submitted to it")
+    request_budget: Optional[int] = Field(default=None, description="The number of requests the provider allows between two rate limit resets (e.g. a daily quota). None if it is not known")
     
     rate_limit_info: ProviderRateLimitInfo = Field(default=ProviderRateLimitInfo(), description="The rate limit information for the provider")
     
@@ -37,6 +46,12 @@ class Provider(DBFuncMixin):
     updated_at: datetime = Field(default=datetime.now(), description="The time when the provider was last updated")
     
 
+    def get_remaining_requests(self) -> Optional[int]:
+        """ The requests left in the budget of the provider. None if the budget is not known """
+        if self.request_budget is None:
+            return None
+        return max(0, self.request_budget - self.rate_limit_info.n_requests_made_since_last_reset)
+
     @classmethod
     def load_from_secrets_json(cls: Type[T], secrets_json: dict) -> List[T]:
         providers = []
@@ -1,5 +1,6 @@
 from pydantic import BaseModel, Field
-from typing import ClassVar
+from typing import ClassVar, List
+from pymongo import IndexModel, ASCENDING
 
 from nos.schemas.enums import TranslationEntityType
 from nos.schemas.mixins import DBFuncMixin
@@ -9,6 +10,9 @@ class TranslationEntity(DBFuncMixin):
     """ The translation entity is a collection which is basically like a key value store for word/words that occur very commonly withing the novel or its description. An example of this is the tags of the novel."""
 
     _collection_name: ClassVar[str] = "translation_entities"
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("type", ASCENDING), ("key", ASCENDING)], unique=True),
+    ]
 
     key: str = Field(description="The key of the translation entity. This will in raw chinese")
     value: str = Field(description="The translated value of the key")
@@ -1,10 +1,24 @@
+import os
 import datetime
 from bson import ObjectId
+from pymongo import IndexModel, ASCENDING
 from pydantic import BaseModel, Field
-from typing import Optional, Union, Dict, Annotated
+from typing import Optional, Union, Dict, List, Annotated, ClassVar
 
 from nos.schemas.mixins import DBFuncMixin
-from nos.schemas.enums import TranlsationStatus
+from nos.schemas.enums import TranlsationStatus, CacheTier
+
+
+LLM_CACHE_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60))
+
+
+class HedgeMetadata(BaseModel):
+    """ A duplicate request sent because the first one was slower than the hedge percentile of its endpoint """
+    delay: float = Field(description="The seconds after which the duplicate request was sent")
+    provider_name: Optional[str] = Field(default=None, description="The provider the duplicate request was sent to. None if it was cancelled before it got a route")
+    model_name: Optional[str] = Field(default=None, description="The model the duplicate request was sent to")
+    hedge_won: bool = Field(default=False, description="Whether the duplicate request answered first")
+    loser_cancelled: bool = Field(default=False, description="Whether the losing request was still in flight and got cancelled. The provider may still bill it")
 
 
 class LLMCallResponseSchema(BaseModel):
@@ -21,16 +35,20 @@ class LLMCallResponseSchema(BaseModel):
     start_time: Optional[datetime.datetime] = Field(default=None, description="The start timestamp of the llm call")
     end_time: Optional[datetime.datetime] = Field(default=None, description="The end timestamp of the llm call")
     total_time_taken: Optional[float] = Field(default=None, description="The total time taken for this llm call in seconds")
+    time_to_first_token: Optional[float] = Field(default=None, description="The seconds from sending the request to the first output token. Only known for streamed calls")
+    output_tokens_per_second: Optional[float] = Field(default=None, description="The output tokens per second after the first token. Only known for streamed calls")
+    hedge: Optional[HedgeMetadata] = Field(default=None, description="The duplicate request, if the call was hedged")
 
 class TranslatorMetadata(DBFuncMixin):
 
-    _collection_name: str = "translator_metadata"
+    _collection_name: ClassVar[str] = "translator_metadata"
     
     status: TranlsationStatus = Field(default=TranlsationStatus.STARTED, description="The status of the translation")
     error_message: Optional[str] = Field(default=None, description="The error message if the translation failed. It will remain None if the translation is successfull")
 
     novel_id: Optional[ObjectId] = Field(default=None, description="The id of the novel that is being translated")
     chapter_id: Optional[ObjectId] = Field(default=None, description="The id of the chapter that is being translated. If the translation is for other things, the novel_id is enough")
+    novel_ids: Optional[List[ObjectId]] = Field(default=None, description="The ids of the novels when a single call translates a batch of novels")
 
     provider_name: str = Field(description="The name of the api provider through which this translation is taking place")
     model_name: str = Field(description="The name of the model used for this translation")
@@ -38,3 +56,25 @@ class TranslatorMetadata(DBFuncMixin):
 
     llm_call_metadata: LLMCallResponseSchema = Field(description="The metadata for the llm call")
 
+    cache_hit: bool = Field(default=False, description="Whether the response was served from the llm response cache instead of the provider")
+    cache_tier: Optional[CacheTier] = Field(default=None, description="The tier of the cache that served the response. None on a cache miss")
+
+
+class LLMResponseCacheEntry(DBFuncMixin):
+    """ A cached llm response. The cache_key is derived from the prompt fingerprint and the hash of the input """
+
+    _collection_name: ClassVar[str] = "llm_response_cache"
+    _indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("cache_key", ASCENDING)], unique=True),
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=LLM_CACHE_TTL_SECONDS),
+    ]
+
+    cache_key: str = Field(description="The sha256 of the prompt fingerprint and input hash")
+    prompt_fingerprint: str = Field(description="The fingerprint of the prompt that produced this response")
+    model_name: str = Field(description="The name of the model that produced this response")
+    input_hash: str = Field(description="The sha256 of the serialized input")
+    response_content: Union[str, Dict] = Field(description="The response content from the llm call")
+    input_tokens: Optional[int] = Field(default=None, description="The number of input tokens the original call used")
+    output_tokens: Optional[int] = Field(default=None, description="The number of output tokens the original call used")
+    created_at: datetime.datetime = Field(default_factory=datetime.datetime.now, description="When the entry was cached. The db expires entries based on this field")
+
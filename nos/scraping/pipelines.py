@@ -0,0 +1,116 @@
+from collections import Counter
+from typing import List, Optional, Type
+
+from twisted.internet import task, threads, defer
+
+from nos.config import db
+from nos.schemas.chapter_schema import ChapterData
+from nos.schemas.mixins import DBFuncMixin
+from nos.schemas.scraping_schema import NovelRawData
+from nos.utils.metrics import SCRAPER_ITEMS, SCRAPER_WRITES
+
+
+class BufferedUpsertPipeline:
+    """
+    Buffers the scraped items of item_cls and writes them to the db as bulk upserts on the fingerprint.
+    The writes run in the reactor's thread pool, so Mongo latency never blocks the downloads. The buffer is
+    flushed once it holds NOS_PIPELINE_BUFFER_SIZE items, every NOS_PIPELINE_FLUSH_INTERVAL seconds, and when
+    the spider closes. Only one flush is in flight at a time, the items that arrive meanwhile wait for the next.
+    Only the _raw_fields of item_cls are refreshed on an existing document
+    """
+
+    item_cls: Type[DBFuncMixin]
+    # The name of the items in the logs and the stats keys
+    item_name: str
+
+    def __init__(self, buffer_size: int=50, flush_interval: float=5, stats=None):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.stats = stats
+
+        self.buffer: List[DBFuncMixin] = []
+        self.in_flight: Optional[defer.Deferred] = None
+        self.flush_loop: Optional[task.LoopingCall] = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            buffer_size=crawler.settings.getint("NOS_PIPELINE_BUFFER_SIZE", 50),
+            flush_interval=crawler.settings.getfloat("NOS_PIPELINE_FLUSH_INTERVAL", 5),
+            stats=crawler.stats,
+        )
+
+    def open_spider(self, spider):
+        self.spider = spider
+        self.flush_loop = task.LoopingCall(self.flush)
+        self.flush_loop.start(self.flush_interval, now=False)
+
+    def process_item(self, item, spider):
+        if not isinstance(item, self.item_cls):
+            return item
+        SCRAPER_ITEMS.inc(item=self.item_name)
+        self.buffer.append(item)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return item
+
+    def flush(self) -> Optional[defer.Deferred]:
+        if self.in_flight is not None or not self.buffer:
+            return self.in_flight
+
+        items, self.buffer = self.buffer, []
+        self.in_flight = threads.deferToThread(self.write_items, items)
+        self.in_flight.addErrback(self.on_write_error, len(items))
+        self.in_flight.addBoth(self.on_flushed)
+        return self.in_flight
+
+    def on_flushed(self, _):
+        self.in_flight = None
+        # Items may have piled up while the previous flush was running
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def on_write_error(self, failure, n_items: int):
+        self.spider.logger.error(f"Failed to write {n_items} {self.item_name} to the db: {failure.getErrorMessage()}")
+        SCRAPER_WRITES.inc(n_items, item=self.item_name, result="failed")
+        if self.stats:
+            self.stats.inc_value(f"nos/{self.item_name}_failed", n_items)
+
+    def write_items(self, items: List[DBFuncMixin]):
+        """
+        Runs in a thread. An item scraped twice in the same batch is only written once. Only the new and the changed
+        items are written, and a changed item gets the _reset_on_change fields of item_cls, so it is translated again
+        """
+        unique_items = list({item.fingerprint: item for item in items}.values())
+        statuses = self.item_cls.bulk_upsert_changes(db, unique_items, key_fields=["fingerprint"], update_fields=self.item_cls._raw_fields, reset_on_change=self.item_cls._reset_on_change) # type: ignore
+        counts = Counter(status.value if status is not None else "failed" for status in statuses)
+        if counts["failed"]:
+            # Another crawler may have written the same fingerprint concurrently. The rest of the batch is still written
+            self.spider.logger.warning(f"{counts['failed']} of {len(unique_items)} {self.item_name} failed to upsert")
+
+        for result in ("inserted", "updated", "unchanged", "failed"):
+            SCRAPER_WRITES.inc(counts[result], item=self.item_name, result=result)
+            if self.stats:
+                self.stats.inc_value(f"nos/{self.item_name}_{result}", counts[result])
+        self.spider.logger.debug(f"Upserted {len(unique_items)} {self.item_name}: {dict(counts)}")
+
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        # Wait for the flush in flight, then write whatever is left in the buffer
+        while self.in_flight is not None or self.buffer:
+            if self.in_flight is not None:
+                yield self.in_flight
+            else:
+                yield self.flush()
+
+
+class NovelRawDataPipeline(BufferedUpsertPipeline):
+    item_cls = NovelRawData
+    item_name = "novels"
+
+
+class ChapterDataPipeline(BufferedUpsertPipeline):
+    item_cls = ChapterData
+    item_name = "chapters"
@@ -0,0 +1,113 @@
+import scrapy
+import hashlib
+from bson import ObjectId
+from typing import List, Optional
+
+import nos.config
+from nos.schemas.chapter_schema import ChapterData
+from nos.schemas.scraping_schema import NovelRawData
+
+
+class Scrape1qxsChapters(scrapy.Spider):
+    """
+    Scrapes the chapters of the novels that are already in the db, from the chapter_list_url of every novel.
+    The chapters that are already in the db are skipped, so running it again only fetches the new chapters.
+    The chapters are yielded one by one and written in bulk by the pipeline, so a novel is never held in memory
+    """
+    name = "scrape_1qxs_chapters"
+    custom_settings = {
+        'USER_AGENT': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'DOWNLOAD_DELAY': 2, # Adds a 2-second delay between requests
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 1,
+        'AUTOTHROTTLE_ENABLED': True,
+        # The chapters are written to the db in bulk, off the reactor thread, by the pipeline
+        'ITEM_PIPELINES': {
+            'nos.scraping.pipelines.ChapterDataPipeline': 300,
+        },
+        'NOS_PIPELINE_BUFFER_SIZE': 20,
+        'NOS_PIPELINE_FLUSH_INTERVAL': 5,
+    }
+
+    source_name = "1qxs"
+
+    def __init__(self, *args, **kwargs):
+        super(Scrape1qxsChapters, self).__init__(*args, **kwargs)
+        # A comma separated list of novel ids. If not given, the first max_novels novels of the source are scraped
+        novel_ids = getattr(self, "novel_ids", None)
+        self.novel_ids: Optional[List[ObjectId]] = [ObjectId(n) for n in novel_ids.split(",")] if novel_ids else None
+        self.max_novels = int(getattr(self, "max_novels", 10))
+        max_chapters_per_novel = getattr(self, "max_chapters_per_novel", None)
+        self.max_chapters_per_novel: Optional[int] = int(max_chapters_per_novel) if max_chapters_per_novel else None
+
+    def start_requests(self):
+        for novel in self.load_novels():
+            known_chapter_source_ids = self.load_known_chapter_source_ids(novel["_id"])
+            yield scrapy.Request(
+                url=novel["chapter_list_url"],
+                callback=self.parse,
+                meta={"novel_id": novel["_id"], "known_chapter_source_ids": known_chapter_source_ids},
+            )
+
+    def load_novels(self) -> List[dict]:
+        """ Only the ids and the chapter list urls are loaded, up front, so that no cursor is held open during the crawl """
+        query = {"source_name": self.source_name}
+        if self.novel_ids is not None:
+            query["_id"] = {"$in": self.novel_ids} # type: ignore
+        return list(NovelRawData.iter_load(
+            nos.config.db,
+            query=query,
+            projection={"_id": 1, "chapter_list_url": 1},
+            raw=True,
+            sort={"_id": 1},
+            limit=None if self.novel_ids is not None else self.max_novels,
+        ))
+
+    def load_known_chapter_source_ids(self, novel_id: ObjectId) -> set:
+        return {
+            chapter["chapter_source_id"]
+            for chapter in ChapterData.iter_load(nos.config.db, query={"novel_id": novel_id}, projection={"chapter_source_id": 1, "_id": 0}, raw=True)
+        }
+
+    @staticmethod
+    def get_chapter_source_id(chapter_url: str) -> str:
+        return chapter_url.split(".html")[0].split("/")[-1]
+
+    def parse(self, response):
+        chapter_links = response.css("div.list ul li a::attr(href)").getall()
+        if self.max_chapters_per_novel is not None:
+            chapter_links = chapter_links[:self.max_chapters_per_novel]
+
+        known_chapter_source_ids = response.meta["known_chapter_source_ids"]
+        n_new_chapters = 0
+        for chapter_idx, chapter_link in enumerate(chapter_links):
+            if self.get_chapter_source_id(chapter_link) in known_chapter_source_ids:
+                continue
+            n_new_chapters += 1
+            yield response.follow(
+                chapter_link,
+                callback=self.parse_chapter,
+                meta={"novel_id": response.meta["novel_id"], "chapter_idx": chapter_idx},
+            )
+        self.logger.info(f"Novel {response.meta['novel_id']} has {len(chapter_links)} chapters, {n_new_chapters} of them new")
+
+    def parse_chapter(self, response):
+        source_name = self.source_name
+        chapter_url: str = response.url
+        title_raw: str = (response.css("div.title h1::text").get() or "").strip()
+        paragraphs: List[str] = [p.strip() for p in response.css("div.content p::text").getall() if p.strip()]
+
+        # Create a unique fingerprint for this chapter based on the source_name and the chapter_url
+        _fingerprint = hashlib.sha256(f"{source_name}{chapter_url}".encode()).hexdigest()
+
+        # The pipeline stores the data in the db
+        yield ChapterData(
+            novel_id=response.meta["novel_id"],
+            source_name=source_name,
+            chapter_source_id=self.get_chapter_source_id(chapter_url),
+            chapter_url=chapter_url,
+            chapter_idx=response.meta["chapter_idx"],
+            title_raw=title_raw,
+            # The paragraphs are kept apart by blank lines, so the splitter can cut the chapter on them
+            content_raw="\n\n".join(paragraphs),
+            fingerprint=_fingerprint,
+        )
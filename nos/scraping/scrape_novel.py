@@ -13,26 +13,85 @@ class Scrape1qxs(scrapy.Spider):
         'DOWNLOAD_DELAY': 2, # Adds a 2-second delay between requests
         'CONCURRENT_REQUESTS_PER_DOMAIN': 1,
         'AUTOTHROTTLE_ENABLED': True,
+        # The novels are written to the db in bulk, off the reactor thread, by the pipeline
+        'ITEM_PIPELINES': {
+            'nos.scraping.pipelines.NovelRawDataPipeline': 300,
+        },
+        'NOS_PIPELINE_BUFFER_SIZE': 50,
+        'NOS_PIPELINE_FLUSH_INTERVAL': 5,
     }
 
+    source_name = "1qxs"
+
     def __init__(self, *args, **kwargs):
         super(Scrape1qxs, self).__init__(*args, **kwargs)
         self.max_pages = int(getattr(self, "max_pages", 100))
         self.max_novels_per_page = int(getattr(self, "max_novels_per_page", 20))
+        # In the incremental mode, the listing pages are crawled one after the other and the known novels are skipped.
+        # The crawl stops once max_pages_without_new_novels listing pages in a row had nothing new
+        self.incremental = str(getattr(self, "incremental", False)).lower() in ("true", "1")
+        self.max_pages_without_new_novels = int(getattr(self, "max_pages_without_new_novels", 3))
+        self.n_pages_without_new_novels = 0
+        self.known_novel_source_ids = set()
+
+    def get_listing_url(self, page: int) -> str:
+        return f"https://www.1qxs.com/all/0_4_0_0_0_{page}.html"
+
+    def get_listing_request(self, page: int) -> scrapy.Request:
+        """
+        The listing pages are the ones fetched again on every incremental run, so they go through the http cache.
+        max-age=0 makes the cache revalidate them every time, so an unchanged page is a 304 and a changed one is never stale
+        """
+        return scrapy.Request(url=self.get_listing_url(page), callback=self.parse, meta={"page": page}, headers={"Cache-Control": "max-age=0"})
 
     def start_requests(self):
-        self.start_urls = [f"https://www.1qxs.com/all/0_4_0_0_0_{i}.html" for i in range(1, self.max_pages+1)] # The first page of the novel list ]
+        if self.incremental:
+            self.known_novel_source_ids = self.load_known_novel_source_ids()
+            self.logger.info(f"Incremental crawl, {len(self.known_novel_source_ids)} novels are already known")
+            yield self.get_listing_request(1)
+            return
+
+        self.start_urls = [self.get_listing_url(i) for i in range(1, self.max_pages+1)] # The first page of the novel list ]
         for url in self.start_urls:
             yield scrapy.Request(url=url, callback=self.parse)
 
+    def load_known_novel_source_ids(self) -> set:
+        return {
+            novel["novel_source_id"]
+            for novel in NovelRawData.iter_load(nos.config.db, query={"source_name": self.source_name}, projection={"novel_source_id": 1, "_id": 0}, raw=True)
+        }
+
+    @staticmethod
+    def get_novel_source_id(novel_url: str) -> str:
+        return novel_url.split(".html")[0].split("/")[-1]
+
     def parse(self, response):
         # List out all the novel links
         novel_links = response.css("div.name.line_1 a::attr(href)").getall()
+        n_new_novels = 0
         for novel_link in novel_links[:self.max_novels_per_page]:
+            if self.incremental:
+                novel_source_id = self.get_novel_source_id(novel_link)
+                if novel_source_id in self.known_novel_source_ids:
+                    continue
+                self.known_novel_source_ids.add(novel_source_id)
+            n_new_novels += 1
             yield response.follow(novel_link, callback=self.parse_novel)
 
+        if not self.incremental:
+            return
+
+        page = response.meta["page"]
+        self.n_pages_without_new_novels = 0 if n_new_novels else self.n_pages_without_new_novels + 1
+        self.logger.info(f"Listing page {page} had {n_new_novels} new novels")
+        if self.n_pages_without_new_novels >= self.max_pages_without_new_novels:
+            self.logger.info(f"Stopping the crawl after {self.n_pages_without_new_novels} listing pages without new novels")
+            return
+        if page < self.max_pages:
+            yield self.get_listing_request(page + 1)
+
     def parse_novel(self, response):
-        source_name = "1qxs"
+        source_name = self.source_name
         novel_url: str = response.url
         title_raw: str = response.css('div.name h1::text').get()
         author_raw: str = response.css('div.name span::text').get()
@@ -40,7 +99,7 @@ class Scrape1qxs(scrapy.Spider):
         classification_raw: str = response.css('div.label span.tags a::text').getall()
         tags_raw: List[str] = response.css("span.tags a::text").getall()
         image_url: str = response.css('div.image img::attr(data-original)').get()
-        novel_source_id = novel_url.split(".html")[0].split("/")[-1]
+        novel_source_id = self.get_novel_source_id(novel_url)
         chapter_list_url = "https://www.1qxs.com/list/" + novel_source_id + ".html"
 
         # Create a unique fingerprint for this novel based on the source_name, title_raw, novel_url
@@ -61,12 +120,6 @@ class Scrape1qxs(scrapy.Spider):
             "fingerprint": _fingerprint
         }
 
-        # The data need to stored in the db
-        novel_data_dict = NovelRawData(**novel_data)
-        novel_data_dict.update(db=nos.config.db)
-        # Refresh the data
-        novel_data_dict = NovelRawData.load(db=nos.config.db, query={"id": novel_data_dict.id}) # type: ignore
-        
-        # Send a message to the translator to parse the novel details
-        yield novel_data_dict
+        # The pipeline stores the data in the db
+        yield NovelRawData(**novel_data)
         
\ No newline at end of file
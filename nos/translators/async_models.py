@@ -0,0 +1,321 @@
+import time
+import asyncio
+import functools
+import datetime
+from collections import defaultdict
+from bson import ObjectId
+from openai import AsyncOpenAI, RateLimitError
+from typing import List, Optional, Dict, Union, Tuple, Any, Set
+
+from nos.config import logger, db
+from nos.schemas.prompt_schemas import RoutingConstraints
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translator_schemas import LLMCallResponseSchema, TranslatorMetadata, HedgeMetadata
+from nos.schemas.enums import TranlsationStatus
+from nos.exceptions.translator_exceptions import NoProvidersAvailable
+from nos.translators.cache import get_translation_cache
+from nos.translators.prompt_registry import get_prompt_registry
+from nos.translators.http_clients import build_async_http_client
+from nos.translators.router import get_router, Route
+from nos.translators.rate_limiter import get_rate_limiter, parse_rate_limit_headers, RATE_LIMIT_MAX_WAIT
+from nos.translators.streaming import LLMStream, OnItem, aconsume_llm_stream
+from nos.utils.metrics import LLM_HEDGES, TRANSLATIONS
+from nos.translators.models import (
+    MODEL_ERRORS,
+    get_routes,
+    load_available_providers,
+    mark_provider_as_exhausted,
+    mark_provider_use,
+    record_llm_call,
+    build_messages,
+    parse_llm_response,
+    get_stream_kwargs,
+)
+
+
+class AsyncTranslator:
+    """
+    The async counterpart of the Translator. Instead of having a single current provider, it keeps a client
+    and a semaphore for every available provider so that many requests can be in flight at once, capped per
+    provider by Provider.max_concurrent_requests.
+
+    NOTE: The clients and semaphores are bound to the event loop they are first used in, so create the
+    AsyncTranslator inside the coroutine that is passed to asyncio.run
+    """
+
+    def __init__(self):
+        self.providers: List[Provider] = []
+        self.clients: Dict[ObjectId, AsyncOpenAI] = {}
+        self.semaphores: Dict[ObjectId, asyncio.Semaphore] = {}
+        # When (in monotonic time) the rate limited models of every provider can be used again. Shared by the
+        # concurrent requests, as each of them may only hit the rate limit of some of the models
+        self.rate_limited_until: Dict[ObjectId, Dict[int, float]] = defaultdict(dict)
+        self.load_providers()
+
+
+    def load_providers(self) -> List[Provider]:
+        """ Load the available providers and setup a client and a semaphore for the ones we have not seen yet """
+        providers = load_available_providers()
+        logger.debug(f"Found {len(providers)} providers for the async translator")
+
+        for provider in providers:
+            if provider.id not in self.clients:
+                self.setup_client(provider)
+        self.providers = providers
+        return self.providers
+
+
+    def setup_client(self, provider: Provider):
+        self.clients[provider.id] = AsyncOpenAI(base_url=provider.url, api_key=provider.key, max_retries=0, http_client=build_async_http_client(provider.max_concurrent_requests)) # type: ignore
+        self.semaphores[provider.id] = asyncio.Semaphore(provider.max_concurrent_requests) # type: ignore
+        logger.info(f"Done Setting up async client for provider: {provider.provider}, name: {provider.name}")
+
+
+    async def acquire_route(self, routes: List[Route]) -> Tuple[Optional[Route], List[float]]:
+        """
+        Take a rate limit token and a provider slot for the first route that grants a token, best first. The routes
+        whose provider still has a free slot go first, and if all the providers are saturated the call waits for a slot
+        on the provider of the route that granted the token. The tokens are taken one route at a time, so the buckets
+        only drain at the rate of the requests that are sent. Returns None and the seconds every throttled route has
+        to wait when no route grants a token
+        """
+        if not routes:
+            raise NoProvidersAvailable()
+
+        rate_limiter = get_rate_limiter()
+        throttled_for: List[float] = []
+        # A stable sort, so the ranking is kept among the routes with a free slot and among the saturated ones
+        for provider, model_idx in sorted(routes, key=lambda route: self.semaphores[route[0].id].locked()): # type: ignore
+            wait = await asyncio.to_thread(rate_limiter.try_acquire, provider, provider.model_names[model_idx])
+            if wait > 0:
+                throttled_for.append(wait)
+                continue
+            await self.semaphores[provider.id].acquire() # type: ignore
+            return (provider, model_idx), throttled_for
+        return None, throttled_for
+
+
+    def release_provider(self, provider: Provider):
+        self.semaphores[provider.id].release() # type: ignore
+
+
+    async def mark_provider_as_exhausted(self, provider: Provider, rate_limit_reset_time: Optional[datetime.datetime]=None):
+        """ Other in-flight requests may hit the same rate limit, so the provider is only marked once """
+        if all(p.id != provider.id for p in self.providers):
+            return
+        self.providers = [p for p in self.providers if p.id != provider.id]
+        await asyncio.to_thread(mark_provider_as_exhausted, provider, rate_limit_reset_time)
+
+
+    async def call_routes(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int, response_format: Optional[Dict], raise_usage_error: bool, constraints: Optional[RoutingConstraints], stream: bool, on_item: Optional[OnItem], tried: Set[Tuple[ObjectId, int]], attempts: List[Route], avoid_provider_ids: Optional[Set[ObjectId]]=None, max_wait: float=RATE_LIMIT_MAX_WAIT) -> Tuple[Provider, int, LLMCallResponseSchema]:
+        """
+        Send the messages to the best route that is not in tried and return the provider, the model_idx that served
+        the request and the response. Every route is tried at most once, best first. A model that errors or is rate
+        limited falls back to the next route, and a provider is only marked as exhausted, till the reset time it
+        reported, once all of its models are rate limited. A route whose rate limit bucket is empty is skipped, and if
+        all of them are, the call waits for the first bucket to refill, up to max_wait seconds.
+        The routes of avoid_provider_ids are only used once no other route is left
+        """
+        router = get_router()
+        rate_limiter = get_rate_limiter()
+        deadline = time.monotonic() + max_wait
+        while True:
+            # The routes are ranked again for every attempt, as the other requests in flight update the stats
+            routes = [(p, m) for p, m in router.rank(self.providers, constraints) if (p.id, m) not in tried]
+            if avoid_provider_ids:
+                routes = [(p, m) for p, m in routes if p.id not in avoid_provider_ids] or routes
+            route, throttled_for = await self.acquire_route(routes)
+            if route is None:
+                if time.monotonic() + min(throttled_for) > deadline:
+                    raise NoProvidersAvailable()
+                logger.debug(f"All the routes are throttled, waiting {min(throttled_for):.2f} seconds")
+                await asyncio.sleep(min(throttled_for))
+                continue
+
+            provider, model_idx = route
+            tried.add((provider.id, model_idx)) # type: ignore
+            attempts.append((provider, model_idx))
+            model_name = provider.model_names[model_idx]
+            logger.debug(f"Calling provider: {provider.provider}, model: {model_name}")
+
+            start_time = time.monotonic()
+            try:
+                raw_response = await self.clients[provider.id].chat.completions.with_raw_response.create( # type: ignore
+                    model=model_name,
+                    messages=messages, # type: ignore
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    response_format=response_format, # type: ignore
+                    **get_stream_kwargs(stream), # type: ignore
+                )
+                if stream:
+                    response = await aconsume_llm_stream(raw_response, LLMStream(provider, model_idx, start_time, response_format, raise_usage_error, on_item))
+                else:
+                    response = parse_llm_response(raw_response, provider, model_idx, response_format, raise_usage_error)
+            except RateLimitError as e:
+                record_llm_call(provider, model_name, "rate_limited")
+                router.record_error(provider, model_name)
+                blocked_for = await asyncio.to_thread(rate_limiter.block, provider, model_name, parse_rate_limit_headers(e.response.headers)) # type: ignore
+                now = time.monotonic()
+                rate_limited_until = self.rate_limited_until[provider.id] # type: ignore
+                rate_limited_until[model_idx] = now + blocked_for
+                if all(rate_limited_until.get(idx, 0) > now for idx in range(len(provider.model_names))):
+                    # The provider is usable again as soon as the first of its models is
+                    blocked_for = min(rate_limited_until.values()) - now
+                    await self.mark_provider_as_exhausted(provider, datetime.datetime.now() + datetime.timedelta(seconds=blocked_for))
+                continue
+            except MODEL_ERRORS as e:
+                logger.warning(f"Model {model_name} of provider {provider.name} failed: {e}. Falling back")
+                record_llm_call(provider, model_name, "error")
+                router.record_error(provider, model_name)
+                continue
+            finally:
+                self.release_provider(provider)
+
+            response.total_time_taken = time.monotonic() - start_time
+            record_llm_call(provider, model_name, "success", response)
+            await asyncio.to_thread(rate_limiter.observe, provider, parse_rate_limit_headers(raw_response.headers))
+            router.record_success(provider, model_name, response)
+            await asyncio.to_thread(mark_provider_use, provider)
+            return provider, model_idx, response
+
+
+    def get_hedge_delay(self, constraints: Optional[RoutingConstraints]) -> Optional[float]:
+        """ The hedge percentile latency of the best route. None if the prompt does not hedge, or its latency is not known yet """
+        if constraints is None or constraints.hedge_percentile is None:
+            return None
+        routes = get_router().rank(self.providers, constraints)
+        if not routes:
+            return None
+        provider, model_idx = routes[0]
+        return get_router().get_latency_percentile(provider, provider.model_names[model_idx], constraints.hedge_percentile)
+
+
+    async def call_provider(self, user_prompt: Optional[str]=None, system_prompt: Optional[str]=None, temperature: float=0.1, max_tokens: int=2048, response_format: Optional[Dict]=None, raise_usage_error: bool=True, messages: Optional[List[Dict[str, str]]]=None, constraints: Optional[RoutingConstraints]=None, stream: bool=False, on_item: Optional[OnItem]=None) -> Tuple[Provider, int, LLMCallResponseSchema]:
+        """
+        Send the text to llm and return the provider, the model_idx that served the request and the response.
+        With stream, a JSON response is parsed as it comes in and its top level pairs are handed to on_item as soon as
+        they are complete. A pair may be handed over more than once, when a route fails halfway or a hedge runs too.
+        If the prompt hedges and the request is still running after the hedge percentile latency of its endpoint, the
+        same request is sent to the next best route, preferably on another provider, unless all of the routes are
+        throttled. The first valid answer wins and the other request is cancelled. The hedge is recorded in the response
+        """
+        if messages is None:
+            messages = build_messages(user_prompt, system_prompt) # type: ignore
+
+        # The hedge never retries a route the first request already tried, and the other way round
+        tried: Set[Tuple[ObjectId, int]] = set()
+        primary_attempts: List[Route] = []
+        call_routes = functools.partial(self.call_routes, messages, temperature, max_tokens, response_format, raise_usage_error, constraints, stream, on_item, tried) # type: ignore
+
+        hedge_delay = self.get_hedge_delay(constraints)
+        if hedge_delay is None:
+            return await call_routes(primary_attempts)
+
+        primary = asyncio.create_task(call_routes(primary_attempts))
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done:
+            return primary.result()
+
+        logger.debug(f"No answer after {hedge_delay:.2f} seconds, hedging the request")
+        hedge_attempts: List[Route] = []
+        # The hedge is only sent if a route has a rate limit token to spare right now. It never waits for a bucket to
+        # refill, as that would take the tokens the other requests are waiting for while the first request still runs
+        hedge = asyncio.create_task(call_routes(hedge_attempts, avoid_provider_ids={provider_id for provider_id, _ in tried}, max_wait=0))
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None:
+                    break
+                error = next(iter(done)).exception()
+            else:
+                raise error # type: ignore
+        finally:
+            for task in pending:
+                task.cancel()
+
+        provider, model_idx, response = winner.result()
+        hedge_route = hedge_attempts[-1] if hedge_attempts else None
+        response.hedge = HedgeMetadata(
+            delay=hedge_delay,
+            provider_name=hedge_route[0].name if hedge_route else None,
+            model_name=hedge_route[0].model_names[hedge_route[1]] if hedge_route else None,
+            hedge_won=winner is hedge,
+            loser_cancelled=bool(pending),
+        )
+        LLM_HEDGES.inc(winner="hedge" if winner is hedge else "first")
+        logger.debug(f"The {'hedge' if winner is hedge else 'first request'} won, served by {provider.name}/{provider.model_names[model_idx]}")
+        return provider, model_idx, response
+
+
+    async def run_translation(self, text: Union[str, List, Dict], prompt_name: str, novel_id: Optional[ObjectId]=None, chapter_id: Optional[ObjectId]=None, novel_ids: Optional[List[ObjectId]]=None, use_cache: bool=True, on_item: Optional[OnItem]=None) -> TranslatorMetadata:
+        """ on_item is only called when the prompt streams, and not on a cache hit """
+
+        compiled_prompt = await asyncio.to_thread(get_prompt_registry().get, prompt_name)
+        prompt = compiled_prompt.prompt
+        messages = compiled_prompt.render_messages(text)
+        model_params = prompt.model_parameters
+        status = TranlsationStatus.STARTED
+
+        # Until a provider serves the request, attribute it to the best route
+        provider, model_idx = get_routes(self.providers, prompt.routing)[0]
+
+        start_time = datetime.datetime.now()
+        cache = get_translation_cache() if use_cache else None
+        cached = await asyncio.to_thread(cache.lookup, prompt.fingerprint, text) if cache else None
+        cache_tier = None
+        response = LLMCallResponseSchema(**{})  # Just create and keep an empty schema
+        if cached is not None:
+            cache_entry, cache_tier = cached
+            response = LLMCallResponseSchema(response_content=cache_entry.response_content)
+            status = TranlsationStatus.COMPLETED
+            error_message = None
+        else:
+            try:
+                provider, model_idx, response = await self.call_provider(temperature=model_params.temperature, max_tokens=model_params.max_tokens, response_format=model_params.response_format, messages=messages, constraints=prompt.routing, stream=model_params.stream, on_item=on_item)
+                status = TranlsationStatus.COMPLETED
+                error_message = None
+            except NoProvidersAvailable:
+                logger.info(f"No providers available to switch to")
+                status = TranlsationStatus.FAILED
+                error_message = f"No providers available to switch to"
+
+            if cache is not None and status == TranlsationStatus.COMPLETED:
+                await asyncio.to_thread(cache.store, prompt.fingerprint, provider.model_names[model_idx], text, response)
+
+        response.start_time = start_time
+        response.end_time = datetime.datetime.now()
+        response.total_time_taken = (response.end_time - response.start_time).total_seconds()
+
+        translator_metadata = TranslatorMetadata(**{
+            "status": status,
+            "error_message": error_message,
+            "novel_id": novel_id,
+            "chapter_id": chapter_id,
+            "novel_ids": novel_ids,
+            "provider_name": provider.name,
+            "model_name": provider.model_names[model_idx],
+            "prompt_id": prompt.id,
+            "llm_call_metadata": response,
+            "cache_hit": cached is not None,
+            "cache_tier": cache_tier,
+        })
+        await asyncio.to_thread(translator_metadata.update, db)
+        TRANSLATIONS.inc(prompt=prompt_name, status=status.value)
+        logger.info(f"Translation completed in {response.total_time_taken} seconds")
+        return translator_metadata
+
+
+    async def run_translations_many(self, translations: List[Dict[str, Any]]) -> List[Union[TranslatorMetadata, BaseException]]:
+        """
+        Run many translations concurrently. Each item in translations is the kwargs for run_translation.
+        The results are returned in the same order. A translation that raised is returned as the exception
+        so that one bad item does not fail the others
+        """
+        return await asyncio.gather(
+            *[self.run_translation(**translation) for translation in translations],
+            return_exceptions=True
+        )
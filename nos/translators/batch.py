@@ -0,0 +1,107 @@
+import os
+import json
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from openai import OpenAI
+from openai.types import Batch
+
+from nos.config import logger
+from nos.schemas.prompt_schemas import PromptSchema
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translator_schemas import LLMCallResponseSchema
+from nos.translators.http_clients import get_http_client_pool
+from nos.translators.prompt_registry import get_prompt_registry
+
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# How long the provider has to run a batch. OpenAI compatible batch endpoints only accept 24h
+BATCH_COMPLETION_WINDOW = os.environ.get("BATCH_COMPLETION_WINDOW", "24h")
+# The batch statuses after which the batch will not change anymore
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchTranslator:
+    """
+    Translates through the batch endpoint of an OpenAI compatible provider. The requests are written as a jsonl file,
+    uploaded and submitted as a single batch, which the provider runs offline within the completion window, at a
+    lower price and on rate limits separate from the live chat completions.
+    The results (or the error) of every request are returned keyed by the custom_id of the request
+    """
+
+    def __init__(self, provider: Provider, model_name: Optional[str]=None):
+        self.provider = provider
+        self.model_name = model_name or provider.model_names[0]
+        self.client: OpenAI = get_http_client_pool().get_client(provider)
+
+
+    def build_request(self, custom_id: str, prompt_name: str, text: Union[str, List, Dict]) -> Tuple[Dict[str, Any], PromptSchema]:
+        """ A line of the batch input file, and the prompt it was rendered from """
+        compiled_prompt = get_prompt_registry().get(prompt_name)
+        model_params = compiled_prompt.prompt.model_parameters
+        body: Dict[str, Any] = {
+            "model": self.model_name,
+            "messages": compiled_prompt.render_messages(text),
+            "temperature": model_params.temperature,
+            "max_tokens": model_params.max_tokens,
+        }
+        if model_params.response_format:
+            body["response_format"] = model_params.response_format
+        return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}, compiled_prompt.prompt
+
+
+    def submit(self, requests: List[Dict[str, Any]]) -> Batch:
+        content = "\n".join(json.dumps(request, ensure_ascii=False) for request in requests).encode("utf-8")
+        input_file = self.client.files.create(file=("nos_batch.jsonl", content), purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window=BATCH_COMPLETION_WINDOW) # type: ignore
+        logger.info(f"Submitted batch {batch.id} of {len(requests)} requests to provider {self.provider.name}")
+        return batch
+
+
+    def retrieve(self, batch_id: str) -> Batch:
+        return self.client.batches.retrieve(batch_id)
+
+
+    def get_results(self, batch: Batch, response_formats: Dict[str, Optional[Dict]]) -> Dict[str, Union[LLMCallResponseSchema, str]]:
+        """
+        The results of a finished batch keyed by custom_id. A failed request maps to its error message, and a request
+        that is missing from the output files is missing from the results too.
+        response_formats holds the response_format of the requests, so the json responses get parsed
+        """
+        results: Dict[str, Union[LLMCallResponseSchema, str]] = {}
+        for file_id in (batch.error_file_id, batch.output_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                custom_id = result["custom_id"]
+                results[custom_id] = self.parse_result(result, response_formats.get(custom_id))
+        return results
+
+
+    def parse_result(self, result: Dict[str, Any], response_format: Optional[Dict]=None) -> Union[LLMCallResponseSchema, str]:
+        """ Convert a line of a batch output file into a LLMCallResponseSchema, or into the error message """
+        if result.get("error"):
+            return str(result["error"].get("message", result["error"]))
+        response = result.get("response") or {}
+        body = response.get("body") or {}
+        if response.get("status_code") != 200:
+            return f"Status {response.get('status_code')}: {body.get('error', body)}"
+
+        choices = body.get("choices") or []
+        response_content = choices[0].get("message", {}).get("content") if choices else None
+        if not response_content:
+            return "No response content"
+        if response_format and response_format.get("type") == "json_object":
+            try:
+                response_content = json.loads(response_content)
+            except json.JSONDecodeError as e:
+                return f"Invalid json response: {e}"
+
+        usage = body.get("usage") or {}
+        return LLMCallResponseSchema(
+            response_content=response_content,
+            input_tokens=usage.get("prompt_tokens"),
+            output_tokens=usage.get("completion_tokens"),
+        )
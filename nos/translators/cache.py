@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import datetime
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Union
+
+from pymongo.database import Database
+
+from nos.config import db
+from nos.schemas.enums import CacheTier
+from nos.schemas.translator_schemas import LLMCallResponseSchema, LLMResponseCacheEntry, LLM_CACHE_TTL_SECONDS
+from nos.utils.metrics import TRANSLATION_CACHE_LOOKUPS
+
+
+LLM_CACHE_MAX_SIZE = int(os.environ.get("LLM_CACHE_MAX_SIZE", 1024))
+
+
+def get_input_hash(text: Union[str, List, Dict]) -> str:
+    """ The keys are sorted so that the same dict always hashes the same irrespective of the key order """
+    serialized = text if isinstance(text, str) else json.dumps(text, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def get_cache_key(prompt_fingerprint: str, input_hash: str) -> str:
+    return hashlib.sha256(f"{prompt_fingerprint}:{input_hash}".encode()).hexdigest()
+
+
+class TranslationCache:
+    """
+    A two tier cache for llm responses
+    - A hot, process local LRU of at most max_size entries
+    - A durable tier in the llm_response_cache collection, whose entries are evicted by its TTL index
+    The entries are keyed on the prompt and the input only. Which model serves a request is only known once it was
+    served, after a fallback or as the router ranks the routes again, so the model it came from is kept on the entry
+    """
+
+    def __init__(self, db: Database, max_size: int=LLM_CACHE_MAX_SIZE, ttl_seconds: int=LLM_CACHE_TTL_SECONDS):
+        self.db = db
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = Lock()
+        self._entries: "OrderedDict[str, LLMResponseCacheEntry]" = OrderedDict()
+
+
+    def _is_expired(self, entry: LLMResponseCacheEntry) -> bool:
+        return entry.created_at < datetime.datetime.now() - datetime.timedelta(seconds=self.ttl_seconds)
+
+
+    def _set_in_memory(self, entry: LLMResponseCacheEntry):
+        with self._lock:
+            self._entries[entry.cache_key] = entry
+            self._entries.move_to_end(entry.cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+    def get(self, cache_key: str) -> Optional[Tuple[LLMResponseCacheEntry, CacheTier]]:
+        """ Look in memory first and then in the db. A db hit is promoted to the memory tier """
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                if not self._is_expired(entry):
+                    self._entries.move_to_end(cache_key)
+                    return entry, CacheTier.MEMORY
+                del self._entries[cache_key]
+
+        entry: Optional[LLMResponseCacheEntry] = LLMResponseCacheEntry.load(self.db, query={"cache_key": cache_key}) # type: ignore
+        # The TTL monitor only runs once a minute, so the entry might still be around after it expired
+        if entry is None or self._is_expired(entry):
+            return None
+        self._set_in_memory(entry)
+        return entry, CacheTier.DB
+
+
+    def set(self, entry: LLMResponseCacheEntry):
+        self._set_in_memory(entry)
+        self.db[LLMResponseCacheEntry._collection_name].update_one(
+            {"cache_key": entry.cache_key},
+            {"$set": entry.model_dump()},
+            upsert=True
+        )
+
+
+    def lookup(self, prompt_fingerprint: str, text: Union[str, List, Dict]) -> Optional[Tuple[LLMResponseCacheEntry, CacheTier]]:
+        cache_key = get_cache_key(prompt_fingerprint, get_input_hash(text))
+        cached = self.get(cache_key)
+        TRANSLATION_CACHE_LOOKUPS.inc(result=cached[1].value if cached else "miss")
+        return cached
+
+
+    def store(self, prompt_fingerprint: str, model_name: str, text: Union[str, List, Dict], response: LLMCallResponseSchema):
+        """ model_name is the model that served the response """
+        input_hash = get_input_hash(text)
+        self.set(LLMResponseCacheEntry(
+            cache_key=get_cache_key(prompt_fingerprint, input_hash),
+            prompt_fingerprint=prompt_fingerprint,
+            model_name=model_name,
+            input_hash=input_hash,
+            response_content=response.response_content,
+            input_tokens=response.input_tokens,
+            output_tokens=response.output_tokens,
+        ))
+
+
+_translation_cache: Optional[TranslationCache] = None
+_translation_cache_pid: Optional[int] = None
+
+
+def get_translation_cache() -> TranslationCache:
+    """ Return the translation cache of the current process. A forked process gets its own cache """
+    global _translation_cache, _translation_cache_pid
+    if _translation_cache is None or _translation_cache_pid != os.getpid():
+        _translation_cache = TranslationCache(db)
+        _translation_cache_pid = os.getpid()
+    return _translation_cache
@@ -0,0 +1,113 @@
+import os
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+import httpx
+from bson import ObjectId
+from openai import OpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+from nos.config import logger
+from nos.schemas.secrets_schema import Provider
+
+
+LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", 20))
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", 10))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_HTTP_KEEPALIVE_EXPIRY", 120))
+LLM_HTTP_CONNECT_TIMEOUT = float(os.environ.get("LLM_HTTP_CONNECT_TIMEOUT", 10))
+LLM_HTTP_READ_TIMEOUT = float(os.environ.get("LLM_HTTP_READ_TIMEOUT", 300))
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+LLM_HTTP2 = os.environ.get("LLM_HTTP2", "false").lower() == "true"
+
+
+def is_http2_enabled() -> bool:
+    if not LLM_HTTP2:
+        return False
+    try:
+        import h2 # noqa: F401
+    except ImportError:
+        logger.warning("LLM_HTTP2 is set but the h2 package is not installed. Falling back to HTTP/1.1")
+        return False
+    return True
+
+
+def get_http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(LLM_HTTP_READ_TIMEOUT, connect=LLM_HTTP_CONNECT_TIMEOUT)
+
+
+def build_async_http_client(max_connections: int=LLM_HTTP_MAX_CONNECTIONS) -> httpx.AsyncClient:
+    """
+    An async client's connections are bound to the event loop it is used in, so unlike the sync clients these are not
+    shared across the process. Every AsyncTranslator builds its own, sized to the concurrency of the provider
+    """
+    return DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY),
+        timeout=get_http_timeout(),
+        http2=is_http2_enabled(),
+    )
+
+
+class HTTPClientPool:
+    """
+    The process wide llm clients. Every provider gets one OpenAI client backed by its own pooled httpx client, so the
+    TCP and TLS connections to the provider are kept alive and reused across translations instead of being set up
+    for every task. A provider whose url or key changed gets a new client
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._clients: Dict[ObjectId, Tuple[Tuple[str, str], OpenAI]] = {}
+        self.http2 = is_http2_enabled()
+
+
+    def get_client(self, provider: Provider) -> OpenAI:
+        config = (provider.url, provider.key)
+        with self._lock:
+            cached = self._clients.get(provider.id) # type: ignore
+            if cached is not None and cached[0] == config:
+                return cached[1]
+
+            http_client = DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=get_http_timeout(),
+                http2=self.http2,
+            )
+            # The rate limits and failures are handled by the translators, which fall back to another route instead of
+            # sleeping on the same one
+            client = OpenAI(base_url=provider.url, api_key=provider.key, max_retries=0, http_client=http_client)
+            self._clients[provider.id] = (config, client) # type: ignore
+            stale = cached[1] if cached is not None else None
+
+        if stale is not None:
+            stale.close()
+        logger.debug(f"Created a pooled http client for provider {provider.name} (http2: {self.http2})")
+        return client
+
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for _, client in clients.values():
+            client.close()
+
+
+_http_client_pool: Optional[HTTPClientPool] = None
+_http_client_pool_pid: Optional[int] = None
+
+
+def get_http_client_pool() -> HTTPClientPool:
+    """ Return the client pool of the current process. A forked process never reuses the sockets of its parent """
+    global _http_client_pool, _http_client_pool_pid
+    if _http_client_pool is None or _http_client_pool_pid != os.getpid():
+        _http_client_pool = HTTPClientPool()
+        _http_client_pool_pid = os.getpid()
+    return _http_client_pool
+
+
+def close_http_clients(**kwargs):
+    """ Close the pooled connections of the current process, if it has any """
+    if _http_client_pool is not None and _http_client_pool_pid == os.getpid():
+        _http_client_pool.close()
@@ -1,20 +1,29 @@
+import os
 import time
 import json
 import yaml
 import httpx
 import datetime
-import backoff
 from bson import ObjectId
-from openai import OpenAI, RateLimitError
-from typing import List, Optional, Dict, Union
+from collections import defaultdict
+from openai import RateLimitError, APIStatusError, APIConnectionError
+from typing import List, Optional, Dict, Union, Tuple, Set
 from pathlib import Path
 
 from nos.config import logger, db
 from nos.schemas.secrets_schema import Provider
-from nos.schemas.prompt_schemas import PromptSchema
+from nos.schemas.prompt_schemas import PromptSchema, RoutingConstraints
 from nos.schemas.translator_schemas import LLMCallResponseSchema, TranslatorMetadata
 from nos.schemas.enums import TranlsationStatus
 from nos.exceptions.translator_exceptions import LLMNoResponseError, LLMNoUsageError, NoProvidersAvailable
+from nos.translators.provider_pool import get_provider_pool
+from nos.translators.cache import get_translation_cache
+from nos.translators.prompt_registry import get_prompt_registry
+from nos.translators.http_clients import get_http_client_pool
+from nos.translators.router import get_router, Route
+from nos.translators.rate_limiter import get_rate_limiter, parse_rate_limit_headers, RATE_LIMIT_MAX_WAIT
+from nos.translators.streaming import LLMStream, OnItem, consume_llm_stream
+from nos.utils.metrics import LLM_REQUEST_DURATION, LLM_REQUESTS, LLM_INPUT_TOKENS, LLM_OUTPUT_TOKENS, LLM_TIME_TO_FIRST_TOKEN, LLM_PROVIDER_EXHAUSTED, TRANSLATIONS
 
 
 def mock_rate_limit():
@@ -34,12 +43,102 @@ def mock_rate_limit():
         body=None
     )
 
+
+def load_available_providers() -> List[Provider]:
+    """ Return the providers whose rate limit has been reset, sorted by priority high to low """
+    return get_provider_pool().get_available_providers()
+
+
+def mark_provider_as_exhausted(provider: Provider, rate_limit_reset_time: Optional[datetime.datetime]=None):
+    LLM_PROVIDER_EXHAUSTED.inc(provider=provider.name)
+    get_provider_pool().mark_exhausted(provider, rate_limit_reset_time)
+
+
+def mark_provider_use(provider: Provider):
+    get_provider_pool().record_use(provider)
+
+
+# The errors after which the next model or provider is tried. A rate limit (a subclass of APIStatusError) is handled on its own
+MODEL_ERRORS = (APIStatusError, APIConnectionError, LLMNoResponseError, LLMNoUsageError, json.JSONDecodeError)
+
+
+def get_routes(providers: List[Provider], constraints: Optional[RoutingConstraints]=None) -> List[Route]:
+    """ The provider/models allowed by the constraints, best first. Raises NoProvidersAvailable if there are none """
+    routes = get_router().rank(providers, constraints)
+    if not routes:
+        raise NoProvidersAvailable()
+    return routes
+
+
+def record_llm_call(provider: Provider, model_name: str, outcome: str, response: Optional[LLMCallResponseSchema]=None):
+    """ Update the llm metrics with a call. outcome is success, rate_limited or error, and a success has its response """
+    LLM_REQUESTS.inc(provider=provider.name, model=model_name, outcome=outcome)
+    if response is None:
+        return
+    if response.total_time_taken is not None:
+        LLM_REQUEST_DURATION.observe(response.total_time_taken, provider=provider.name, model=model_name)
+    if response.time_to_first_token is not None:
+        LLM_TIME_TO_FIRST_TOKEN.observe(response.time_to_first_token, provider=provider.name, model=model_name)
+    if response.input_tokens:
+        LLM_INPUT_TOKENS.inc(response.input_tokens, provider=provider.name, model=model_name)
+    if response.output_tokens:
+        LLM_OUTPUT_TOKENS.inc(response.output_tokens, provider=provider.name, model=model_name)
+
+
+def build_messages(user_prompt: str, system_prompt: Optional[str]=None) -> List[Dict[str, str]]:
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": user_prompt})
+    return messages
+
+
+def parse_llm_response(response, provider: Provider, model_idx: int, response_format: Optional[Dict]=None, raise_usage_error: bool=True) -> LLMCallResponseSchema:
+    """ Convert the raw response of a chat completion call into a LLMCallResponseSchema """
+    headers = response.headers
+    remaining_req = int(headers.get('x-ratelimit-remaining-requests', -1))
+    remaining_tok = int(headers.get('x-ratelimit-remaining-tokens', -1))
+
+    completion = response.parse() # type: ignore
+
+    if completion.choices:
+        response_content = completion.choices[0].message.content
+        if not response_content:
+            raise LLMNoResponseError(provider, model_idx)
+
+        if response_format and response_format.get("type") == "json_object":
+            response_content = json.loads(response_content)
+        if completion.usage:
+            input_tokens = completion.usage.prompt_tokens
+            output_tokens = completion.usage.completion_tokens
+        else:
+            if raise_usage_error:
+                raise LLMNoUsageError(provider, model_idx)
+            else:
+                input_tokens = None
+                output_tokens = None
+
+        return LLMCallResponseSchema(
+            response_content=response_content,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            remaining_requests=remaining_req,
+            remaining_tokens=remaining_tok,
+        )
+
+    raise LLMNoResponseError(provider, model_idx)
+
+
+def get_stream_kwargs(stream: bool) -> Dict:
+    """ A streamed completion only reports its usage if asked to, in a last chunk """
+    return {"stream": True, "stream_options": {"include_usage": True}} if stream else {}
+
+
 class Translator:
 
     def __init__(self):
         """ Setup the translator """
         self.switch_providers()
-        self.setup_client()
 
 
     def switch_providers(self, mark_current_provider_as_exhausted: bool=False):
@@ -57,13 +156,8 @@ class Translator:
 
         # Load all the providers fromt the db
         logger.debug(f"Switching providers")
-        providers: List[Provider] = Provider.load(db, query={"rate_limit_info.rate_limit_reset_time": {"$lt": datetime.datetime.now()}}, many=True) # type: ignore
-        if not providers:
-            raise NoProvidersAvailable()
-        
+        providers = load_available_providers()
         logger.debug(f"Found {len(providers)} providers to switch to")
-        # Sort the providers by priority high to low
-        providers.sort(key=lambda x: x.priority, reverse=True)
         
         # Set the current provider to the first provider in the list
         self.current_provider = providers[0]
@@ -73,138 +167,185 @@ class Translator:
         return self.current_provider
     
 
-    def mark_current_provider_as_exhausted(self):
-        logger.debug(f"Marking current provider as exhausted: {self.current_provider.model_dump()=}")
-        self.current_provider.rate_limit_info.rate_limit_reset_time = datetime.datetime.now() + datetime.timedelta(days=1)
-        self.current_provider.rate_limit_info.n_requests_made_since_last_reset = 0
-        self.current_provider.rate_limit_info.is_rate_limited = True
-        self.current_provider.update(db)
+    def refresh_current_provider(self, constraints: Optional[RoutingConstraints]=None):
+        """
+        Point the translator at the best route for the next request. A long lived translator also picks up the providers
+        that were exhausted or became available since its last translation. This only reads the in-memory provider pool
+        and router, and reuses the pooled clients, so it is cheap
+        """
+        provider, model_idx = get_routes(load_available_providers(), constraints)[0]
+        self.setup_client(provider, model_idx)
+
+
+    def mark_current_provider_as_exhausted(self, rate_limit_reset_time: Optional[datetime.datetime]=None):
+        mark_provider_as_exhausted(self.current_provider, rate_limit_reset_time)
         
 
     def mark_current_provider_use(self):
-        self.current_provider.rate_limit_info.n_requests_made += 1
-        self.current_provider.rate_limit_info.n_requests_made_since_last_reset += 1
-        self.current_provider.rate_limit_info.is_rate_limited = False
-        self.current_provider.rate_limit_info.last_request_time = datetime.datetime.now()
-        self.current_provider.update(db)
-        pass
+        mark_provider_use(self.current_provider)
         
     
-    def setup_client(self, provider: Optional[Provider]=None):
+    def setup_client(self, provider: Optional[Provider]=None, model_idx: int=0):
         """ Use the internal provider_idx if the provider arg is None"""
         if provider is None:
             provider = self.current_provider
 
-        self.client = OpenAI(base_url=provider.url, api_key=provider.key)
+        self.client = get_http_client_pool().get_client(provider)
         self.current_provider = provider
-        self.model_idx = 0
-        logger.info(f"Done Setting up client for provider: {provider.provider}, name: {provider.name}")
-
-    @backoff.on_exception(
-            backoff.constant,
-            RateLimitError,
-            interval=2,
-            on_backoff=lambda details: details['args'][0].switch_providers(mark_current_provider_as_exhausted=True)
-    )
-    def call_provider(self, user_prompt: str, system_prompt: Optional[str]=None, temperature: float=0.1, max_tokens: int=2048, response_format: Optional[Dict]=None, raise_usage_error: bool=True):
-        """ Send the text to llm and return response """
-        model_name = self.current_provider.model_names[self.model_idx]
-        logger.debug(f"Calling provider: {self.current_provider.provider}, model: {model_name}")
-
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": user_prompt})
-
-        response = self.client.chat.completions.with_raw_response.create(
-            model=model_name,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            response_format=response_format # type: ignore
-        )
-        self.mark_current_provider_use()
-        headers = response.headers
-        remaining_req = int(headers.get('x-ratelimit-remaining-requests', -1))
-        remaining_tok = int(headers.get('x-ratelimit-remaining-tokens', -1))
-        
-        logger.debug(f"Response headers: {headers}")
+        self.model_idx = model_idx
+        logger.debug(f"Done Setting up client for provider: {provider.provider}, name: {provider.name}")
 
-        completion = response.parse() # type: ignore
+    def call_provider(self, user_prompt: Optional[str]=None, system_prompt: Optional[str]=None, temperature: float=0.1, max_tokens: int=2048, response_format: Optional[Dict]=None, raise_usage_error: bool=True, messages: Optional[List[Dict[str, str]]]=None, constraints: Optional[RoutingConstraints]=None, stream: bool=False, on_item: Optional[OnItem]=None):
+        """
+        Send the text to llm and return response. Prebuilt messages take precedence over the prompts.
+        With stream, a JSON response is parsed as it comes in and its top level pairs are handed to on_item as soon as
+        they are complete. A pair may be handed over again if a route fails halfway and the next one is tried.
+        The routes are tried best first. A model that errors or is rate limited falls back to the next route, and a
+        provider is only marked as exhausted, till the reset time it reported, once all of its models are rate limited.
+        A route whose rate limit bucket is empty is skipped, and if all of them are, the call waits for the first bucket
+        to refill, up to RATE_LIMIT_MAX_WAIT seconds
+        """
+        if messages is None:
+            messages = build_messages(user_prompt, system_prompt) # type: ignore
 
+        router = get_router()
+        rate_limiter = get_rate_limiter()
+        failed_routes: Set[Tuple[ObjectId, int]] = set()
+        rate_limited_models: Dict[ObjectId, Dict[int, float]] = defaultdict(dict)
+        deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT
+        while True:
+            throttled_for: List[float] = []
+            for provider, model_idx in get_routes(load_available_providers(), constraints):
+                if (provider.id, model_idx) in failed_routes or len(rate_limited_models[provider.id]) == len(provider.model_names): # type: ignore
+                    continue
+                model_name = provider.model_names[model_idx]
+                wait = rate_limiter.try_acquire(provider, model_name)
+                if wait > 0:
+                    throttled_for.append(wait)
+                    continue
 
-        if completion.choices:
-            response_content = completion.choices[0].message.content
-            if not response_content:
-                raise LLMNoResponseError(self.current_provider, self.model_idx)
-            
-            if response_format and response_format.get("type") == "json_object":
-                response_content = json.loads(response_content)
-            if completion.usage:
-                input_tokens = completion.usage.prompt_tokens
-                output_tokens = completion.usage.completion_tokens
-            else:
-                if raise_usage_error:
-                    raise LLMNoUsageError(self.current_provider, self.model_idx)
-                else:
-                    input_tokens = None
-                    output_tokens = None
-
-            return LLMCallResponseSchema(
-                response_content=response_content,
-                input_tokens=input_tokens,
-                output_tokens=output_tokens,
-                remaining_requests=remaining_req,
-                remaining_tokens=remaining_tok,
-            )
-        
-        raise LLMNoResponseError(self.current_provider, self.model_idx)
+                self.setup_client(provider, model_idx)
+                logger.debug(f"Calling provider: {provider.provider}, model: {model_name}")
+                start_time = time.monotonic()
+                try:
+                    raw_response = self.client.chat.completions.with_raw_response.create(
+                        model=model_name,
+                        messages=messages, # type: ignore
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        response_format=response_format, # type: ignore
+                        **get_stream_kwargs(stream), # type: ignore
+                    )
+                    if stream:
+                        response = consume_llm_stream(raw_response, LLMStream(provider, model_idx, start_time, response_format, raise_usage_error, on_item))
+                    else:
+                        response = parse_llm_response(raw_response, provider, model_idx, response_format, raise_usage_error)
+                except RateLimitError as e:
+                    record_llm_call(provider, model_name, "rate_limited")
+                    router.record_error(provider, model_name)
+                    failed_routes.add((provider.id, model_idx)) # type: ignore
+                    rate_limited_models[provider.id][model_idx] = rate_limiter.block(provider, model_name, parse_rate_limit_headers(e.response.headers)) # type: ignore
+                    if len(rate_limited_models[provider.id]) == len(provider.model_names): # type: ignore
+                        # The provider is usable again as soon as the first of its models is
+                        blocked_for = min(rate_limited_models[provider.id].values()) # type: ignore
+                        self.mark_current_provider_as_exhausted(datetime.datetime.now() + datetime.timedelta(seconds=blocked_for))
+                    continue
+                except MODEL_ERRORS as e:
+                    logger.warning(f"Model {model_name} of provider {provider.name} failed: {e}. Falling back")
+                    record_llm_call(provider, model_name, "error")
+                    router.record_error(provider, model_name)
+                    failed_routes.add((provider.id, model_idx)) # type: ignore
+                    continue
 
+                response.total_time_taken = time.monotonic() - start_time
+                record_llm_call(provider, model_name, "success", response)
+                rate_limiter.observe(provider, parse_rate_limit_headers(raw_response.headers))
+                router.record_success(provider, model_name, response)
+                self.mark_current_provider_use()
+                return response
 
-    def run_translation(self, text: Union[str, List, Dict], prompt_name: str, novel_id: Optional[ObjectId]=None, chapter_id: Optional[ObjectId]=None):
+            if not throttled_for or time.monotonic() + min(throttled_for) > deadline:
+                raise NoProvidersAvailable()
+            logger.debug(f"All the routes are throttled, waiting {min(throttled_for):.2f} seconds")
+            time.sleep(min(throttled_for))
 
-        prompt = PromptSchema.load(db, query={"prompt_name": prompt_name})
-        if not prompt:
-            raise ValueError(f"Prompt {prompt_name} not found")
 
-        system_prompt = prompt.prompt_content.system_prompt
-        user_prompt = prompt.prompt_content.user_prompt
-        text = json.dumps(text) if not isinstance(text, str) else text
-        user_prompt = user_prompt + "\n\n" + text
+    def run_translation(self, text: Union[str, List, Dict], prompt_name: str, novel_id: Optional[ObjectId]=None, chapter_id: Optional[ObjectId]=None, novel_ids: Optional[List[ObjectId]]=None, use_cache: bool=True, on_item: Optional[OnItem]=None):
+        """ on_item is only called when the prompt streams, and not on a cache hit """
+
+        compiled_prompt = get_prompt_registry().get(prompt_name)
+        prompt = compiled_prompt.prompt
+        messages = compiled_prompt.render_messages(text)
         model_params = prompt.model_parameters
+        self.refresh_current_provider(prompt.routing)
         status = TranlsationStatus.STARTED
+        model_name = self.current_provider.model_names[self.model_idx]
 
-        logger.debug(f"Calling provider: {self.current_provider.name}, model: {self.current_provider.model_names[self.model_idx]}")
         start_time = datetime.datetime.now()
+        cache = get_translation_cache() if use_cache else None
+        cached = cache.lookup(prompt.fingerprint, text) if cache else None
+        cache_tier = None
         response = LLMCallResponseSchema(**{})  # Just create and keep an empty schema
-        try:
-            response: LLMCallResponseSchema = self.call_provider(user_prompt, system_prompt, model_params.temperature, model_params.max_tokens, response_format=model_params.response_format)
+        if cached is not None:
+            cache_entry, cache_tier = cached
+            response = LLMCallResponseSchema(response_content=cache_entry.response_content)
             status = TranlsationStatus.COMPLETED
             error_message = None
-        except NoProvidersAvailable as re:
-            logger.info(f"No providers available to switch to")
-            # Set the status to failed
-            status = TranlsationStatus.FAILED
-            error_message = f"No providers available to switch to"
-            response = LLMCallResponseSchema(**{"start_time": start_time, "end_time": datetime.datetime.now(), "total_time_taken": (datetime.datetime.now() - start_time).total_seconds()})
-        finally:
-            response.start_time = start_time
-            response.end_time = datetime.datetime.now()
-            response.total_time_taken = (response.end_time - response.start_time).total_seconds() 
+        else:
+            logger.debug(f"Calling provider: {self.current_provider.name}, model: {model_name}")
+            try:
+                response: LLMCallResponseSchema = self.call_provider(temperature=model_params.temperature, max_tokens=model_params.max_tokens, response_format=model_params.response_format, messages=messages, constraints=prompt.routing, stream=model_params.stream, on_item=on_item)
+                status = TranlsationStatus.COMPLETED
+                error_message = None
+            except NoProvidersAvailable as re:
+                logger.info(f"No providers available to switch to")
+                # Set the status to failed
+                status = TranlsationStatus.FAILED
+                error_message = f"No providers available to switch to"
+                response = LLMCallResponseSchema(**{})
+
+            # The provider might have been switched during the call
+            model_name = self.current_provider.model_names[self.model_idx]
+            if cache is not None and status == TranlsationStatus.COMPLETED:
+                cache.store(prompt.fingerprint, model_name, text, response)
+
+        response.start_time = start_time
+        response.end_time = datetime.datetime.now()
+        response.total_time_taken = (response.end_time - response.start_time).total_seconds()
 
         translator_metadata = {
             "status": status,
             "error_message": error_message,
             "novel_id": novel_id,
             "chapter_id": chapter_id,
+            "novel_ids": novel_ids,
             "provider_name": self.current_provider.name,
-            "model_name": self.current_provider.model_names[self.model_idx],
+            "model_name": model_name,
             "prompt_id": prompt.id,
-            "llm_call_metadata": response
+            "llm_call_metadata": response,
+            "cache_hit": cached is not None,
+            "cache_tier": cache_tier,
         }
         # Print the translator metadata
         translator_metadata = TranslatorMetadata(**translator_metadata)
         translator_metadata.update(db)
+        TRANSLATIONS.inc(prompt=prompt_name, status=status.value)
         # Log the amount of time it took
         logger.info(f"Translation completed in {response.total_time_taken} seconds")
-        return translator_metadata
\ No newline at end of file
+        return translator_metadata
+
+
+_worker_translator: Optional[Translator] = None
+_worker_translator_pid: Optional[int] = None
+
+
+def get_worker_translator() -> Translator:
+    """
+    Return the translator of the current process. It is created once per worker process (see the worker_process_init
+    hook in the tasks) and reused by every task, so a task does not pay for loading the providers or for new connections
+    """
+    global _worker_translator, _worker_translator_pid
+    if _worker_translator is None or _worker_translator_pid != os.getpid():
+        _worker_translator = Translator()
+        _worker_translator_pid = os.getpid()
+    return _worker_translator
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Union
+
+from pymongo.database import Database
+
+from nos.config import logger, db
+from nos.schemas.prompt_schemas import PromptSchema
+
+
+PROMPT_REGISTRY_CHECK_INTERVAL = float(os.environ.get("PROMPT_REGISTRY_CHECK_INTERVAL", 10))
+
+
+class CompiledPrompt:
+    """ A prompt loaded from the db along with the message skeleton that is built once and reused for every call """
+
+    def __init__(self, prompt: PromptSchema):
+        self.prompt = prompt
+        self.system_message: Optional[Dict[str, str]] = {"role": "system", "content": prompt.prompt_content.system_prompt} if prompt.prompt_content.system_prompt else None
+        self.user_prompt_prefix = prompt.prompt_content.user_prompt + "\n\n"
+
+    def render_messages(self, text: Union[str, List, Dict]) -> List[Dict[str, str]]:
+        text = json.dumps(text) if not isinstance(text, str) else text
+        messages = [self.system_message] if self.system_message else []
+        messages.append({"role": "user", "content": self.user_prompt_prefix + text})
+        return messages
+
+
+class PromptRegistry:
+    """
+    A process local registry of the compiled prompts keyed by prompt name and fingerprint.
+    The entries are only invalidated when the registry version in the db changes, which beat_update_prompts
+    bumps whenever it saves a prompt with a new fingerprint. The version itself is checked at most once every
+    check_interval seconds, so the hot path does not touch the db at all
+    """
+
+    def __init__(self, db: Database, check_interval: float=PROMPT_REGISTRY_CHECK_INTERVAL):
+        self.db = db
+        self.check_interval = check_interval
+
+        self._lock = Lock()
+        self._by_name: Dict[str, CompiledPrompt] = {}
+        self._by_fingerprint: Dict[str, CompiledPrompt] = {}
+        self._version: Optional[int] = None
+        self._last_version_check: Optional[float] = None
+
+
+    def maybe_invalidate(self):
+        if self._last_version_check is not None and time.monotonic() - self._last_version_check < self.check_interval:
+            return
+
+        version = PromptSchema.get_registry_version(self.db)
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    logger.debug(f"Prompt registry version changed from {self._version} to {version}. Invalidating")
+                # A fingerprint always maps to the same content, so only the name lookups go stale
+                self._by_name = {}
+                self._version = version
+            self._last_version_check = time.monotonic()
+
+
+    def get(self, prompt_name: str) -> CompiledPrompt:
+        self.maybe_invalidate()
+        compiled = self._by_name.get(prompt_name)
+        if compiled is not None:
+            return compiled
+
+        prompt = PromptSchema.load(self.db, query={"prompt_name": prompt_name})
+        if not prompt:
+            raise ValueError(f"Prompt {prompt_name} not found")
+
+        with self._lock:
+            compiled = self._by_fingerprint.get(prompt.fingerprint)
+            if compiled is None:
+                compiled = CompiledPrompt(prompt)
+                self._by_fingerprint[prompt.fingerprint] = compiled
+            self._by_name[prompt_name] = compiled
+        logger.debug(f"Loaded prompt {prompt_name} with fingerprint {prompt.fingerprint} into the registry")
+        return compiled
+
+
+_prompt_registry: Optional[PromptRegistry] = None
+_prompt_registry_pid: Optional[int] = None
+
+
+def get_prompt_registry() -> PromptRegistry:
+    """ Return the prompt registry of the current process. A forked process starts with an empty registry of its own """
+    global _prompt_registry, _prompt_registry_pid
+    if _prompt_registry is None or _prompt_registry_pid != os.getpid():
+        _prompt_registry = PromptRegistry(db)
+        _prompt_registry_pid = os.getpid()
+    return _prompt_registry
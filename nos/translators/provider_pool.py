@@ -0,0 +1,198 @@
+import os
+import time
+import atexit
+import datetime
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from nos.config import logger, db
+from nos.schemas.secrets_schema import Provider
+from nos.exceptions.translator_exceptions import NoProvidersAvailable
+
+
+PROVIDER_POOL_REFRESH_INTERVAL = float(os.environ.get("PROVIDER_POOL_REFRESH_INTERVAL", 30))
+PROVIDER_POOL_FLUSH_INTERVAL = float(os.environ.get("PROVIDER_POOL_FLUSH_INTERVAL", 5))
+PROVIDER_POOL_FLUSH_THRESHOLD = int(os.environ.get("PROVIDER_POOL_FLUSH_THRESHOLD", 20))
+
+
+class ProviderPool:
+    """
+    A process level cache of the providers.
+    - The providers are loaded from the db and refreshed every refresh_interval seconds
+    - The usage of a provider is counted in memory and written to the db as batched $inc operations, either
+      every flush_interval seconds or once flush_threshold uses are pending. This way concurrent workers
+      never overwrite each others counters. Counters that could not be written stay pending for the next flush
+    - Marking a provider as exhausted is rare, so it is written to the db right away for other workers to see
+    """
+
+    def __init__(self, db: Database, refresh_interval: float=PROVIDER_POOL_REFRESH_INTERVAL, flush_interval: float=PROVIDER_POOL_FLUSH_INTERVAL, flush_threshold: int=PROVIDER_POOL_FLUSH_THRESHOLD):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+
+        self._lock = Lock()
+        self._providers: Dict[ObjectId, Provider] = {}
+        self._last_refresh_time: Optional[float] = None
+        self._last_flush_time = time.monotonic()
+
+        # Pending counters that are yet to be written to the db
+        self._pending_requests: Dict[ObjectId, int] = defaultdict(int)
+        self._pending_requests_since_last_reset: Dict[ObjectId, int] = defaultdict(int)
+        self._pending_last_request_time: Dict[ObjectId, datetime.datetime] = {}
+
+
+    def refresh(self):
+        """ Flush the pending counters and reload all the providers from the db """
+        self.flush()
+        providers: List[Provider] = Provider.load(self.db, query={}, many=True) or [] # type: ignore
+        with self._lock:
+            self._providers = {provider.id: provider for provider in providers} # type: ignore
+            self._last_refresh_time = time.monotonic()
+        logger.debug(f"Refreshed the provider pool with {len(providers)} providers")
+
+
+    def maybe_refresh(self):
+        if self._last_refresh_time is None or time.monotonic() - self._last_refresh_time > self.refresh_interval:
+            self.refresh()
+
+
+    def get_available_providers(self) -> List[Provider]:
+        """ Return the providers whose rate limit has been reset, sorted by priority high to low """
+        self.maybe_refresh()
+        now = datetime.datetime.now()
+        with self._lock:
+            providers = [p for p in self._providers.values() if p.rate_limit_info.rate_limit_reset_time < now]
+        if not providers:
+            raise NoProvidersAvailable()
+        providers.sort(key=lambda x: x.priority, reverse=True)
+        return providers
+
+
+    def record_use(self, provider: Provider):
+        now = datetime.datetime.now()
+        with self._lock:
+            provider.rate_limit_info.n_requests_made += 1
+            provider.rate_limit_info.n_requests_made_since_last_reset += 1
+            provider.rate_limit_info.is_rate_limited = False
+            provider.rate_limit_info.last_request_time = now
+
+            self._pending_requests[provider.id] += 1 # type: ignore
+            self._pending_requests_since_last_reset[provider.id] += 1 # type: ignore
+            self._pending_last_request_time[provider.id] = now # type: ignore
+            n_pending = sum(self._pending_requests.values())
+
+        if n_pending >= self.flush_threshold or time.monotonic() - self._last_flush_time > self.flush_interval:
+            self.flush()
+
+
+    def mark_exhausted(self, provider: Provider, rate_limit_reset_time: Optional[datetime.datetime]=None):
+        if rate_limit_reset_time is None:
+            rate_limit_reset_time = datetime.datetime.now() + datetime.timedelta(days=1)
+        logger.debug(f"Marking provider {provider.name} as exhausted till {rate_limit_reset_time}")
+
+        with self._lock:
+            provider.rate_limit_info.rate_limit_reset_time = rate_limit_reset_time
+            provider.rate_limit_info.n_requests_made_since_last_reset = 0
+            provider.rate_limit_info.is_rate_limited = True
+            # The counter is being reset, so the pending uses since the last reset are no longer relevant
+            self._pending_requests_since_last_reset.pop(provider.id, None) # type: ignore
+
+        self.db[Provider._collection_name].update_one(
+            {"_id": provider.id},
+            {"$set": {
+                "rate_limit_info.rate_limit_reset_time": rate_limit_reset_time,
+                "rate_limit_info.n_requests_made_since_last_reset": 0,
+                "rate_limit_info.is_rate_limited": True,
+            }}
+        )
+
+
+    def flush(self):
+        """
+        Write all the pending counters to the db as one unordered bulk write. If the write fails, the counters are
+        merged back into the pending ones, so they are written by the next flush instead of being lost
+        """
+        with self._lock:
+            pending_requests = self._pending_requests
+            pending_requests_since_last_reset = self._pending_requests_since_last_reset
+            pending_last_request_time = self._pending_last_request_time
+            self._pending_requests = defaultdict(int)
+            self._pending_requests_since_last_reset = defaultdict(int)
+            self._pending_last_request_time = {}
+            self._last_flush_time = time.monotonic()
+
+        if not pending_requests:
+            return
+
+        operations = []
+        for provider_id, n_requests in pending_requests.items():
+            inc = {"rate_limit_info.n_requests_made": n_requests}
+            if pending_requests_since_last_reset.get(provider_id):
+                inc["rate_limit_info.n_requests_made_since_last_reset"] = pending_requests_since_last_reset[provider_id]
+            operations.append(UpdateOne(
+                {"_id": provider_id},
+                {
+                    "$inc": inc,
+                    "$set": {"rate_limit_info.is_rate_limited": False},
+                    "$max": {"rate_limit_info.last_request_time": pending_last_request_time[provider_id]},
+                }
+            ))
+
+        try:
+            self.db[Provider._collection_name].bulk_write(operations, ordered=False)
+        except PyMongoError as e:
+            # The operations of an unordered bulk write are applied independently, so only the failed ones are kept.
+            # After any other error (e.g. the connection dropped) it is not known what was written, so all of them are
+            failed_ids = set(pending_requests)
+            if isinstance(e, BulkWriteError):
+                provider_ids = list(pending_requests)
+                failed_ids = {provider_ids[error["index"]] for error in e.details.get("writeErrors", [])}
+            logger.error(f"Could not flush the usage of {len(failed_ids)}/{len(operations)} providers, keeping it for the next flush: {e}")
+            self.restore_pending(
+                {k: v for k, v in pending_requests.items() if k in failed_ids},
+                {k: v for k, v in pending_requests_since_last_reset.items() if k in failed_ids},
+                {k: v for k, v in pending_last_request_time.items() if k in failed_ids},
+            )
+            return
+        logger.debug(f"Flushed the usage of {len(operations)} providers to the db")
+
+
+    def restore_pending(self, pending_requests: Dict[ObjectId, int], pending_requests_since_last_reset: Dict[ObjectId, int], pending_last_request_time: Dict[ObjectId, datetime.datetime]):
+        """ Merge counters that were taken for a flush back into the ones recorded meanwhile """
+        with self._lock:
+            for provider_id, n_requests in pending_requests.items():
+                self._pending_requests[provider_id] += n_requests
+            for provider_id, n_requests in pending_requests_since_last_reset.items():
+                self._pending_requests_since_last_reset[provider_id] += n_requests
+            for provider_id, last_request_time in pending_last_request_time.items():
+                current = self._pending_last_request_time.get(provider_id)
+                self._pending_last_request_time[provider_id] = last_request_time if current is None else max(current, last_request_time)
+
+
+_provider_pool: Optional[ProviderPool] = None
+_provider_pool_pid: Optional[int] = None
+
+
+def get_provider_pool() -> ProviderPool:
+    """ Return the provider pool of the current process. A forked process gets its own pool """
+    global _provider_pool, _provider_pool_pid
+    if _provider_pool is None or _provider_pool_pid != os.getpid():
+        _provider_pool = ProviderPool(db)
+        _provider_pool_pid = os.getpid()
+    return _provider_pool
+
+
+def flush_provider_pool(**kwargs):
+    """ Flush the pending counters of the current process, if it has a pool """
+    if _provider_pool is not None and _provider_pool_pid == os.getpid():
+        _provider_pool.flush()
+
+
+atexit.register(flush_provider_pool)
@@ -0,0 +1,238 @@
+import os
+import re
+import time
+import datetime
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+
+from nos.config import logger, REDIS_URL
+from nos.schemas.secrets_schema import Provider
+from nos.utils.redis_utils import get_redis_client
+
+
+# The request limits are per minute, so the bucket of a provider refills at limit / 60 requests per second
+RATE_LIMIT_WINDOW_SECONDS = 60
+# How long a model is blocked after a 429 that did not say when to retry
+RATE_LIMIT_DEFAULT_RETRY_AFTER = float(os.environ.get("RATE_LIMIT_DEFAULT_RETRY_AFTER", 60))
+# The longest a request waits for the bucket before it gives up on the provider
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", 30))
+RATE_LIMIT_KEY_PREFIX = "nos:rate_limit"
+
+# e.g. "1s", "6m0s", "1h30m", "20ms" or a plain number of seconds
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+# Take a request from the bucket of a provider. Returns the seconds to wait, 0 if the request was granted.
+# The bucket is unlimited until its capacity is known, from the provider config or the limit headers
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+local ttl = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at', 'capacity', 'blocked_until')
+local blocked_until = tonumber(bucket[4]) or 0
+if blocked_until > now then
+    return tostring(blocked_until - now)
+end
+if capacity <= 0 then
+    capacity = tonumber(bucket[3]) or 0
+end
+if capacity <= 0 then
+    return '0'
+end
+local rate = capacity / window
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], ttl)
+return tostring(wait)
+"""
+
+# Sync the bucket with what the provider reported. ARGV[2..4] are -1 when the header was missing
+OBSERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local remaining = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local blocked_until = tonumber(ARGV[4])
+local ttl = tonumber(ARGV[5])
+if capacity > 0 then
+    redis.call('HSET', KEYS[1], 'capacity', tostring(capacity))
+end
+if remaining >= 0 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(remaining), 'updated_at', tostring(now))
+end
+if blocked_until > now then
+    local current = tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0
+    redis.call('HSET', KEYS[1], 'blocked_until', tostring(math.max(current, blocked_until)))
+end
+redis.call('EXPIRE', KEYS[1], ttl)
+return 1
+"""
+
+
+class RateLimitHeaders(BaseModel):
+    """ The rate limit state a provider reports in its response headers. The reset times are in seconds from now """
+    limit_requests: Optional[int] = None
+    remaining_requests: Optional[int] = None
+    reset_requests: Optional[float] = None
+    limit_tokens: Optional[int] = None
+    remaining_tokens: Optional[int] = None
+    reset_tokens: Optional[float] = None
+    retry_after: Optional[float] = None
+
+    def get_blocked_for(self) -> Optional[float]:
+        """ How long the provider cannot take requests, if it said so """
+        if self.retry_after is not None:
+            return self.retry_after
+        blocked_for = [
+            reset for remaining, reset in ((self.remaining_requests, self.reset_requests), (self.remaining_tokens, self.reset_tokens))
+            if remaining == 0 and reset is not None
+        ]
+        return max(blocked_for) if blocked_for else None
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """ Parse a duration header like "6m0s" or "20ms" or "1.5" into seconds """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    multipliers = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * multipliers[unit] for amount, unit in parts)
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """ Retry-After is either a number of seconds or a http date. Some providers send retry-after-ms instead """
+    if headers.get("retry-after-ms") is not None:
+        seconds = parse_duration(headers.get("retry-after-ms"))
+        return seconds / 1000 if seconds is not None else None
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    seconds = parse_duration(value)
+    if seconds is not None:
+        return seconds
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_int_header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_rate_limit_headers(headers: Mapping[str, str]) -> RateLimitHeaders:
+    return RateLimitHeaders(
+        limit_requests=parse_int_header(headers, "x-ratelimit-limit-requests"),
+        remaining_requests=parse_int_header(headers, "x-ratelimit-remaining-requests"),
+        reset_requests=parse_duration(headers.get("x-ratelimit-reset-requests")),
+        limit_tokens=parse_int_header(headers, "x-ratelimit-limit-tokens"),
+        remaining_tokens=parse_int_header(headers, "x-ratelimit-remaining-tokens"),
+        reset_tokens=parse_duration(headers.get("x-ratelimit-reset-tokens")),
+        retry_after=parse_retry_after(headers),
+    )
+
+
+class RateLimiter:
+    """
+    A token bucket per provider, kept in redis so that it is shared by all the workers.
+    - The capacity is Provider.requests_per_minute, or else the limit the provider reports in its headers
+    - Every response syncs the bucket with the remaining requests the provider reported, and blocks it until the
+      reported reset when nothing is left, so the workers slow down before the provider starts returning 429s
+    - A 429 blocks the model that returned it until its Retry-After
+    The limiter fails open: if redis is unavailable the requests are let through and the 429s are handled as before
+    """
+
+    def __init__(self, redis_url: str=REDIS_URL, window: float=RATE_LIMIT_WINDOW_SECONDS):
+        self.redis_url = redis_url
+        self.window = window
+        redis_client = get_redis_client(redis_url)
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._observe = redis_client.register_script(OBSERVE_SCRIPT)
+
+
+    def get_key(self, provider: Provider, model_name: Optional[str]=None) -> str:
+        key = f"{RATE_LIMIT_KEY_PREFIX}:{provider.id}"
+        return f"{key}:{model_name}" if model_name else key
+
+
+    def get_ttl(self, blocked_for: float=0) -> int:
+        return int(max(self.window, blocked_for) * 2) + 1
+
+
+    def try_acquire(self, provider: Provider, model_name: str) -> float:
+        """ Take a request from the bucket of the provider. Returns the seconds to wait, 0 if the request can go now """
+        now = time.time()
+        try:
+            wait = float(self._acquire(keys=[self.get_key(provider, model_name)], args=[now, -1, self.window, self.get_ttl()]))
+            if wait > 0:
+                return wait
+            return float(self._acquire(keys=[self.get_key(provider)], args=[now, provider.requests_per_minute or -1, self.window, self.get_ttl()]))
+        except RedisError as e:
+            logger.warning(f"The rate limiter is unavailable, letting the request through: {e}")
+            return 0
+
+
+    def observe(self, provider: Provider, headers: RateLimitHeaders):
+        """ Sync the bucket of the provider with the headers of a successful response """
+        now = time.time()
+        blocked_for = headers.get_blocked_for()
+        try:
+            self._observe(
+                keys=[self.get_key(provider)],
+                args=[
+                    now,
+                    headers.remaining_requests if headers.remaining_requests is not None else -1,
+                    headers.limit_requests if headers.limit_requests is not None else -1,
+                    now + blocked_for if blocked_for else -1,
+                    self.get_ttl(blocked_for or 0),
+                ],
+            )
+        except RedisError as e:
+            logger.warning(f"The rate limiter is unavailable, could not record the rate limit headers: {e}")
+        if blocked_for:
+            logger.info(f"Provider {provider.name} has no requests left for the next {blocked_for:.1f} seconds")
+
+
+    def block(self, provider: Provider, model_name: str, headers: RateLimitHeaders) -> float:
+        """ Block the model after a 429 until the provider said to retry. Returns the seconds it is blocked for """
+        now = time.time()
+        blocked_for = headers.get_blocked_for() or RATE_LIMIT_DEFAULT_RETRY_AFTER
+        try:
+            self._observe(keys=[self.get_key(provider, model_name)], args=[now, -1, -1, now + blocked_for, self.get_ttl(blocked_for)])
+        except RedisError as e:
+            logger.warning(f"The rate limiter is unavailable, could not block {provider.name}/{model_name}: {e}")
+        logger.info(f"Model {model_name} of provider {provider.name} is rate limited for {blocked_for:.1f} seconds")
+        return blocked_for
+
+
+_rate_limiter: Optional[RateLimiter] = None
+_rate_limiter_pid: Optional[int] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """ Return the rate limiter of the current process. The buckets themselves live in redis """
+    global _rate_limiter, _rate_limiter_pid
+    if _rate_limiter is None or _rate_limiter_pid != os.getpid():
+        _rate_limiter = RateLimiter()
+        _rate_limiter_pid = os.getpid()
+    return _rate_limiter
@@ -0,0 +1,161 @@
+import os
+import time
+from fnmatch import fnmatch
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from nos.config import logger
+from nos.schemas.prompt_schemas import RoutingConstraints
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translator_schemas import LLMCallResponseSchema
+
+
+# The weight of the latest observation in the moving averages
+LLM_ROUTER_EWMA_ALPHA = float(os.environ.get("LLM_ROUTER_EWMA_ALPHA", 0.2))
+# The latency (in seconds) and throughput (in output tokens per second) assumed for an endpoint that has not served a request yet
+LLM_ROUTER_DEFAULT_LATENCY = float(os.environ.get("LLM_ROUTER_DEFAULT_LATENCY", 5))
+LLM_ROUTER_DEFAULT_THROUGHPUT = float(os.environ.get("LLM_ROUTER_DEFAULT_THROUGHPUT", 50))
+# An endpoint that always fails costs this many times its latency. The error rate halves every ERROR_HALF_LIFE seconds
+# without a new observation, so an endpoint that failed a while ago gets tried again
+LLM_ROUTER_ERROR_PENALTY = float(os.environ.get("LLM_ROUTER_ERROR_PENALTY", 10))
+LLM_ROUTER_ERROR_HALF_LIFE = float(os.environ.get("LLM_ROUTER_ERROR_HALF_LIFE", 300))
+# The latency percentiles are taken over the last LATENCY_WINDOW calls, and only once there are MIN_LATENCY_SAMPLES of them
+LLM_ROUTER_LATENCY_WINDOW = int(os.environ.get("LLM_ROUTER_LATENCY_WINDOW", 200))
+LLM_ROUTER_MIN_LATENCY_SAMPLES = int(os.environ.get("LLM_ROUTER_MIN_LATENCY_SAMPLES", 20))
+
+# A route is a provider and the index of one of its model_names
+Route = Tuple[Provider, int]
+
+
+class EndpointStats:
+    """ The moving averages of a single provider/model """
+
+    def __init__(self):
+        self.n_requests = 0
+        self.n_errors = 0
+        self.latency_ewma: Optional[float] = None
+        self.throughput_ewma: Optional[float] = None
+        self.error_rate_ewma = 0.0
+        self.latencies: Deque[float] = deque(maxlen=LLM_ROUTER_LATENCY_WINDOW)
+        self.last_update_time = time.monotonic()
+
+
+    def _update(self, current: Optional[float], value: float) -> float:
+        return value if current is None else LLM_ROUTER_EWMA_ALPHA * value + (1 - LLM_ROUTER_EWMA_ALPHA) * current
+
+
+    def record_success(self, latency: float, output_tokens: Optional[int]):
+        self.n_requests += 1
+        self.latency_ewma = self._update(self.latency_ewma, latency)
+        self.latencies.append(latency)
+        if output_tokens and latency > 0:
+            self.throughput_ewma = self._update(self.throughput_ewma, output_tokens / latency)
+        self.error_rate_ewma = self._update(self.get_error_rate(), 0.0)
+        self.last_update_time = time.monotonic()
+
+
+    def record_error(self):
+        self.n_requests += 1
+        self.n_errors += 1
+        self.error_rate_ewma = self._update(self.get_error_rate(), 1.0)
+        self.last_update_time = time.monotonic()
+
+
+    def get_error_rate(self) -> float:
+        return self.error_rate_ewma * 0.5 ** ((time.monotonic() - self.last_update_time) / LLM_ROUTER_ERROR_HALF_LIFE)
+
+
+    def get_latency(self) -> float:
+        return self.latency_ewma if self.latency_ewma is not None else LLM_ROUTER_DEFAULT_LATENCY
+
+
+    def get_throughput(self) -> float:
+        return self.throughput_ewma if self.throughput_ewma is not None else LLM_ROUTER_DEFAULT_THROUGHPUT
+
+
+class Router:
+    """
+    Picks the provider/model for every request from what the process has seen of them so far.
+    Every provider/model pair is an endpoint with a moving average of its latency, output throughput and error rate.
+    The endpoints are ranked by their expected cost (the latency, or the time per output token when the prompt
+    prefers throughput) scaled up by their recent error rate. Ties, e.g. among endpoints that have not been used yet,
+    go to the higher priority provider and then to the earlier model in its model_names
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats: Dict[Tuple[ObjectId, str], EndpointStats] = {}
+
+
+    def get_stats(self, provider: Provider, model_name: str) -> EndpointStats:
+        key = (provider.id, model_name)
+        with self._lock:
+            stats = self._stats.get(key) # type: ignore
+            if stats is None:
+                stats = self._stats[key] = EndpointStats() # type: ignore
+            return stats
+
+
+    def record_success(self, provider: Provider, model_name: str, response: LLMCallResponseSchema):
+        """ The response must have the total_time_taken of the call to the provider """
+        stats = self.get_stats(provider, model_name)
+        with self._lock:
+            stats.record_success(response.total_time_taken or 0.0, response.output_tokens)
+        logger.debug(f"Endpoint {provider.name}/{model_name}: latency {stats.get_latency():.2f}s, {stats.get_throughput():.1f} tokens/s, error rate {stats.get_error_rate():.2f}")
+
+
+    def record_error(self, provider: Provider, model_name: str):
+        stats = self.get_stats(provider, model_name)
+        with self._lock:
+            stats.record_error()
+        logger.debug(f"Endpoint {provider.name}/{model_name} failed, error rate {stats.get_error_rate():.2f}")
+
+
+    def get_latency_percentile(self, provider: Provider, model_name: str, percentile: float) -> Optional[float]:
+        """ The latency percentile (0-100) of the recent calls of the endpoint. None until there are enough of them to tell """
+        stats = self.get_stats(provider, model_name)
+        # Other threads append to the deque while they record their calls, so it is copied under the same lock
+        with self._lock:
+            latencies = list(stats.latencies)
+        if len(latencies) < LLM_ROUTER_MIN_LATENCY_SAMPLES:
+            return None
+        latencies.sort()
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+    def get_cost(self, provider: Provider, model_name: str, constraints: RoutingConstraints) -> float:
+        stats = self.get_stats(provider, model_name)
+        cost = 1 / stats.get_throughput() if constraints.prefer == "throughput" else stats.get_latency()
+        return cost * (1 + LLM_ROUTER_ERROR_PENALTY * stats.get_error_rate())
+
+
+    def rank(self, providers: List[Provider], constraints: Optional[RoutingConstraints]=None) -> List[Route]:
+        """ Return the routes of the providers allowed by the constraints, best first """
+        constraints = constraints or RoutingConstraints()
+        ranked = []
+        for provider in providers:
+            if constraints.providers and not any(fnmatch(provider.name, pattern) for pattern in constraints.providers):
+                continue
+            for model_idx, model_name in enumerate(provider.model_names):
+                if constraints.models and not any(fnmatch(model_name, pattern) for pattern in constraints.models):
+                    continue
+                too_slow = constraints.max_latency is not None and self.get_stats(provider, model_name).get_latency() > constraints.max_latency
+                ranked.append(((too_slow, self.get_cost(provider, model_name, constraints), -provider.priority, model_idx), (provider, model_idx)))
+        ranked.sort(key=lambda x: x[0])
+        return [route for _, route in ranked]
+
+
+_router: Optional[Router] = None
+_router_pid: Optional[int] = None
+
+
+def get_router() -> Router:
+    """ Return the router of the current process. A forked process starts with fresh stats """
+    global _router, _router_pid
+    if _router is None or _router_pid != os.getpid():
+        _router = Router()
+        _router_pid = os.getpid()
+    return _router
@@ -0,0 +1,94 @@
+import time
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translator_schemas import LLMCallResponseSchema
+from nos.exceptions.translator_exceptions import LLMNoResponseError, LLMNoUsageError
+from nos.utils.json_utils import IncrementalJSONObjectParser
+
+
+# Called with every top level key/value pair of a JSON response as soon as it has streamed in
+OnItem = Callable[[str, Any], None]
+
+
+class LLMStream:
+    """
+    Collects the chunks of a streamed chat completion into a LLMCallResponseSchema.
+    A JSON response is parsed as it comes in. Every completed top level pair is handed to on_item, and the stream is
+    aborted with a json.JSONDecodeError as soon as the output can no longer be valid. The time to the first token and
+    the output tokens per second after it are measured from start_time, the monotonic time the request was sent
+    """
+
+    def __init__(self, provider: Provider, model_idx: int, start_time: float, response_format: Optional[Dict]=None, raise_usage_error: bool=True, on_item: Optional[OnItem]=None):
+        self.provider = provider
+        self.model_idx = model_idx
+        self.start_time = start_time
+        self.raise_usage_error = raise_usage_error
+        self.on_item = on_item
+        self.parser = IncrementalJSONObjectParser() if response_format and response_format.get("type") == "json_object" else None
+
+        self.parts: List[str] = []
+        self.first_token_time: Optional[float] = None
+        self.usage = None
+
+
+    def add_chunk(self, chunk):
+        # With include_usage the usage comes in a last chunk without choices
+        if chunk.usage:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return
+        content = chunk.choices[0].delta.content
+        if not content:
+            return
+        if self.first_token_time is None:
+            self.first_token_time = time.monotonic()
+        self.parts.append(content)
+        if self.parser is not None:
+            for key, value in self.parser.feed(content):
+                if self.on_item is not None:
+                    self.on_item(key, value)
+
+
+    def build_response(self, headers: Mapping[str, str]) -> LLMCallResponseSchema:
+        response_content: Any = "".join(self.parts)
+        if not response_content:
+            raise LLMNoResponseError(self.provider, self.model_idx)
+        if self.parser is not None:
+            response_content = self.parser.close()
+
+        input_tokens = output_tokens = None
+        if self.usage:
+            input_tokens = self.usage.prompt_tokens
+            output_tokens = self.usage.completion_tokens
+        elif self.raise_usage_error:
+            raise LLMNoUsageError(self.provider, self.model_idx)
+
+        end_time = time.monotonic()
+        time_to_first_token = self.first_token_time - self.start_time # type: ignore
+        generation_time = end_time - self.first_token_time # type: ignore
+        return LLMCallResponseSchema(
+            response_content=response_content,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            remaining_requests=int(headers.get('x-ratelimit-remaining-requests', -1)),
+            remaining_tokens=int(headers.get('x-ratelimit-remaining-tokens', -1)),
+            time_to_first_token=time_to_first_token,
+            output_tokens_per_second=output_tokens / generation_time if output_tokens and generation_time > 0 else None,
+        )
+
+
+def consume_llm_stream(raw_response, llm_stream: LLMStream) -> LLMCallResponseSchema:
+    """ Read a streamed completion to the end. The connection is closed if the stream is aborted """
+    with raw_response.parse() as stream:
+        for chunk in stream:
+            llm_stream.add_chunk(chunk)
+    return llm_stream.build_response(raw_response.headers)
+
+
+async def aconsume_llm_stream(raw_response, llm_stream: LLMStream) -> LLMCallResponseSchema:
+    """ The async version of consume_llm_stream """
+    async with raw_response.parse() as stream:
+        async for chunk in stream:
+            llm_stream.add_chunk(chunk)
+    return llm_stream.build_response(raw_response.headers)
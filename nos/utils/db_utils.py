@@ -6,7 +6,7 @@ from pymongo.server_api import ServerApi
 from urllib.parse import quote_plus
 import time
 from threading import Lock
-from typing import Optional
+from typing import Callable, Optional
 
 
 from nos.utils.logging_utils import get_logger
@@ -36,4 +36,42 @@ def get_db_client(host: str, port: int, username: str, pwd: str, db_name: str, d
         logger.debug(f"Pinging the server at: {host}:{port}")
         client.admin.command("ping")
         logger.debug("Pinged the server")
-    return db
\ No newline at end of file
+    return db
+
+class LazyDatabase:
+    """
+    Stands in for a pymongo Database that is only connected on first use. A MongoClient is not fork safe, so a
+    process that was forked off after the first use gets a client of its own instead of sharing the parent's sockets
+    """
+
+    def __init__(self, connect: Callable[[], Database]):
+        self._connect = connect
+        self._lock = Lock()
+        self._db: Optional[Database] = None
+        self._pid: Optional[int] = None
+
+    @property
+    def connected(self) -> bool:
+        return self._db is not None and self._pid == os.getpid()
+
+    def get(self) -> Database:
+        if not self.connected:
+            with self._lock:
+                if not self.connected:
+                    start_time = time.perf_counter()
+                    self._db = self._connect()
+                    self._pid = os.getpid()
+                    logger.debug(f"Connected to the db in {time.perf_counter() - start_time:.3f}s in process {self._pid}")
+        return self._db # type: ignore
+
+    def __getattr__(self, name: str):
+        # Only reached for the names the proxy itself does not have. The private ones are never the db's, e.g. when copied
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __getitem__(self, name: str):
+        return self.get()[name]
+
+    def __repr__(self) -> str:
+        return f"LazyDatabase(connected={self.connected})"
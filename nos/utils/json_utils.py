@@ -0,0 +1,75 @@
+import json
+from typing import Any, List, Optional, Tuple
+
+# NOTE THIS FILE SHOULD NOT IMPORT ANY LOCAL MODULES
+
+
+class IncrementalJSONObjectParser:
+    """
+    Parses a JSON object as it streams in, and returns every top level key/value pair as soon as it is complete.
+    Only the brackets and strings are tracked while the text comes in, every complete pair is then parsed on its own.
+    It raises json.JSONDecodeError as soon as the text can no longer be a single JSON object, e.g. when it does not
+    start with "{", when a pair is malformed or when there is text after the object, so a stream can be aborted early
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.item_start: Optional[int] = None
+        self.closed = False
+
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        """ Add the next piece of the text. Returns the top level pairs it completed """
+        items: List[Tuple[str, Any]] = []
+        self.buffer += text
+        while self.pos < len(self.buffer):
+            char = self.buffer[self.pos]
+            if self.closed:
+                if not char.isspace():
+                    raise json.JSONDecodeError("Extra data after the JSON object", self.buffer, self.pos)
+            elif self.depth == 0:
+                if char == "{":
+                    self.depth = 1
+                    self.item_start = self.pos + 1
+                elif not char.isspace():
+                    raise json.JSONDecodeError("Expecting a JSON object", self.buffer, self.pos)
+            elif self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    items.extend(self._parse_item(self.pos, last=True))
+                    self.closed = True
+            elif char == "," and self.depth == 1:
+                items.extend(self._parse_item(self.pos))
+                self.item_start = self.pos + 1
+            self.pos += 1
+        return items
+
+
+    def _parse_item(self, end: int, last: bool=False) -> List[Tuple[str, Any]]:
+        item = self.buffer[self.item_start:end].strip()
+        if not item and last:
+            return []
+        # Parsing the pair as an object of its own validates the key, the colon and the value
+        return list(json.loads("{" + item + "}").items())
+
+
+    def close(self) -> Any:
+        """ The text is complete. Returns the whole object """
+        if not self.closed:
+            raise json.JSONDecodeError("Unterminated JSON object", self.buffer, self.pos)
+        return json.loads(self.buffer)
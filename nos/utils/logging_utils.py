@@ -3,15 +3,16 @@ import logging
 from logging import getLogger, StreamHandler, Formatter, INFO, DEBUG
 from dotenv import load_dotenv
 import os
+from typing import Union
 
 
 # NOTE THIS FILE SHOULD NOT IMPORT ANY LOCAL MODULES
 
 load_dotenv()
 
-def get_logger(name: str=os.environ["MAIN_LOGGER_NAME"], level: int=DEBUG) -> logging.Logger:
+def get_logger(name: str=os.environ.get("MAIN_LOGGER_NAME", "main"), level: Union[int, str]=os.environ.get("LOG_LEVEL", "DEBUG").upper()) -> logging.Logger:
     """
-    Get a logger object.
+    Get a logger object. The level defaults to LOG_LEVEL
     """
     logger = getLogger(name)
     if not logger.handlers:
@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# NOTE THIS FILE SHOULD NOT IMPORT ANY LOCAL MODULES
+
+# The port the metrics are served on, in the prometheus text format at /metrics. 0 disables the endpoint
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+# The worker processes of a celery worker write their metrics here every METRICS_FLUSH_INTERVAL seconds, and the main
+# process of the worker serves the sum of them
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "nos_metrics"))
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric(ABC):
+    """
+    A prometheus style metric. The values are kept per combination of label values, and every update passes all the
+    labels of the metric as keyword arguments. The updates are thread safe.
+    Every metric type implements snapshot, which is what gets written out and merged across the worker processes
+    """
+
+    type: str
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str]=(), registry: Optional["MetricsRegistry"]=None):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+
+    def get_key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+    @abstractmethod
+    def snapshot(self) -> dict:
+        ...
+
+
+    def reset(self):
+        with self._lock:
+            self._values.clear() # type: ignore
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+
+    def inc(self, amount: float=1, **labels: str):
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"values": [[list(key), value] for key, value in self._values.items()]}
+
+
+class Gauge(Metric):
+    """ A value that is set from time to time. Across the worker processes, the value set last wins """
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, Tuple[float, float]] = {}
+
+
+    def set(self, value: float, **labels: str):
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = (value, time.time())
+
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"values": [[list(key), value, updated_at] for key, (value, updated_at) in self._values.items()]}
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str]=(), buckets: Sequence[float]=LATENCY_BUCKETS, registry: Optional["MetricsRegistry"]=None):
+        super().__init__(name, description, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+        # The count of every bucket (the last one is +Inf), the sum and the count of the observations
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+
+    def observe(self, value: float, **labels: str):
+        key = self.get_key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            idx = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            counts[idx] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+
+    def time(self, **labels: str) -> "Timer":
+        return Timer(self, labels)
+
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"buckets": list(self.buckets), "values": [[list(key), list(counts), total, count] for key, (counts, total, count) in self._values.items()]}
+
+
+class Timer:
+    """ Observes the seconds spent in a with block """
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start_time, **self.labels)
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+
+    def snapshot(self) -> Dict[str, dict]:
+        """ The current values of all the metrics, as json """
+        return {
+            name: {"type": metric.type, "description": metric.description, "labelnames": list(metric.labelnames), **metric.snapshot()}
+            for name, metric in self._metrics.items()
+        }
+
+
+def merge_snapshots(snapshots: List[Dict[str, dict]]) -> Dict[str, dict]:
+    """ Sum the snapshots of several processes """
+    merged: Dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, data in snapshot.items():
+            target = merged.setdefault(name, {**data, "values": {}})
+            for value in data["values"]:
+                key = tuple(value[0])
+                if data["type"] == "histogram":
+                    counts, total, count = target["values"].get(key) or ([0] * len(value[1]), 0.0, 0)
+                    target["values"][key] = ([a + b for a, b in zip(counts, value[1])], total + value[2], count + value[3])
+                elif data["type"] == "gauge":
+                    if key not in target["values"] or target["values"][key][1] < value[2]:
+                        target["values"][key] = (value[1], value[2])
+                else:
+                    target["values"][key] = target["values"].get(key, 0) + value[1]
+    return merged
+
+
+def format_labels(labelnames: List[str], key: Tuple[str, ...], extra: Optional[Dict[str, str]]=None) -> str:
+    pairs = list(zip(labelnames, key)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = [(name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def render_metrics(merged: Dict[str, dict]) -> str:
+    """ The prometheus text exposition format of merged snapshots """
+    lines = []
+    for name, data in sorted(merged.items()):
+        lines.append(f"# HELP {name} {data['description']}")
+        lines.append(f"# TYPE {name} {data['type']}")
+        for key, value in sorted(data["values"].items()):
+            if data["type"] == "gauge":
+                value = value[0]
+            if data["type"] != "histogram":
+                lines.append(f"{name}{format_labels(data['labelnames'], key)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip([*data["buckets"], "+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(data['labelnames'], key, {'le': str(bound)})} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(data['labelnames'], key)} {total}")
+            lines.append(f"{name}_count{format_labels(data['labelnames'], key)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def get_process_metrics_dir(parent_pid: int) -> str:
+    """ The directory the worker processes of a parent process write their metrics to """
+    return os.path.join(METRICS_DIR, str(parent_pid))
+
+
+def flush_metrics(**kwargs):
+    """ Write the metrics of this process for its parent process to serve. The file is replaced atomically """
+    metrics_dir = get_process_metrics_dir(os.getppid())
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = os.path.join(metrics_dir, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(REGISTRY.snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def read_child_snapshots() -> List[Dict[str, dict]]:
+    """ The last snapshots of the worker processes of this process, including the ones that exited """
+    metrics_dir = get_process_metrics_dir(os.getpid())
+    snapshots = []
+    if os.path.isdir(metrics_dir):
+        for filename in os.listdir(metrics_dir):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(metrics_dir, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return snapshots
+
+
+_flusher_pid: Optional[int] = None
+
+
+def start_metrics_flusher(interval: float=METRICS_FLUSH_INTERVAL, **kwargs):
+    """
+    Flush the metrics of this process every interval seconds, from a daemon thread. It is called in a forked worker
+    process, so the values it inherited from the parent process are dropped first, the parent serves them already
+    """
+    global _flusher_pid
+    if not METRICS_PORT or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    REGISTRY.reset()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                flush_metrics()
+            except OSError:
+                pass
+
+    threading.Thread(target=run, name="nos-metrics-flusher", daemon=True).start()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics(merge_snapshots([REGISTRY.snapshot(), *read_child_snapshots()])).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        # Every scrape would be logged to stderr otherwise
+        pass
+
+
+def start_metrics_server(port: int=METRICS_PORT, host: str=METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """
+    Serve the metrics of this process, and those its worker processes flushed, from a daemon thread.
+    Nothing is served if the port is 0. Raises OSError if the port is taken
+    """
+    if not port:
+        return None
+    # The snapshots of a previous process with the same pid are stale
+    shutil.rmtree(get_process_metrics_dir(os.getpid()), ignore_errors=True)
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="nos-metrics-server", daemon=True).start()
+    return server
+
+
+# The metrics of the hot paths
+LLM_REQUEST_DURATION = Histogram("nos_llm_request_duration_seconds", "The latency of the llm calls that answered", ["provider", "model"])
+LLM_REQUESTS = Counter("nos_llm_requests_total", "The llm calls by their outcome: success, rate_limited or error", ["provider", "model", "outcome"])
+LLM_INPUT_TOKENS = Counter("nos_llm_input_tokens_total", "The input tokens of the llm calls", ["provider", "model"])
+LLM_OUTPUT_TOKENS = Counter("nos_llm_output_tokens_total", "The output tokens of the llm calls", ["provider", "model"])
+LLM_TIME_TO_FIRST_TOKEN = Histogram("nos_llm_time_to_first_token_seconds", "The time to the first token of the streamed llm calls", ["provider", "model"])
+LLM_PROVIDER_EXHAUSTED = Counter("nos_llm_provider_exhausted_total", "The times a provider was marked as exhausted and the translators switched away from it", ["provider"])
+LLM_HEDGES = Counter("nos_llm_hedges_total", "The hedged llm calls by the request that won: first or hedge", ["winner"])
+TRANSLATION_CACHE_LOOKUPS = Counter("nos_translation_cache_lookups_total", "The llm response cache lookups by their result: memory, db or miss", ["result"])
+TRANSLATIONS = Counter("nos_translations_total", "The translations by prompt and status", ["prompt", "status"])
+DISPATCHED = Counter("nos_dispatched_total", "The items the dispatchers sent for translation", ["kind"])
+DISPATCH_SIZE = Histogram("nos_dispatch_size", "The number of items of every dispatcher run", ["kind"], buckets=SIZE_BUCKETS)
+TRANSLATION_QUEUE_DEPTH = Gauge("nos_translation_queue_depth", "The tasks waiting in the translations queue when the dispatcher last looked")
+TASK_QUEUE_LAG = Histogram("nos_task_queue_lag_seconds", "The time the tasks waited in the queue before a worker started them", ["task"])
+TASK_DURATION = Histogram("nos_task_duration_seconds", "The run time of the celery tasks by their state", ["task", "state"])
+SCRAPER_ITEMS = Counter("nos_scraper_items_total", "The items the spiders scraped", ["item"])
+SCRAPER_WRITES = Counter("nos_scraper_writes_total", "The scraped items written to the db by their result: inserted, updated, unchanged or failed", ["item", "result"])
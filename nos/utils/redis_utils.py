@@ -0,0 +1,21 @@
+import os
+from typing import Dict, Tuple
+
+import redis
+
+# NOTE THIS FILE SHOULD NOT IMPORT ANY LOCAL MODULES
+
+_redis_clients: Dict[Tuple[str, int], redis.Redis] = {}
+
+
+def get_redis_client(url: str) -> redis.Redis:
+    """
+    Return a redis client for the url. The client (and its connection pool) is created once per process,
+    so a forked process never shares the sockets of its parent
+    """
+    key = (url, os.getpid())
+    client = _redis_clients.get(key)
+    if client is None:
+        client = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5)
+        _redis_clients[key] = client
+    return client
@@ -0,0 +1,81 @@
+import re
+from typing import Callable, List, Optional, TypeVar
+
+# NOTE THIS FILE SHOULD NOT IMPORT ANY LOCAL MODULES
+
+T = TypeVar("T")
+
+# CJK ideographs and punctuation are roughly one token each, everything else is roughly 4 characters per token
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A cheap, tokenizer independent estimate of the number of tokens in the text. It errs on the higher side,
+    so it is safe to use for budgeting requests
+    """
+    n_cjk = len(CJK_PATTERN.findall(text))
+    n_other = len(text) - n_cjk
+    return n_cjk + (n_other + 3) // 4
+
+
+def pack_by_token_budget(items: List[T], cost_fn: Callable[[T], int], budget: int, max_items: Optional[int]=None) -> List[List[T]]:
+    """
+    Greedily pack the items, in order, into batches whose total cost stays within the budget.
+    An item that is on its own over the budget gets a batch of its own
+    """
+    batches: List[List[T]] = []
+    current: List[T] = []
+    current_cost = 0
+    for item in items:
+        cost = cost_fn(item)
+        if current and (current_cost + cost > budget or (max_items is not None and len(current) >= max_items)):
+            batches.append(current)
+            current = []
+            current_cost = 0
+        current.append(item)
+        current_cost += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+# A sentence runs up to a chinese or latin full stop, question or exclamation mark, or an ellipsis, plus any closing quotes
+SENTENCE_PATTERN = re.compile(r".+?(?:[。！？!?…；;.]+[”’」』\"')]*|$)", re.DOTALL)
+PARAGRAPH_SEPARATOR = "\n\n"
+
+
+def split_paragraphs(text: str) -> List[str]:
+    """ Split the text into its non empty paragraphs. Each line of the text is a paragraph """
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def _split_oversized_paragraph(paragraph: str, budget: int) -> List[str]:
+    """ Split a paragraph that is on its own over the budget on its sentence boundaries, and hard split a sentence that still is """
+    pieces: List[str] = []
+    for sentence in SENTENCE_PATTERN.findall(paragraph):
+        while estimate_tokens(sentence) > budget:
+            # CJK text is roughly one token per character, so the budget in characters is a safe cut
+            pieces.append(sentence[:budget])
+            sentence = sentence[budget:]
+        if sentence:
+            pieces.append(sentence)
+    return ["".join(batch) for batch in pack_by_token_budget(pieces, estimate_tokens, budget)]
+
+
+def split_into_segments(text: str, budget: int) -> List[str]:
+    """
+    Split the text into segments of at most budget (estimated) tokens. The segments are cut on paragraph boundaries
+    so that every segment can be translated on its own, and the paragraphs of a segment are joined with PARAGRAPH_SEPARATOR.
+    Only a paragraph that is on its own over the budget is cut within, on its sentence boundaries
+    """
+    paragraphs: List[str] = []
+    for paragraph in split_paragraphs(text):
+        if estimate_tokens(paragraph) > budget:
+            paragraphs.extend(_split_oversized_paragraph(paragraph, budget))
+        else:
+            paragraphs.append(paragraph)
+
+    # The separator between the paragraphs costs a token as well
+    batches = pack_by_token_budget(paragraphs, lambda p: estimate_tokens(p) + 1, budget)
+    return [PARAGRAPH_SEPARATOR.join(batch) for batch in batches]
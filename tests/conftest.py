@@ -0,0 +1,45 @@
+import os
+import shutil
+
+import pytest
+
+from benchmarks.mock_llm import MockLLMConfig, MockLLMServer
+from benchmarks.mongo import DisposableMongo, MONGOD_BIN
+
+# The tests that need mongo run against a disposable single node replica set, so the change streams work too.
+# They are skipped when there is no mongod, see MONGOD_BIN
+
+
+@pytest.fixture(scope="session")
+def mongo():
+    if shutil.which(MONGOD_BIN) is None:
+        pytest.skip(f"{MONGOD_BIN} was not found. Point MONGOD_BIN at a mongod binary to run the db tests")
+    with DisposableMongo(replica_set="nos_test") as mongo:
+        # nos.config only connects on first use, so it picks these up
+        os.environ.update(mongo.env)
+        yield mongo
+
+
+@pytest.fixture
+def db(mongo, monkeypatch):
+    """ nos.config.db, emptied and with its indexes in place. The process caches of what was in it are dropped too """
+    from nos.config import db
+    from nos.ensure_indexes import ensure_indexes
+    from nos.translators import cache, prompt_registry, provider_pool
+
+    for collection_name in db.list_collection_names():
+        db.drop_collection(collection_name)
+    ensure_indexes(db)
+    for module, name in ((prompt_registry, "_prompt_registry"), (provider_pool, "_provider_pool"), (cache, "_translation_cache")):
+        monkeypatch.setattr(module, name, None)
+    return db
+
+
+@pytest.fixture
+def mock_llm():
+    """ A local OpenAI compatible server that answers right away. Tweak its config in the test for anything else """
+    server = MockLLMServer(MockLLMConfig(latency=0)).start()
+    try:
+        yield server
+    finally:
+        server.stop()
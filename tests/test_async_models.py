@@ -0,0 +1,133 @@
+import os
+import time
+import asyncio
+from typing import Dict, Iterator, Tuple
+from unittest import mock
+
+import pytest
+from bson import ObjectId
+
+from benchmarks.mock_llm import MockLLMConfig, MockLLMServer
+from nos.schemas.prompt_schemas import RoutingConstraints
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translator_schemas import LLMCallResponseSchema
+from nos.translators import async_models, router
+from nos.translators.async_models import AsyncTranslator
+from nos.translators.rate_limiter import RateLimitHeaders
+from nos.translators.router import Router
+
+HEDGE = RoutingConstraints(hedge_percentile=50)
+# The latency the router has seen of the first route, so the hedge is sent after this many seconds
+FIRST_ROUTE_LATENCY = 0.2
+
+
+class FakeRateLimiter:
+    """ Grants every request, except on the providers that have no tokens to spare """
+
+    def __init__(self):
+        self.throttled_provider_ids = set()
+
+    def try_acquire(self, provider: Provider, model_name: str) -> float:
+        return 60 if provider.id in self.throttled_provider_ids else 0
+
+    def observe(self, provider: Provider, headers: RateLimitHeaders):
+        pass
+
+    def block(self, provider: Provider, model_name: str, headers: RateLimitHeaders) -> float:
+        return 60
+
+
+@pytest.fixture
+def routes(monkeypatch) -> Iterator[Tuple[Dict[str, MockLLMServer], Dict[str, Provider], Router, FakeRateLimiter]]:
+    """
+    Two providers, each served by its own mock server so their latencies are set apart. The router ranks the first
+    one best, and has seen enough of its calls to know its latency percentiles
+    """
+    servers = {name: MockLLMServer(MockLLMConfig(latency=0)).start() for name in ("first", "second")}
+    providers = {name: Provider(_id=ObjectId(), url=server.url, key="mock-key", provider="mock", name=name, model_names=["mock-model"], priority=1 if name == "first" else 0) for name, server in servers.items()}
+
+    llm_router = Router()
+    for _ in range(router.LLM_ROUTER_MIN_LATENCY_SAMPLES):
+        llm_router.record_success(providers["first"], "mock-model", LLMCallResponseSchema(response_content="", total_time_taken=FIRST_ROUTE_LATENCY))
+    llm_router.record_success(providers["second"], "mock-model", LLMCallResponseSchema(response_content="", total_time_taken=2 * FIRST_ROUTE_LATENCY))
+    monkeypatch.setattr(router, "_router", llm_router)
+    monkeypatch.setattr(router, "_router_pid", os.getpid())
+
+    rate_limiter = FakeRateLimiter()
+    monkeypatch.setattr(async_models, "get_rate_limiter", lambda: rate_limiter)
+    monkeypatch.setattr(async_models, "load_available_providers", lambda: list(providers.values()))
+    # The usage counters of the providers are not what is tested here
+    monkeypatch.setattr(async_models, "mark_provider_use", mock.MagicMock())
+    try:
+        yield servers, providers, llm_router, rate_limiter
+    finally:
+        for server in servers.values():
+            server.stop()
+
+
+def call_provider() -> Tuple[Provider, LLMCallResponseSchema, float, AsyncTranslator]:
+    """ The provider that answered, its response, the seconds it took and the translator that made the call """
+    async def run():
+        translator = AsyncTranslator()
+        start_time = time.monotonic()
+        provider, _, response = await translator.call_provider(user_prompt="少年踏上修仙之路", constraints=HEDGE)
+        elapsed = time.monotonic() - start_time
+        # Let the cancelled request unwind before the loop closes
+        await asyncio.sleep(0.05)
+        return provider, response, elapsed, translator
+    return asyncio.run(run())
+
+
+def get_n_calls(llm_router: Router, provider: Provider) -> int:
+    return llm_router.get_stats(provider, "mock-model").n_requests
+
+
+def test_no_hedge_is_sent_when_the_first_route_answers_in_time(routes):
+    servers, providers, _, _ = routes
+    provider, response, _, _ = call_provider()
+    assert provider.name == "first" and response.hedge is None
+    assert servers["second"].n_requests == 0
+
+
+def test_the_hedge_is_sent_after_the_hedge_delay_and_the_loser_is_cancelled(routes):
+    servers, providers, llm_router, _ = routes
+    servers["first"].config.latency = 5
+    servers["second"].config.latency = 0.05
+    n_first_calls = get_n_calls(llm_router, providers["first"])
+
+    provider, response, elapsed, translator = call_provider()
+    assert provider.name == "second"
+    assert response.hedge is not None
+    assert (response.hedge.delay, response.hedge.provider_name, response.hedge.hedge_won, response.hedge.loser_cancelled) == (FIRST_ROUTE_LATENCY, "second", True, True)
+    # The answer came well before the first route would have answered
+    assert FIRST_ROUTE_LATENCY <= elapsed < 2
+    assert (servers["first"].max_in_flight, servers["second"].n_requests) == (1, 1)
+    # The cancelled request neither counts as a call of its route nor holds on to its provider slot
+    assert get_n_calls(llm_router, providers["first"]) == n_first_calls
+    assert not translator.semaphores[providers["first"].id].locked()
+
+
+def test_the_first_answer_wins_when_the_hedge_is_slower(routes):
+    servers, _, _, _ = routes
+    servers["first"].config.latency = 0.5
+    servers["second"].config.latency = 5
+
+    provider, response, elapsed, _ = call_provider()
+    assert provider.name == "first"
+    assert response.hedge is not None
+    assert (response.hedge.provider_name, response.hedge.hedge_won, response.hedge.loser_cancelled) == ("second", False, True)
+    assert elapsed < 2
+
+
+def test_no_hedge_is_sent_without_a_rate_limit_token_to_spare(routes):
+    servers, providers, _, rate_limiter = routes
+    servers["first"].config.latency = 0.5
+    rate_limiter.throttled_provider_ids.add(providers["second"].id)
+
+    provider, response, elapsed, _ = call_provider()
+    # The hedge gave up right away instead of waiting for the bucket, and the first request still answered
+    assert provider.name == "first"
+    assert response.hedge is not None
+    assert (response.hedge.provider_name, response.hedge.hedge_won) == (None, False)
+    assert servers["second"].n_requests == 0
+    assert elapsed < 2
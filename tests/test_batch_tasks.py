@@ -0,0 +1,120 @@
+import datetime
+from typing import List
+from unittest import mock
+
+from bson import ObjectId
+from pymongo.database import Database
+
+from benchmarks.mock_llm import MockLLMServer
+from nos.celery_tasks import batch_tasks
+from nos.celery_tasks.dispatchers import claim_novels_for_metadata_translation
+from nos.schemas.batch_schema import TranslationBatchJob
+from nos.schemas.enums import BatchJobStatus, TranlsationStatus, TranslationEntityType
+from nos.schemas.prompt_schemas import PromptSchema
+from nos.schemas.scraping_schema import NovelData
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translation_entities_schema import TranslationEntity
+from nos.schemas.translator_schemas import TranslatorMetadata
+
+PROVIDER_NAME = "mock_batch_provider"
+
+
+def make_novel(idx: int) -> NovelData:
+    return NovelData(
+        source_name="test",
+        novel_source_id=str(idx),
+        novel_url=f"https://www.1qxs.com/xs/{idx}.html",
+        chapter_list_url=f"https://www.1qxs.com/list/{idx}.html",
+        image_url=f"https://img.1qxs.com/cover/{idx}.jpg",
+        title_raw=f"小说{idx}",
+        author_raw="作者",
+        description_raw="少年踏上修仙之路",
+        classification_raw=["玄幻"],
+        tags_raw=["修仙", f"标签{idx}"],
+        fingerprint=f"test-{idx}",
+    )
+
+
+def seed(db: Database, url: str, n_novels: int) -> List[NovelData]:
+    """ A batch provider at url, the prompts of the batch and untranslated novels """
+    Provider(url=url, key="mock-key", provider="mock", name=PROVIDER_NAME, model_names=["mock-model"], supports_batch=True).update(db)
+    for prompt_name in (batch_tasks.TAG_TRANSLATION_PROMPT_NAME, batch_tasks.NOVEL_METADATA_PROMPT_NAME):
+        PromptSchema.load(db, query={"prompt_name": prompt_name}, load_from_file=True).update(db) # type: ignore
+    novels = [make_novel(idx) for idx in range(n_novels)]
+    for novel in novels:
+        novel.update(db)
+    return novels
+
+
+def test_novels_are_claimed_for_a_batch_in_bulk(db: Database):
+    novels = [make_novel(idx) for idx in range(30)]
+    NovelData.bulk_update(db, novels)
+
+    collection_type = type(db[NovelData._collection_name])
+    with mock.patch.object(collection_type, "find_one_and_update", side_effect=AssertionError("claimed one by one")), \
+            mock.patch.object(collection_type, "update_many", autospec=True, side_effect=collection_type.update_many) as update_many:
+        claimed = batch_tasks.claim_novels_for_batch(limit=25)
+    assert update_many.call_count == 1
+
+    assert len(claimed) == 25
+    assert all(novel.title_raw and novel.description_raw and "tags_raw" not in novel.__dict__ for novel in claimed)
+    # The claim is dated into the future, so the live dispatcher leaves the novels to the batch
+    saved: List[NovelData] = NovelData.load(db, query={"_id": {"$in": [novel.id for novel in claimed]}}, many=True) # type: ignore
+    assert all(novel.dispatched_at > datetime.datetime.now() for novel in saved) # type: ignore
+    assert {novel.id for novel in claim_novels_for_metadata_translation(limit=30)} == {novel.id for novel in novels} - {novel.id for novel in claimed}
+
+
+def run_batch() -> TranslationBatchJob:
+    """ Submit a batch, and poll it until the provider finished it and the results are saved """
+    job_id = batch_tasks.submit_batch_translation()
+    assert job_id is not None
+    batch_tasks.poll_batch_translations()
+    return TranslationBatchJob.load(batch_tasks.db, query={"_id": ObjectId(job_id)}) # type: ignore
+
+
+def test_batch_translates_novels_and_tags(db: Database, mock_llm: MockLLMServer):
+    novels = seed(db, mock_llm.url, n_novels=3)
+
+    job = run_batch()
+    assert job.status == BatchJobStatus.COMPLETED
+    assert job.provider_status == "completed"
+    # One request translates all the tags, and one every novel
+    assert (job.n_succeeded, job.n_failed) == (len(novels) + 1, 0)
+    assert job.output_file_id is not None and job.error_file_id is None
+
+    for novel in novels:
+        saved: NovelData = NovelData.load(db, query={"_id": novel.id}) # type: ignore
+        assert saved.all_data_parsed
+        assert (saved.title, saved.author) == (f"EN {novel.title_raw}", "EN 作者")
+
+    translator_metadata: List[TranslatorMetadata] = TranslatorMetadata.load(db, query={}, many=True) # type: ignore
+    assert len(translator_metadata) == len(novels) + 1
+    assert all(metadata.status == TranlsationStatus.COMPLETED and metadata.provider_name == PROVIDER_NAME for metadata in translator_metadata)
+    assert {metadata.novel_id for metadata in translator_metadata} == {novel.id for novel in novels} | {None}
+
+    tags = {entity.key: entity.value for entity in TranslationEntity.load(db, query={"type": TranslationEntityType.TAGS.value}, many=True)} # type: ignore
+    assert tags == {tag: f"EN {tag}" for novel in novels for tag in novel.tags_raw}
+
+    # Everything is translated, so the next run has nothing to submit
+    assert batch_tasks.submit_batch_translation() is None
+
+
+def test_failed_batch_requests_release_the_novels(db: Database, mock_llm: MockLLMServer):
+    mock_llm.config.batch_error_ratio = 1.0
+    novels = seed(db, mock_llm.url, n_novels=2)
+
+    job = run_batch()
+    # The batch itself completed, only its requests failed
+    assert job.status == BatchJobStatus.COMPLETED
+    assert (job.n_succeeded, job.n_failed) == (0, len(novels) + 1)
+    assert job.output_file_id is None and job.error_file_id is not None
+
+    for novel in novels:
+        saved: NovelData = NovelData.load(db, query={"_id": novel.id}) # type: ignore
+        assert not saved.all_data_parsed
+        assert saved.dispatched_at is None and saved.title is None
+
+    translator_metadata: List[TranslatorMetadata] = TranslatorMetadata.load(db, query={}, many=True) # type: ignore
+    assert len(translator_metadata) == len(novels) + 1
+    assert all(metadata.status == TranlsationStatus.FAILED and metadata.error_message.startswith("Status 500") for metadata in translator_metadata) # type: ignore
+    assert db[TranslationEntity._collection_name].count_documents({}) == 0
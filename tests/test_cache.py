@@ -0,0 +1,68 @@
+import asyncio
+from unittest import mock
+
+import pytest
+from pymongo.database import Database
+
+from benchmarks.mock_llm import MockLLMServer
+from nos.schemas.enums import CacheTier
+from nos.schemas.prompt_schemas import PromptSchema
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translator_schemas import LLMCallResponseSchema, LLMResponseCacheEntry, TranslatorMetadata
+from nos.translators import router
+from nos.translators.async_models import AsyncTranslator
+from nos.translators.cache import TranslationCache
+from nos.translators.models import Translator
+
+PROMPT_NAME = "novel_metadata_translation"
+NOVEL_METADATA = {"title_raw": "小说", "author_raw": "作者", "description_raw": "少年踏上修仙之路"}
+
+
+def test_a_response_is_found_whichever_model_served_it():
+    cache = TranslationCache(mock.MagicMock())
+    cache.store("fingerprint", "fallback-model", NOVEL_METADATA, LLMCallResponseSchema(response_content={"title": "Novel"}, input_tokens=10, output_tokens=5))
+
+    # The keys of a dict input are hashed in order
+    cached = cache.lookup("fingerprint", dict(reversed(NOVEL_METADATA.items())))
+    assert cached is not None
+    entry, tier = cached
+    assert tier == CacheTier.MEMORY
+    assert (entry.response_content, entry.model_name, entry.output_tokens) == ({"title": "Novel"}, "fallback-model", 5)
+
+    # Another prompt or another input is a miss, it falls through to the db tier
+    with mock.patch.object(LLMResponseCacheEntry, "load", return_value=None) as load:
+        assert cache.lookup("another-fingerprint", NOVEL_METADATA) is None
+        assert cache.lookup("fingerprint", {**NOVEL_METADATA, "title_raw": "新小说"}) is None
+    assert load.call_count == 2
+
+
+def run_sync_translation(text: dict) -> TranslatorMetadata:
+    return Translator().run_translation(text, PROMPT_NAME)
+
+
+def run_async_translation(text: dict) -> TranslatorMetadata:
+    async def run():
+        return await AsyncTranslator().run_translation(text, PROMPT_NAME)
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("run_translation", [run_sync_translation, run_async_translation], ids=["sync", "async"])
+def test_a_response_served_after_a_fallback_is_a_hit_next_time(db: Database, mock_llm: MockLLMServer, monkeypatch, run_translation):
+    mock_llm.config.failing_models = {"failing-model"}
+    Provider(url=mock_llm.url, key="mock-key", provider="mock", name="mock", model_names=["failing-model", "mock-model"]).update(db)
+    PromptSchema.load(db, query={"prompt_name": PROMPT_NAME}, load_from_file=True).update(db) # type: ignore
+
+    first = run_translation(NOVEL_METADATA)
+    assert not first.cache_hit and first.model_name == "mock-model"
+    assert mock_llm.n_requests == 2
+
+    # A fresh router ranks the failing model first again, as a new worker process would
+    monkeypatch.setattr(router, "_router", None)
+    second = run_translation(NOVEL_METADATA)
+    assert second.cache_hit and second.cache_tier == CacheTier.MEMORY
+    assert second.llm_call_metadata.response_content == first.llm_call_metadata.response_content
+    assert mock_llm.n_requests == 2
+
+    third = run_translation({**NOVEL_METADATA, "title_raw": "新小说"})
+    assert not third.cache_hit
+    assert mock_llm.n_requests == 4
@@ -0,0 +1,63 @@
+import datetime
+from typing import List
+
+from bson import ObjectId
+from pymongo.database import Database
+
+from nos.schemas.chapter_schema import ChapterData, ChapterSegment
+from nos.schemas.enums import TranlsationStatus, UpsertStatus
+
+
+def make_chapter(novel_id: ObjectId, **kwargs) -> ChapterData:
+    return ChapterData(**{
+        "novel_id": novel_id,
+        "source_name": "test",
+        "chapter_source_id": "1",
+        "chapter_url": "https://www.1qxs.com/xs/1/1.html",
+        "chapter_idx": 0,
+        "title_raw": "第一章",
+        "content_raw": "少年踏上修仙之路。\n\n他来到了山门。",
+        "fingerprint": "test-1-1",
+        **kwargs,
+    })
+
+
+def make_translated_chapter(novel_id: ObjectId) -> ChapterData:
+    return make_chapter(
+        novel_id,
+        title="Chapter One",
+        content="The young man set off on the path of cultivation.",
+        segments=[ChapterSegment(segment_idx=0, text_raw="少年踏上修仙之路。", text="The young man set off on the path of cultivation.", status=TranlsationStatus.COMPLETED)],
+        translation_status=TranlsationStatus.COMPLETED,
+        dispatched_at=datetime.datetime.now(),
+    )
+
+
+def rescrape(db: Database, chapter: ChapterData, **changes) -> List[UpsertStatus]:
+    """ Write the chapter the way the scraper pipeline does, as if it was scraped again with changes """
+    scraped = ChapterData(**{**chapter.model_dump(include={*ChapterData._raw_fields, "fingerprint"}), **changes})
+    return ChapterData.bulk_upsert_changes(db, [scraped], key_fields=["fingerprint"], update_fields=ChapterData._raw_fields, reset_on_change=ChapterData._reset_on_change) # type: ignore
+
+
+def test_a_changed_content_is_translated_again(db: Database):
+    chapter = make_translated_chapter(ObjectId())
+    chapter.update(db)
+
+    assert rescrape(db, chapter, content_raw="少年踏上修仙之路。\n\n他来到了宗门。") == [UpsertStatus.UPDATED]
+    saved: ChapterData = ChapterData.load(db, query={"_id": chapter.id}) # type: ignore
+    # The old segments no longer match the content, so the chapter is segmented again
+    assert (saved.content, saved.segments, saved.translation_status, saved.dispatched_at) == (None, [], TranlsationStatus.PENDING, None)
+    assert saved.title == "Chapter One"
+
+
+def test_a_changed_title_keeps_the_translated_segments(db: Database):
+    chapter = make_translated_chapter(ObjectId())
+    chapter.update(db)
+
+    assert rescrape(db, chapter, title_raw="第一章 入门") == [UpsertStatus.UPDATED]
+    saved: ChapterData = ChapterData.load(db, query={"_id": chapter.id}) # type: ignore
+    assert (saved.title, saved.translation_status) == (None, TranlsationStatus.PENDING)
+    assert saved.segments == chapter.segments and saved.content == chapter.content
+
+    # Scraped again without changes, the translation is left alone
+    assert rescrape(db, saved) == [UpsertStatus.UNCHANGED]
@@ -0,0 +1,43 @@
+import os
+import sys
+import subprocess
+from unittest import mock
+
+from nos.utils.db_utils import LazyDatabase
+
+# Run in a fresh interpreter, the test process has imported nos.config and celery long before this test
+IMPORT_CONFIG = """
+import sys
+from unittest import mock
+
+import pymongo
+
+with mock.patch.object(pymongo.MongoClient, "__init__", side_effect=AssertionError("nos.config connected to the db on import")):
+    import nos.config
+
+assert not nos.config.db.connected
+assert "celery" not in sys.modules, "nos.config imported celery"
+"""
+
+
+def test_importing_the_config_neither_connects_nor_imports_celery():
+    # A complete db config, so a connection on import would get as far as the client
+    env = {**os.environ, "MONGO_HOST": "127.0.0.1", "MONGO_PORT": "1", "MONGO_USERNAME": "nos", "MONGO_PASSWORD": "nos", "MONGO_DB_NAME": "nos", "MONGO_AUTH_SOURCE": "admin"}
+    result = subprocess.run([sys.executable, "-c", IMPORT_CONFIG], env=env, capture_output=True, text=True, timeout=60, cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert result.returncode == 0, result.stderr
+
+
+def test_a_forked_process_gets_a_db_of_its_own(monkeypatch):
+    parent_db, child_db = mock.MagicMock(), mock.MagicMock()
+    connect = mock.MagicMock(side_effect=[parent_db, child_db])
+    db = LazyDatabase(connect)
+    assert not db.connected and connect.call_count == 0
+
+    assert db.get() is db.get() is parent_db
+    assert connect.call_count == 1
+
+    parent_pid = os.getpid()
+    monkeypatch.setattr(os, "getpid", lambda: parent_pid + 1)
+    assert not db.connected
+    assert db.get() is db.get() is child_db
+    assert connect.call_count == 2
@@ -0,0 +1,146 @@
+from typing import Iterator, List, Optional
+from unittest import mock
+
+import pytest
+from bson import ObjectId
+
+from nos.celery_tasks import dispatchers
+from nos.schemas.scraping_schema import NovelData
+from nos.schemas.secrets_schema import Provider
+
+
+def make_novels(n_novels: int) -> List[NovelData]:
+    return [NovelData.model_construct(id=ObjectId()) for _ in range(n_novels)]
+
+
+def get_sent_chunks(task: mock.MagicMock) -> List[List[str]]:
+    return [call.args[0] for call in task.delay.call_args_list]
+
+
+def test_novels_are_sent_in_chunks_to_the_concurrent_task():
+    novels = make_novels(45)
+    with mock.patch.object(dispatchers, "NOVEL_METADATA_BATCH_MODE", False), \
+            mock.patch.object(dispatchers, "NOVEL_METADATA_CONCURRENT_MAX_NOVELS", 20), \
+            mock.patch.object(dispatchers, "translate_novels_metadata") as translate_novels_metadata, \
+            mock.patch.object(dispatchers, "translate_novel_metadata_batch") as translate_novel_metadata_batch:
+        dispatchers.send_novel_metadata_tasks(novels)
+
+    assert [len(chunk) for chunk in get_sent_chunks(translate_novels_metadata)] == [20, 20, 5]
+    assert sum(get_sent_chunks(translate_novels_metadata), []) == [str(novel.id) for novel in novels]
+    translate_novel_metadata_batch.delay.assert_not_called()
+
+
+def test_novels_are_sent_in_batches_in_the_batch_mode():
+    novels = make_novels(25)
+    with mock.patch.object(dispatchers, "NOVEL_METADATA_BATCH_MODE", True), \
+            mock.patch.object(dispatchers, "NOVEL_METADATA_BATCH_MAX_NOVELS", 10), \
+            mock.patch.object(dispatchers, "translate_novels_metadata") as translate_novels_metadata, \
+            mock.patch.object(dispatchers, "translate_novel_metadata_batch") as translate_novel_metadata_batch:
+        dispatchers.send_novel_metadata_tasks(novels)
+
+    assert [len(chunk) for chunk in get_sent_chunks(translate_novel_metadata_batch)] == [10, 10, 5]
+    translate_novels_metadata.delay.assert_not_called()
+
+
+class FakeInspect:
+    """ What celery_app.control.inspect() reports of two workers, one of them not consuming the translations queue """
+
+    def __init__(self):
+        self.n_calls = 0
+
+    def active_queues(self):
+        self.n_calls += 1
+        return {
+            "translator@a": [{"name": dispatchers.TRANSLATIONS_QUEUE}],
+            "translator@b": [{"name": "celery"}, {"name": dispatchers.TRANSLATIONS_QUEUE}],
+            "scraper@c": [{"name": "celery"}],
+        }
+
+    def stats(self):
+        return {
+            "translator@a": {"pool": {"max-concurrency": 4}},
+            "translator@b": {"pool": {"max-concurrency": 2}},
+            "scraper@c": {"pool": {"max-concurrency": 8}},
+        }
+
+
+@pytest.fixture
+def redis_client() -> Iterator[mock.MagicMock]:
+    """ A redis client with no cached worker concurrency and an empty translations queue """
+    redis_client = mock.MagicMock()
+    redis_client.get.return_value = None
+    redis_client.llen.return_value = 0
+    with mock.patch.object(dispatchers, "get_redis_client", return_value=redis_client):
+        yield redis_client
+
+
+@pytest.fixture
+def inspect() -> Iterator[FakeInspect]:
+    inspect = FakeInspect()
+    with mock.patch.object(dispatchers.celery_app.control, "inspect", return_value=inspect):
+        yield inspect
+
+
+def test_the_worker_concurrency_is_counted_over_the_translation_workers_and_cached(redis_client: mock.MagicMock, inspect: FakeInspect):
+    assert dispatchers.get_translation_worker_concurrency() == 6
+    redis_client.set.assert_called_once_with(dispatchers.WORKER_CONCURRENCY_CACHE_KEY, 6, ex=dispatchers.DISPATCHER_WORKER_CONCURRENCY_CACHE_TTL)
+
+    # While it is cached, the workers are not inspected again
+    redis_client.get.return_value = b"6"
+    assert dispatchers.get_translation_worker_concurrency() == 6
+    assert inspect.n_calls == 1
+
+
+def test_the_free_slots_are_what_the_queue_has_left(redis_client: mock.MagicMock, inspect: FakeInspect):
+    with mock.patch.object(dispatchers, "DISPATCHER_QUEUED_TASKS_PER_SLOT", 2):
+        assert dispatchers.get_free_translation_slots() == 12
+        redis_client.llen.return_value = 5
+        assert dispatchers.get_free_translation_slots() == 7
+        # A queue that is fuller than it should be has no free slots, rather than a negative number of them
+        redis_client.llen.return_value = 50
+        assert dispatchers.get_free_translation_slots() == 0
+
+
+def test_there_are_no_free_slots_without_translation_workers(redis_client: mock.MagicMock):
+    redis_client.get.return_value = b"0"
+    assert dispatchers.get_free_translation_slots() == 0
+    # The queue is not even looked at
+    redis_client.llen.assert_not_called()
+
+
+@pytest.mark.parametrize("batch_mode, free_slots, request_budget, expected", [
+    # Every task translates NOVEL_METADATA_CONCURRENT_MAX_NOVELS novels, one request each
+    (False, 2, None, 40),
+    (False, 20, None, 200),
+    (False, 20, 15, 15),
+    (False, 0, 15, 0),
+    # Every task translates NOVEL_METADATA_BATCH_MAX_NOVELS novels, in as many requests as it packs them into
+    (True, 3, None, 30),
+    (True, 3, 2, 20),
+    (True, 3, 0, 0),
+])
+def test_the_dispatch_is_sized_to_the_free_slots_and_the_request_budget(batch_mode: bool, free_slots: int, request_budget: Optional[int], expected: int):
+    with mock.patch.object(dispatchers, "get_free_translation_slots", return_value=free_slots), \
+            mock.patch.object(dispatchers, "get_provider_request_budget", return_value=request_budget), \
+            mock.patch.object(dispatchers, "NOVEL_METADATA_BATCH_MODE", batch_mode), \
+            mock.patch.object(dispatchers, "NOVEL_METADATA_CONCURRENT_MAX_NOVELS", 20), \
+            mock.patch.object(dispatchers, "NOVEL_METADATA_BATCH_MAX_NOVELS", 10), \
+            mock.patch.object(dispatchers, "DISPATCHER_MAX_NOVELS_PER_RUN", 200):
+        assert dispatchers.get_novel_metadata_dispatch_size() == expected
+
+
+def make_provider(request_budget: Optional[int], n_requests_made: int=0) -> Provider:
+    provider = Provider(url="http://127.0.0.1:1/v1", key=str(ObjectId()), provider="mock", name="mock", model_names=["mock-model"], request_budget=request_budget)
+    provider.rate_limit_info.n_requests_made_since_last_reset = n_requests_made
+    return provider
+
+
+def test_the_request_budget_is_what_the_providers_have_left():
+    with mock.patch.object(Provider, "load", return_value=[make_provider(100, n_requests_made=30), make_provider(10, n_requests_made=50)]):
+        assert dispatchers.get_provider_request_budget() == 70
+    # A single provider without a known budget makes the budget unknown
+    with mock.patch.object(Provider, "load", return_value=[make_provider(100), make_provider(None)]):
+        assert dispatchers.get_provider_request_budget() is None
+    # Every provider is rate limited
+    with mock.patch.object(Provider, "load", return_value=None):
+        assert dispatchers.get_provider_request_budget() == 0
@@ -0,0 +1,82 @@
+import json
+from typing import Any, List, Tuple
+
+import pytest
+
+from nos.utils.json_utils import IncrementalJSONObjectParser
+
+# Every kind of string that could throw the bracket and string tracking off
+TEXT = json.dumps({
+    "修仙": "Cultivation",
+    "quote": 'He said "run", then {left}',
+    "backslash": "C:\\novels\\",
+    "escaped quote at the end\\\"": "\\\"",
+    # Dumped as \u0001, and as an escaped backslash followed by u0000
+    "unicode": "玄幻 \x01 \\u0000",
+    "nested": {"a": [1, {"b": "]}"}], "c": {}},
+    "list": [[], [1, 2], ["x,y"]],
+    "number": -1.5e3,
+    "null": None,
+}, ensure_ascii=False, indent=2)
+
+
+def feed_in_chunks(text: str, chunk_size: int) -> Tuple[IncrementalJSONObjectParser, List[Tuple[str, Any]]]:
+    parser = IncrementalJSONObjectParser()
+    items = []
+    for start in range(0, len(text), chunk_size):
+        items.extend(parser.feed(text[start:start + chunk_size]))
+    return parser, items
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, len(TEXT)])
+def test_every_pair_is_parsed_whatever_the_chunk_boundaries(chunk_size: int):
+    parser, items = feed_in_chunks(TEXT, chunk_size)
+    assert items == list(json.loads(TEXT).items())
+    assert parser.close() == json.loads(TEXT)
+
+
+def test_a_split_between_a_backslash_and_the_escaped_quote_stays_in_the_string():
+    parser = IncrementalJSONObjectParser()
+    assert parser.feed('{"title": "a \\') == []
+    assert parser.feed('", b", "author": "c"') == [("title", 'a ", b')]
+    assert parser.feed("}") == [("author", "c")]
+
+
+def test_a_pair_is_returned_as_soon_as_it_is_complete():
+    parser = IncrementalJSONObjectParser()
+    assert parser.feed('{"nested": {"a": 1, "b": [2,') == []
+    assert parser.feed(' 3]}, "next"') == [("nested", {"a": 1, "b": [2, 3]})]
+    assert parser.feed(": true }  \n") == [("next", True)]
+    assert parser.close() == {"nested": {"a": 1, "b": [2, 3]}, "next": True}
+
+
+@pytest.mark.parametrize("text", ["{}", " { } "])
+def test_an_empty_object_has_no_pairs(text: str):
+    parser = IncrementalJSONObjectParser()
+    assert parser.feed(text) == []
+    assert parser.close() == {}
+
+
+def test_an_empty_or_unterminated_text_is_not_an_object():
+    parser = IncrementalJSONObjectParser()
+    assert parser.feed("") == []
+    with pytest.raises(json.JSONDecodeError):
+        parser.close()
+
+    parser.feed('{"title": "Novel"')
+    with pytest.raises(json.JSONDecodeError):
+        parser.close()
+
+
+@pytest.mark.parametrize("text", [
+    "Sure! Here is the translation: {",
+    '["title", "Novel"]',
+    '{"title" "Novel",',
+    '{"title": Novel,',
+    '{"title": "Novel"} and some more',
+    '{"title": "Novel"}{',
+])
+def test_the_stream_is_aborted_as_soon_as_it_can_no_longer_be_an_object(text: str):
+    parser = IncrementalJSONObjectParser()
+    with pytest.raises(json.JSONDecodeError):
+        parser.feed(text)
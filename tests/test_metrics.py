@@ -0,0 +1,83 @@
+import os
+import json
+
+import pytest
+
+from nos.utils import metrics
+from nos.utils.metrics import Counter, Gauge, Histogram, MetricsRegistry, merge_snapshots, read_child_snapshots, render_metrics
+
+
+def test_a_registry_renders_as_prometheus_text():
+    registry = MetricsRegistry()
+    requests = Counter("nos_test_requests_total", "The requests", ["provider", "result"], registry=registry)
+    depth = Gauge("nos_test_queue_depth", "The queue depth", registry=registry)
+    latency = Histogram("nos_test_latency_seconds", "The latency", ["provider"], buckets=(1, 0.5), registry=registry)
+
+    requests.inc(provider="mock", result="success")
+    requests.inc(2, provider="mock", result="success")
+    # The label values are escaped
+    requests.inc(provider='a "quoted"\\path\nwith a newline', result="error")
+    depth.set(7)
+    for value in (0.2, 0.7, 3):
+        latency.observe(value, provider="mock")
+
+    assert render_metrics(merge_snapshots([registry.snapshot()])) == "\n".join([
+        "# HELP nos_test_latency_seconds The latency",
+        "# TYPE nos_test_latency_seconds histogram",
+        'nos_test_latency_seconds_bucket{provider="mock",le="0.5"} 1',
+        'nos_test_latency_seconds_bucket{provider="mock",le="1"} 2',
+        'nos_test_latency_seconds_bucket{provider="mock",le="+Inf"} 3',
+        'nos_test_latency_seconds_sum{provider="mock"} 3.9',
+        'nos_test_latency_seconds_count{provider="mock"} 3',
+        "# HELP nos_test_queue_depth The queue depth",
+        "# TYPE nos_test_queue_depth gauge",
+        "nos_test_queue_depth 7",
+        "# HELP nos_test_requests_total The requests",
+        "# TYPE nos_test_requests_total counter",
+        'nos_test_requests_total{provider="a \\"quoted\\"\\\\path\\nwith a newline",result="error"} 1',
+        'nos_test_requests_total{provider="mock",result="success"} 3',
+    ]) + "\n"
+
+
+def test_an_update_must_pass_all_the_labels():
+    counter = Counter("nos_test_total", "A counter", ["provider"], registry=MetricsRegistry())
+    with pytest.raises(ValueError):
+        counter.inc(model="mock-model")
+
+
+def make_child_registry() -> MetricsRegistry:
+    registry = MetricsRegistry()
+    Counter("nos_test_requests_total", "The requests", ["provider"], registry=registry)
+    Gauge("nos_test_queue_depth", "The queue depth", registry=registry)
+    Histogram("nos_test_latency_seconds", "The latency", buckets=(1,), registry=registry)
+    return registry
+
+
+def test_the_snapshots_of_the_worker_processes_are_merged(tmp_path, monkeypatch):
+    first, second = make_child_registry(), make_child_registry()
+    first._metrics["nos_test_requests_total"].inc(2, provider="mock") # type: ignore
+    second._metrics["nos_test_requests_total"].inc(3, provider="mock") # type: ignore
+    second._metrics["nos_test_requests_total"].inc(provider="other") # type: ignore
+    first._metrics["nos_test_latency_seconds"].observe(0.5) # type: ignore
+    second._metrics["nos_test_latency_seconds"].observe(2) # type: ignore
+    second._metrics["nos_test_queue_depth"].set(4) # type: ignore
+    first._metrics["nos_test_queue_depth"].set(10) # type: ignore
+    # The depth the second process set last wins, whichever snapshot is read first
+    first_depth, set_at = first._metrics["nos_test_queue_depth"]._values[()] # type: ignore
+    first._metrics["nos_test_queue_depth"]._values[()] = (first_depth, set_at - 60) # type: ignore
+
+    # The worker processes write their snapshots to the metrics dir of their parent, which is this process here
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    children_dir = metrics.get_process_metrics_dir(os.getpid())
+    os.makedirs(children_dir)
+    for pid, registry in ((101, first), (102, second)):
+        with open(os.path.join(children_dir, f"{pid}.json"), "w") as f:
+            json.dump(registry.snapshot(), f)
+    # A snapshot that is still being written is skipped
+    with open(os.path.join(children_dir, "103.json.tmp"), "w") as f:
+        f.write("{")
+
+    merged = merge_snapshots(read_child_snapshots())
+    assert merged["nos_test_requests_total"]["values"] == {("mock",): 5, ("other",): 1}
+    assert merged["nos_test_latency_seconds"]["values"] == {(): ([1, 1], 2.5, 2)}
+    assert merged["nos_test_queue_depth"]["values"][()][0] == 4
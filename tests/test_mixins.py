@@ -0,0 +1,178 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from unittest import mock
+
+from bson import ObjectId
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
+
+from nos.schemas.enums import UpsertStatus
+from nos.schemas.mixins import DUPLICATE_KEY_ERROR_CODE
+from nos.schemas.scraping_schema import NovelData, NovelRawData
+
+UNCLAIMED_QUERY = {"all_data_parsed": False, "dispatched_at": None}
+
+
+def make_novel(idx: int, **kwargs) -> NovelData:
+    return NovelData(**{
+        "source_name": "test",
+        "novel_source_id": str(idx),
+        "novel_url": f"https://www.1qxs.com/xs/{idx}.html",
+        "chapter_list_url": f"https://www.1qxs.com/list/{idx}.html",
+        "image_url": f"https://img.1qxs.com/cover/{idx}.jpg",
+        "title_raw": f"小说{idx}",
+        "author_raw": "作者",
+        "description_raw": "少年踏上修仙之路",
+        "classification_raw": ["玄幻"],
+        "tags_raw": ["修仙"],
+        "fingerprint": f"test-{idx}",
+        **kwargs,
+    })
+
+
+def seed_novels(db: Database, n_novels: int) -> List[NovelData]:
+    novels = [make_novel(idx) for idx in range(n_novels)]
+    NovelData.bulk_update(db, novels)
+    return novels
+
+
+def claim(db: Database, limit: int, **kwargs) -> List[NovelData]:
+    return NovelData.claim_many(db, query=UNCLAIMED_QUERY, update={"$set": {"dispatched_at": datetime.datetime.now()}}, limit=limit, **kwargs)
+
+
+def test_claim_many_claims_up_to_the_limit(db: Database):
+    novels = seed_novels(db, 5)
+
+    claimed = claim(db, limit=3, sort=[("novel_source_id", 1)])
+    assert [novel.id for novel in claimed] == [novel.id for novel in novels[:3]]
+    # The documents are returned after the update
+    assert all(novel.dispatched_at is not None and novel.title_raw for novel in claimed)
+
+    # Only the rest is left to claim, and nothing after that
+    assert {novel.id for novel in claim(db, limit=10)} == {novel.id for novel in novels[3:]}
+    assert claim(db, limit=10) == []
+
+
+def test_claim_many_loads_only_the_projection(db: Database):
+    seed_novels(db, 2)
+    claimed = claim(db, limit=2, projection={"_id": 1})
+    assert len(claimed) == 2
+    assert all(novel.id is not None and "title_raw" not in novel.__dict__ for novel in claimed)
+
+
+def test_concurrent_claims_never_claim_the_same_document(db: Database):
+    novels = seed_novels(db, 200)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        claims = list(executor.map(lambda _: claim(db, limit=40, projection={"_id": 1}), range(8)))
+
+    claimed_ids = [novel.id for claimed in claims for novel in claimed]
+    assert len(claimed_ids) == len(set(claimed_ids))
+    # A claim only loses the documents the others claimed in between, so the claims keep going till all are taken
+    claimed_ids += [novel.id for novel in claim(db, limit=len(novels), projection={"_id": 1})]
+    assert sorted(claimed_ids) == sorted(novel.id for novel in novels)
+
+
+def upsert_changes(db: Database, novels: List[NovelRawData]) -> List[UpsertStatus]:
+    """ The way the scraper pipeline writes novels """
+    return NovelRawData.bulk_upsert_changes(db, novels, key_fields=["fingerprint"], update_fields=NovelRawData._raw_fields, reset_on_change=NovelRawData._reset_on_change) # type: ignore
+
+
+def to_raw(novel: NovelData) -> NovelRawData:
+    return NovelRawData(**novel.model_dump(exclude={"id"}, include=set(NovelRawData.model_fields)))
+
+
+def test_upsert_changes_reports_what_happened_to_every_document(db: Database):
+    novels = seed_novels(db, 2)
+    scraped = [to_raw(novels[0]), to_raw(novels[1]), to_raw(make_novel(2))]
+    scraped[1].tags_raw = ["修仙", "穿越"]
+
+    assert upsert_changes(db, scraped) == [UpsertStatus.UNCHANGED, UpsertStatus.UPDATED, UpsertStatus.INSERTED]
+    # Every object gets the id of its document
+    assert [novel.id for novel in scraped[:2]] == [novel.id for novel in novels]
+    assert NovelData.load(db, query={"_id": scraped[2].id}) is not None
+
+    # Nothing changed since, so nothing is written
+    collection_type = type(db[NovelData._collection_name])
+    with mock.patch.object(collection_type, "bulk_write", side_effect=AssertionError("wrote an unchanged document")):
+        assert upsert_changes(db, scraped) == [UpsertStatus.UNCHANGED] * 3
+
+
+def test_a_changed_raw_field_resets_its_translation(db: Database):
+    novel = make_novel(0, all_data_parsed=True, dispatched_at=datetime.datetime.now(), title="Novel", tags=["Cultivation"])
+    novel.update(db)
+
+    scraped = to_raw(novel)
+    scraped.tags_raw = ["修仙", "穿越"]
+    upsert_changes(db, [scraped])
+    saved: NovelData = NovelData.load(db, query={"_id": novel.id}) # type: ignore
+    # Only the tags are translated again
+    assert (saved.tags_raw, saved.tags, saved.all_data_parsed, saved.title) == (["修仙", "穿越"], [], True, "Novel")
+
+    scraped.description_raw = "少年穿越到修仙世界"
+    upsert_changes(db, [scraped])
+    saved = NovelData.load(db, query={"_id": novel.id}) # type: ignore
+    assert (saved.description_raw, saved.all_data_parsed, saved.dispatched_at) == ("少年穿越到修仙世界", False, None)
+    # The translation is only overwritten by the next one
+    assert saved.title == "Novel"
+
+
+def make_collection(*found: List[dict]) -> mock.MagicMock:
+    """ A collection whose successive finds return found, as if another writer was writing the same keys """
+    collection = mock.MagicMock()
+    collection.find.side_effect = list(found)
+    return collection
+
+
+def duplicate_key_error(index: int) -> BulkWriteError:
+    return BulkWriteError({"writeErrors": [{"index": index, "code": DUPLICATE_KEY_ERROR_CODE, "errmsg": "E11000 duplicate key error"}], "upserted": []})
+
+
+def test_write_changes_retries_a_document_inserted_by_another_writer():
+    novel = to_raw(make_novel(0))
+    collection = make_collection([])
+    collection.bulk_write.side_effect = duplicate_key_error(0)
+
+    statuses, retry_idxs = NovelRawData._write_changes(collection, [novel], ["fingerprint"], NovelRawData._raw_fields, NovelRawData._reset_on_change)
+    assert (statuses, retry_idxs) == ([None], [0])
+
+
+def test_write_changes_retries_an_upsert_that_matched_instead_of_inserting():
+    novels = [to_raw(make_novel(0)), to_raw(make_novel(1))]
+    collection = make_collection([])
+    # Another writer inserted the first novel after it was read, so its upsert updated the document of the other writer
+    collection.bulk_write.return_value = BulkWriteResult({"upserted": [{"index": 1, "_id": ObjectId()}]}, acknowledged=True)
+
+    statuses, retry_idxs = NovelRawData._write_changes(collection, novels, ["fingerprint"], NovelRawData._raw_fields, NovelRawData._reset_on_change)
+    assert (statuses, retry_idxs) == ([None, UpsertStatus.INSERTED], [0])
+    assert novels[1].id is not None
+
+
+def test_write_changes_does_not_retry_other_write_errors():
+    novel = to_raw(make_novel(0))
+    collection = make_collection([])
+    collection.bulk_write.side_effect = BulkWriteError({"writeErrors": [{"index": 0, "code": 121, "errmsg": "Document failed validation"}], "upserted": []})
+
+    statuses, retry_idxs = NovelRawData._write_changes(collection, [novel], ["fingerprint"], NovelRawData._raw_fields, NovelRawData._reset_on_change)
+    assert (statuses, retry_idxs) == ([None], [])
+
+
+def test_upsert_changes_reads_a_lost_race_again_and_gives_up_after_one_retry():
+    first, second = to_raw(make_novel(0)), to_raw(make_novel(1))
+    winner_id = ObjectId()
+    # The other writer inserted the first novel with another description, and keeps winning the second one
+    collection = make_collection([], [{"_id": winner_id, **first.model_dump(exclude={"id"}), "description_raw": "旧的简介"}])
+    collection.bulk_write.side_effect = [duplicate_key_error(0), BulkWriteError({"writeErrors": [{"index": 1, "code": DUPLICATE_KEY_ERROR_CODE, "errmsg": "E11000 duplicate key error"}], "upserted": []})]
+    db = mock.MagicMock()
+    db.__getitem__.return_value = collection
+
+    statuses = upsert_changes(db, [first, second])
+    assert statuses == [UpsertStatus.UPDATED, None]
+    assert first.id == winner_id and second.id is None
+    # The retry only writes the lost documents, and the changed one gets its reset fields
+    assert collection.bulk_write.call_count == 2
+    assert collection.find.call_count == 2
+    first_update = collection.bulk_write.call_args_list[1].args[0][0]
+    assert first_update._filter == {"_id": winner_id}
+    assert first_update._doc["$set"] == {"description_raw": first.description_raw, "all_data_parsed": False, "dispatched_at": None}
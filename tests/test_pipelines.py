@@ -0,0 +1,49 @@
+from typing import Dict
+from unittest import mock
+
+from pymongo.database import Database
+
+from nos.schemas.scraping_schema import NovelData, NovelRawData
+from nos.scraping.pipelines import NovelRawDataPipeline
+
+
+def make_novel(idx: int, **kwargs) -> NovelRawData:
+    return NovelRawData(**{
+        "source_name": "test",
+        "novel_source_id": str(idx),
+        "novel_url": f"https://www.1qxs.com/xs/{idx}.html",
+        "chapter_list_url": f"https://www.1qxs.com/list/{idx}.html",
+        "image_url": f"https://img.1qxs.com/cover/{idx}.jpg",
+        "title_raw": f"小说{idx}",
+        "author_raw": "作者",
+        "description_raw": "少年踏上修仙之路",
+        "classification_raw": ["玄幻"],
+        "tags_raw": ["修仙"],
+        "fingerprint": f"test-{idx}",
+        **kwargs,
+    })
+
+
+def make_pipeline() -> NovelRawDataPipeline:
+    pipeline = NovelRawDataPipeline(stats=mock.MagicMock())
+    pipeline.spider = mock.MagicMock()
+    return pipeline
+
+
+def get_stats(pipeline: NovelRawDataPipeline) -> Dict[str, int]:
+    return {call.args[0]: call.args[1] for call in pipeline.stats.inc_value.call_args_list} # type: ignore
+
+
+def test_the_stats_count_what_happened_to_every_novel(db: Database):
+    NovelData(**make_novel(0, all_data_parsed=True).model_dump(exclude={"id"})).update(db)
+    NovelData(**make_novel(1, all_data_parsed=True).model_dump(exclude={"id"})).update(db)
+
+    pipeline = make_pipeline()
+    # The novel scraped twice in the batch is written once
+    pipeline.write_items([make_novel(0), make_novel(1, description_raw="少年穿越到修仙世界"), make_novel(2), make_novel(2)])
+    assert get_stats(pipeline) == {"nos/novels_inserted": 1, "nos/novels_updated": 1, "nos/novels_unchanged": 1, "nos/novels_failed": 0}
+
+    # Only the changed novel is queued for translation again
+    saved = {novel.novel_source_id: novel for novel in NovelData.load(db, query={}, many=True)} # type: ignore
+    assert (saved["0"].all_data_parsed, saved["1"].all_data_parsed, saved["2"].all_data_parsed) == (True, False, False)
+    assert saved["1"].description_raw == "少年穿越到修仙世界"
@@ -0,0 +1,128 @@
+import os
+import datetime
+from typing import Dict, List
+from unittest import mock
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from nos.schemas.secrets_schema import Provider
+from nos.translators import provider_pool
+from nos.translators.provider_pool import ProviderPool
+
+
+def make_provider(name: str) -> Provider:
+    return Provider(_id=ObjectId(), url="http://127.0.0.1:1/v1", key=f"{name}-key", provider="mock", name=name, model_names=["mock-model"])
+
+
+def make_pool(flush_threshold: int=3) -> ProviderPool:
+    return ProviderPool(mock.MagicMock(), flush_interval=3600, flush_threshold=flush_threshold)
+
+
+def get_bulk_write(pool: ProviderPool) -> mock.MagicMock:
+    return pool.db[Provider._collection_name].bulk_write
+
+
+def get_written_increments(pool: ProviderPool) -> List[Dict[ObjectId, dict]]:
+    """ The $inc of every provider, for each bulk write """
+    return [
+        {operation._filter["_id"]: operation._doc["$inc"] for operation in call.args[0]}
+        for call in get_bulk_write(pool).call_args_list
+    ]
+
+
+def test_the_uses_are_written_once_the_threshold_is_pending():
+    pool = make_pool(flush_threshold=3)
+    first, second = make_provider("first"), make_provider("second")
+
+    pool.record_use(first)
+    pool.record_use(second)
+    get_bulk_write(pool).assert_not_called()
+
+    pool.record_use(first)
+    assert get_written_increments(pool) == [{
+        first.id: {"rate_limit_info.n_requests_made": 2, "rate_limit_info.n_requests_made_since_last_reset": 2},
+        second.id: {"rate_limit_info.n_requests_made": 1, "rate_limit_info.n_requests_made_since_last_reset": 1},
+    }]
+    # The in-memory provider is up to date right away
+    assert first.rate_limit_info.n_requests_made == 2
+
+    # Nothing is pending anymore, so the next flush has nothing to write
+    pool.flush()
+    assert get_bulk_write(pool).call_count == 1
+
+
+def test_the_uses_are_written_once_the_flush_interval_passed():
+    pool = ProviderPool(mock.MagicMock(), flush_interval=0, flush_threshold=100)
+    provider = make_provider("first")
+    pool.record_use(provider)
+    assert get_written_increments(pool) == [{provider.id: {"rate_limit_info.n_requests_made": 1, "rate_limit_info.n_requests_made_since_last_reset": 1}}]
+
+
+def test_the_uses_of_a_failed_flush_are_written_by_the_next_one():
+    pool = make_pool(flush_threshold=100)
+    provider = make_provider("first")
+    get_bulk_write(pool).side_effect = [AutoReconnect("connection reset"), None]
+
+    pool.record_use(provider)
+    pool.record_use(provider)
+    pool.flush()
+    # Recorded while the db was down
+    pool.record_use(provider)
+    pool.flush()
+
+    assert get_written_increments(pool)[-1] == {provider.id: {"rate_limit_info.n_requests_made": 3, "rate_limit_info.n_requests_made_since_last_reset": 3}}
+
+
+def test_only_the_failed_operations_of_a_bulk_write_are_kept():
+    pool = make_pool(flush_threshold=100)
+    first, second = make_provider("first"), make_provider("second")
+    error = BulkWriteError({"writeErrors": [{"index": 1, "code": 1, "errmsg": "failed"}], "nInserted": 0, "nUpserted": 0, "nMatched": 1, "nModified": 1, "nRemoved": 0, "upserted": []})
+    get_bulk_write(pool).side_effect = [error, None]
+
+    pool.record_use(first)
+    pool.record_use(second)
+    pool.flush()
+    pool.flush()
+
+    assert get_written_increments(pool)[-1] == {second.id: {"rate_limit_info.n_requests_made": 1, "rate_limit_info.n_requests_made_since_last_reset": 1}}
+
+
+def test_the_latest_request_time_is_kept_when_merging_back():
+    pool = make_pool(flush_threshold=100)
+    provider = make_provider("first")
+    get_bulk_write(pool).side_effect = [AutoReconnect("connection reset"), None]
+
+    pool.record_use(provider)
+    first_request_time = provider.rate_limit_info.last_request_time
+    pool.flush()
+    pool.flush()
+
+    operation: UpdateOne = get_bulk_write(pool).call_args.args[0][0]
+    assert operation._doc["$max"] == {"rate_limit_info.last_request_time": first_request_time}
+
+
+def test_the_pending_uses_are_flushed_on_shutdown(monkeypatch):
+    pool = make_pool(flush_threshold=100)
+    provider = make_provider("first")
+    pool.record_use(provider)
+    monkeypatch.setattr(provider_pool, "_provider_pool", pool)
+
+    # A pool inherited from the parent process belongs to the parent, which flushes it
+    monkeypatch.setattr(provider_pool, "_provider_pool_pid", -1)
+    provider_pool.flush_provider_pool()
+    get_bulk_write(pool).assert_not_called()
+
+    monkeypatch.setattr(provider_pool, "_provider_pool_pid", os.getpid())
+    provider_pool.flush_provider_pool()
+    assert get_written_increments(pool) == [{provider.id: {"rate_limit_info.n_requests_made": 1, "rate_limit_info.n_requests_made_since_last_reset": 1}}]
+
+
+def test_the_uses_since_the_last_reset_are_dropped_when_a_provider_is_exhausted():
+    pool = make_pool(flush_threshold=100)
+    provider = make_provider("first")
+    pool.record_use(provider)
+    pool.mark_exhausted(provider, datetime.datetime.now() + datetime.timedelta(minutes=1))
+    pool.flush()
+    assert get_written_increments(pool) == [{provider.id: {"rate_limit_info.n_requests_made": 1}}]
@@ -0,0 +1,137 @@
+import datetime
+from email.utils import format_datetime
+from typing import Iterator, Optional
+from unittest import mock
+
+import pytest
+from bson import ObjectId
+
+from nos.schemas.secrets_schema import Provider
+from nos.translators import rate_limiter
+from nos.translators.rate_limiter import RateLimiter, RateLimitHeaders, parse_duration, parse_rate_limit_headers, parse_retry_after
+
+
+def make_provider(requests_per_minute: Optional[int]=None) -> Provider:
+    return Provider(_id=ObjectId(), url="http://127.0.0.1:1/v1", key="mock-key", provider="mock", name="mock", model_names=["mock-model", "other-model"], requests_per_minute=requests_per_minute)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1.5", 1.5),
+    ("1s", 1),
+    ("6m0s", 360),
+    ("1h30m", 5400),
+    ("2m30.5s", 150.5),
+    ("20ms", 0.02),
+    (None, None),
+    ("soon", None),
+])
+def test_parse_duration(value: Optional[str], expected: Optional[float]):
+    assert parse_duration(value) == expected
+
+
+def test_parse_retry_after():
+    assert parse_retry_after({"retry-after": "2"}) == 2
+    assert parse_retry_after({"retry-after-ms": "1500", "retry-after": "2"}) == 1.5
+    assert parse_retry_after({"retry-after": "whenever"}) is None
+    assert parse_retry_after({}) is None
+
+    in_a_minute = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=1)
+    assert parse_retry_after({"retry-after": format_datetime(in_a_minute, usegmt=True)}) == pytest.approx(60, abs=2)
+    # A date in the past means the provider can be retried right away
+    a_minute_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=1)
+    assert parse_retry_after({"retry-after": format_datetime(a_minute_ago, usegmt=True)}) == 0
+
+
+def test_parse_rate_limit_headers():
+    headers = parse_rate_limit_headers({
+        "x-ratelimit-limit-requests": "60",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "6m0s",
+        "x-ratelimit-limit-tokens": "150000",
+        "x-ratelimit-remaining-tokens": "149000",
+        "x-ratelimit-reset-tokens": "20ms",
+    })
+    assert headers == RateLimitHeaders(limit_requests=60, remaining_requests=0, reset_requests=360, limit_tokens=150000, remaining_tokens=149000, reset_tokens=0.02)
+    # Missing or garbled headers are unknown rather than an error
+    assert parse_rate_limit_headers({"x-ratelimit-limit-requests": "many"}) == RateLimitHeaders()
+
+
+def test_the_provider_is_blocked_until_the_latest_reset_of_what_ran_out():
+    assert RateLimitHeaders(remaining_requests=5, reset_requests=10).get_blocked_for() is None
+    assert RateLimitHeaders(remaining_requests=0, reset_requests=10, remaining_tokens=100, reset_tokens=30).get_blocked_for() == 10
+    assert RateLimitHeaders(remaining_requests=0, reset_requests=10, remaining_tokens=0, reset_tokens=30).get_blocked_for() == 30
+    # Retry-After is what the provider asked for explicitly
+    assert RateLimitHeaders(remaining_requests=0, reset_requests=10, retry_after=2).get_blocked_for() == 2
+
+
+def test_the_requests_are_let_through_when_redis_is_down():
+    # Nothing listens on port 1, so every call fails to connect
+    limiter = RateLimiter(redis_url="redis://127.0.0.1:1/0")
+    provider = make_provider(requests_per_minute=1)
+
+    assert [limiter.try_acquire(provider, "mock-model") for _ in range(3)] == [0, 0, 0]
+    limiter.observe(provider, RateLimitHeaders(limit_requests=1, remaining_requests=0, reset_requests=60))
+    assert limiter.block(provider, "mock-model", RateLimitHeaders()) == rate_limiter.RATE_LIMIT_DEFAULT_RETRY_AFTER
+
+
+class Clock:
+    """ Stands in for the time module of the rate limiter """
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock() -> Iterator[Clock]:
+    clock = Clock()
+    with mock.patch.object(rate_limiter, "time", clock):
+        yield clock
+
+
+@pytest.fixture
+def limiter() -> RateLimiter:
+    """ A rate limiter running its lua scripts on a fake redis """
+    fakeredis = pytest.importorskip("fakeredis")
+    # fakeredis runs the scripts with lupa
+    pytest.importorskip("lupa")
+    with mock.patch.object(rate_limiter, "get_redis_client", return_value=fakeredis.FakeRedis()):
+        return RateLimiter(window=60)
+
+
+def test_the_bucket_refills_at_the_configured_rate(limiter: RateLimiter, clock: Clock):
+    provider = make_provider(requests_per_minute=2)
+    assert limiter.try_acquire(provider, "mock-model") == 0
+    assert limiter.try_acquire(provider, "mock-model") == 0
+    # The bucket refills a request every 30 seconds
+    assert limiter.try_acquire(provider, "mock-model") == pytest.approx(30)
+
+    clock.now += 30
+    assert limiter.try_acquire(provider, "mock-model") == 0
+
+
+def test_the_bucket_is_unlimited_until_the_provider_reports_its_limit(limiter: RateLimiter, clock: Clock):
+    provider = make_provider()
+    assert all(limiter.try_acquire(provider, "mock-model") == 0 for _ in range(100))
+
+    limiter.observe(provider, RateLimitHeaders(limit_requests=60, remaining_requests=1))
+    assert limiter.try_acquire(provider, "mock-model") == 0
+    assert limiter.try_acquire(provider, "mock-model") == pytest.approx(1)
+
+
+def test_the_provider_is_blocked_till_the_reset_once_it_has_nothing_left(limiter: RateLimiter, clock: Clock):
+    provider = make_provider(requests_per_minute=600)
+    limiter.observe(provider, RateLimitHeaders(remaining_requests=0, reset_requests=20))
+    assert limiter.try_acquire(provider, "mock-model") == pytest.approx(20)
+
+    clock.now += 20
+    assert limiter.try_acquire(provider, "mock-model") == 0
+
+
+def test_a_429_only_blocks_the_model_that_returned_it(limiter: RateLimiter, clock: Clock):
+    provider = make_provider()
+    assert limiter.block(provider, "mock-model", RateLimitHeaders(retry_after=5)) == 5
+    assert limiter.try_acquire(provider, "mock-model") == pytest.approx(5)
+    assert limiter.try_acquire(provider, "other-model") == 0
@@ -0,0 +1,113 @@
+import random
+import datetime
+from typing import List, Optional
+from unittest import mock
+
+import pytest
+from bson import ObjectId
+from pymongo.database import Database
+
+from nos.celery_tasks import rollup_tasks
+from nos.schemas.enums import RollupGranularity, TranlsationStatus
+from nos.schemas.rollup_schema import TranslationRollup, RollupWatermark, LATENCY_BUCKET_MIN, estimate_latency_percentile, get_latency_bucket, get_latency_bucket_bound
+from nos.schemas.translator_schemas import LLMCallResponseSchema, TranslatorMetadata
+
+PROMPT_ID = ObjectId()
+# Long enough ago for the rollup to pick the translator metadata up
+CALL_TIME = datetime.datetime.now().replace(minute=30, second=0, microsecond=0) - datetime.timedelta(days=1)
+
+
+def make_sketch(latencies: List[float]) -> dict:
+    sketch: dict = {}
+    for latency in latencies:
+        key = str(get_latency_bucket(latency))
+        sketch[key] = sketch.get(key, 0) + 1
+    return sketch
+
+
+def make_rollup(latencies: List[float]) -> TranslationRollup:
+    return TranslationRollup(
+        granularity=RollupGranularity.HOUR, bucket_start=CALL_TIME, provider_name="mock", model_name="mock-model", prompt_id=PROMPT_ID, status="completed",
+        n_calls=len(latencies), latency_sum=sum(latencies), latency_counts=make_sketch(latencies),
+    )
+
+
+def get_true_percentile(latencies: List[float], percentile: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+def test_a_latency_falls_in_the_bucket_its_bounds_cover():
+    assert get_latency_bucket(0) == get_latency_bucket(LATENCY_BUCKET_MIN) == 0
+    for idx in (1, 10, 30):
+        assert get_latency_bucket(get_latency_bucket_bound(idx) * 0.99) == idx
+        assert get_latency_bucket(get_latency_bucket_bound(idx) * 1.01) == idx + 1
+    # The last bucket takes anything longer
+    assert get_latency_bucket(1e9) == rollup_tasks.get_latency_bucket(1e9) == 47
+
+
+def test_merged_sketches_estimate_the_percentiles_of_all_the_calls():
+    rng = random.Random(0)
+    fast = [rng.lognormvariate(0, 0.5) for _ in range(2000)]
+    slow = [rng.lognormvariate(2, 0.3) for _ in range(500)]
+
+    rollup = make_rollup(fast)
+    rollup.merge(make_rollup(slow))
+    assert rollup.n_calls == 2500 and rollup.latency_sum == pytest.approx(sum(fast) + sum(slow))
+    # Merging the sketches is the same as sketching all the calls at once
+    assert rollup.latency_counts == make_sketch(fast + slow)
+    for percentile in (50, 90, 99):
+        estimate: Optional[float] = rollup.get_latency_percentile(percentile)
+        assert estimate == pytest.approx(get_true_percentile(fast + slow, percentile), rel=0.13)
+
+
+def test_an_empty_sketch_has_no_percentiles():
+    assert estimate_latency_percentile({}, 50) is None
+
+
+def make_metadata(n_seconds_ago: int, status: TranlsationStatus=TranlsationStatus.COMPLETED, cache_hit: bool=False, latency: float=1.0) -> TranslatorMetadata:
+    """ The ids are old enough to be rolled up, and distinct since ObjectId.from_datetime leaves the rest of the id empty """
+    return TranslatorMetadata(
+        _id=ObjectId.from_datetime(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=2, seconds=n_seconds_ago)),
+        status=status, provider_name="mock", model_name="mock-model", prompt_id=PROMPT_ID, cache_hit=cache_hit,
+        llm_call_metadata=LLMCallResponseSchema(response_content="", input_tokens=100, output_tokens=50, total_time_taken=latency, end_time=CALL_TIME),
+    )
+
+
+def test_cache_hits_are_counted_without_tokens_or_latency():
+    docs = [make_metadata(1).model_dump(), make_metadata(2, cache_hit=True).model_dump()]
+    incs = rollup_tasks.accumulate_rollups(docs)
+    # An hourly and a daily rollup
+    assert len(incs) == 2
+    for inc in incs.values():
+        assert dict(inc) == {"n_calls": 2, "n_cache_hits": 1, "input_tokens": 100, "output_tokens": 50, "latency_sum": 1.0, f"latency_counts.{get_latency_bucket(1.0)}": 1}
+
+
+def insert_metadata(db: Database, metadata: List[TranslatorMetadata]):
+    """ With the ids of the objects, which update would not insert """
+    db[TranslatorMetadata._collection_name].insert_many([{"_id": obj.id, **obj.model_dump()} for obj in metadata])
+
+
+def load_hourly_rollups(db: Database) -> List[TranslationRollup]:
+    return TranslationRollup.load(db, query={"granularity": RollupGranularity.HOUR.value}, many=True) or [] # type: ignore
+
+
+def test_a_batch_is_only_rolled_up_once(db: Database):
+    insert_metadata(db, [make_metadata(idx) for idx in range(1, 11)] + [make_metadata(11, status=TranlsationStatus.FAILED)])
+
+    # The rollups are written but the run dies before it moves the watermark, so the next run reads the same batch
+    with mock.patch.object(RollupWatermark, "save_last_id", side_effect=RuntimeError("worker lost")):
+        with pytest.raises(RuntimeError):
+            rollup_tasks.rollup_translator_metadata()
+    assert rollup_tasks.rollup_translator_metadata() == 11
+    assert rollup_tasks.rollup_translator_metadata() == 0
+
+    rollups = {rollup.status: rollup for rollup in load_hourly_rollups(db)}
+    assert (rollups["completed"].n_calls, rollups["completed"].input_tokens, rollups["failed"].n_calls) == (10, 1000, 1)
+    assert rollups["completed"].bucket_start == CALL_TIME.replace(minute=0)
+
+    # Only what is new is added to the rollups
+    insert_metadata(db, [make_metadata(0, latency=3.0)])
+    assert rollup_tasks.rollup_translator_metadata() == 1
+    rollups = {rollup.status: rollup for rollup in load_hourly_rollups(db)}
+    assert (rollups["completed"].n_calls, rollups["completed"].latency_sum) == (11, 13.0)
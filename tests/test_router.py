@@ -0,0 +1,130 @@
+from typing import List, Optional
+
+import pytest
+from bson import ObjectId
+
+from nos.schemas.prompt_schemas import RoutingConstraints
+from nos.schemas.secrets_schema import Provider
+from nos.schemas.translator_schemas import LLMCallResponseSchema
+from nos.translators import router
+from nos.translators.router import EndpointStats, Route, Router
+
+
+def make_provider(name: str, model_names: List[str], priority: int=0) -> Provider:
+    return Provider(_id=ObjectId(), url="http://127.0.0.1:1/v1", key=f"{name}-key", provider="mock", name=name, model_names=model_names, priority=priority)
+
+
+def succeed(llm_router: Router, provider: Provider, model_name: str, latency: float, output_tokens: Optional[int]=None, n_times: int=1):
+    for _ in range(n_times):
+        llm_router.record_success(provider, model_name, LLMCallResponseSchema(response_content="", total_time_taken=latency, output_tokens=output_tokens))
+
+
+def get_names(routes: List[Route]) -> List[str]:
+    return [f"{provider.name}/{provider.model_names[model_idx]}" for provider, model_idx in routes]
+
+
+def test_the_moving_averages_start_at_the_first_observation(monkeypatch):
+    monkeypatch.setattr(router, "LLM_ROUTER_EWMA_ALPHA", 0.5)
+    stats = EndpointStats()
+    assert (stats.get_latency(), stats.get_throughput()) == (router.LLM_ROUTER_DEFAULT_LATENCY, router.LLM_ROUTER_DEFAULT_THROUGHPUT)
+
+    stats.record_success(2.0, output_tokens=100)
+    assert (stats.get_latency(), stats.get_throughput()) == (2.0, 50.0)
+    stats.record_success(4.0, output_tokens=100)
+    assert (stats.get_latency(), stats.get_throughput()) == (3.0, 37.5)
+    # A call without output tokens says nothing about the throughput
+    stats.record_success(4.0, output_tokens=None)
+    assert (stats.get_latency(), stats.get_throughput()) == (3.5, 37.5)
+
+
+def test_the_error_rate_rises_with_failures_and_decays_without_calls(monkeypatch):
+    monkeypatch.setattr(router, "LLM_ROUTER_EWMA_ALPHA", 0.5)
+    stats = EndpointStats()
+    stats.record_error()
+    stats.record_error()
+    assert stats.get_error_rate() == pytest.approx(0.75, rel=1e-3)
+    stats.record_success(1.0, output_tokens=None)
+    assert stats.get_error_rate() == pytest.approx(0.375, rel=1e-3)
+    assert (stats.n_requests, stats.n_errors) == (3, 2)
+
+    # As if the last call was a half life ago
+    stats.last_update_time -= router.LLM_ROUTER_ERROR_HALF_LIFE
+    assert stats.get_error_rate() == pytest.approx(0.1875, rel=1e-3)
+
+
+def test_the_latency_percentiles_wait_for_enough_samples(monkeypatch):
+    monkeypatch.setattr(router, "LLM_ROUTER_MIN_LATENCY_SAMPLES", 10)
+    llm_router = Router()
+    provider = make_provider("provider", ["model"])
+
+    for latency in range(1, 10):
+        succeed(llm_router, provider, "model", latency)
+    assert llm_router.get_latency_percentile(provider, "model", 50) is None
+
+    succeed(llm_router, provider, "model", 10)
+    assert [llm_router.get_latency_percentile(provider, "model", percentile) for percentile in (0, 50, 90, 100)] == [1, 6, 10, 10]
+
+
+def test_the_latency_percentiles_only_cover_the_window(monkeypatch):
+    monkeypatch.setattr(router, "LLM_ROUTER_LATENCY_WINDOW", 5)
+    monkeypatch.setattr(router, "LLM_ROUTER_MIN_LATENCY_SAMPLES", 5)
+    llm_router = Router()
+    provider = make_provider("provider", ["model"])
+
+    succeed(llm_router, provider, "model", 100, n_times=5)
+    succeed(llm_router, provider, "model", 1, n_times=5)
+    # The slow calls have left the window
+    assert llm_router.get_latency_percentile(provider, "model", 100) == 1
+
+
+def test_unused_endpoints_are_ranked_by_priority_and_model_order():
+    low, high = make_provider("low", ["a", "b"], priority=0), make_provider("high", ["c", "d"], priority=1)
+    assert get_names(Router().rank([low, high])) == ["high/c", "high/d", "low/a", "low/b"]
+
+
+def test_the_faster_endpoint_comes_first():
+    llm_router = Router()
+    slow, fast = make_provider("slow", ["model"], priority=1), make_provider("fast", ["model"])
+    succeed(llm_router, slow, "model", 3.0)
+    succeed(llm_router, fast, "model", 1.0)
+    assert get_names(llm_router.rank([slow, fast])) == ["fast/model", "slow/model"]
+
+
+def test_a_failing_endpoint_is_ranked_below_a_slower_one_until_its_errors_decay(monkeypatch):
+    monkeypatch.setattr(router, "LLM_ROUTER_EWMA_ALPHA", 0.5)
+    monkeypatch.setattr(router, "LLM_ROUTER_ERROR_PENALTY", 10)
+    llm_router = Router()
+    failing, slow = make_provider("failing", ["model"]), make_provider("slow", ["model"])
+    succeed(llm_router, failing, "model", 1.0)
+    llm_router.record_error(failing, "model")
+    succeed(llm_router, slow, "model", 4.0)
+    assert get_names(llm_router.rank([failing, slow])) == ["slow/model", "failing/model"]
+
+    llm_router.get_stats(failing, "model").last_update_time -= 10 * router.LLM_ROUTER_ERROR_HALF_LIFE
+    assert get_names(llm_router.rank([failing, slow])) == ["failing/model", "slow/model"]
+
+
+def test_the_throughput_preference_ranks_by_output_tokens_per_second():
+    llm_router = Router()
+    quick, steady = make_provider("quick", ["model"]), make_provider("steady", ["model"])
+    # The quick one answers sooner, but the steady one writes long outputs faster
+    succeed(llm_router, quick, "model", 1.0, output_tokens=20)
+    succeed(llm_router, steady, "model", 4.0, output_tokens=400)
+    assert get_names(llm_router.rank([quick, steady])) == ["quick/model", "steady/model"]
+    assert get_names(llm_router.rank([quick, steady], RoutingConstraints(prefer="throughput"))) == ["steady/model", "quick/model"]
+
+
+def test_the_constraints_filter_and_demote_the_routes():
+    llm_router = Router()
+    first, second = make_provider("first", ["gpt-mini", "claude"]), make_provider("second-eu", ["gpt-large"])
+    assert get_names(llm_router.rank([first, second], RoutingConstraints(models=["gpt-*"]))) == ["first/gpt-mini", "second-eu/gpt-large"]
+    assert get_names(llm_router.rank([first, second], RoutingConstraints(providers=["*-eu"]))) == ["second-eu/gpt-large"]
+
+    # An endpoint over max_latency is only used after every faster one, however cheap it otherwise is
+    succeed(llm_router, first, "gpt-mini", 10.0, output_tokens=100)
+    succeed(llm_router, first, "claude", 30.0, output_tokens=3000)
+    succeed(llm_router, second, "gpt-large", 15.0, output_tokens=600)
+    assert get_names(llm_router.rank([first, second], RoutingConstraints(prefer="throughput"))) == ["first/claude", "second-eu/gpt-large", "first/gpt-mini"]
+    assert get_names(llm_router.rank([first, second], RoutingConstraints(prefer="throughput", max_latency=20))) == ["second-eu/gpt-large", "first/gpt-mini", "first/claude"]
+    # When every endpoint is too slow, they are ranked as if there was no max_latency
+    assert get_names(llm_router.rank([first, second], RoutingConstraints(prefer="throughput", max_latency=5))) == ["first/claude", "second-eu/gpt-large", "first/gpt-mini"]
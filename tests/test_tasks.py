@@ -0,0 +1,49 @@
+from typing import List
+
+from pymongo.database import Database
+
+from benchmarks.mock_llm import MockLLMServer
+from nos.celery_tasks import tasks
+from nos.schemas.prompt_schemas import PromptSchema
+from nos.schemas.scraping_schema import NovelData
+from nos.schemas.secrets_schema import Provider
+
+MAX_CONCURRENT_REQUESTS = 3
+
+
+def seed_novels(db: Database, n_novels: int) -> List[NovelData]:
+    novels = [
+        NovelData(
+            source_name="test",
+            novel_source_id=str(idx),
+            novel_url=f"https://www.1qxs.com/xs/{idx}.html",
+            chapter_list_url=f"https://www.1qxs.com/list/{idx}.html",
+            image_url=f"https://img.1qxs.com/cover/{idx}.jpg",
+            title_raw=f"小说{idx}",
+            author_raw="作者",
+            description_raw="少年踏上修仙之路",
+            classification_raw=["玄幻"],
+            tags_raw=["修仙"],
+            fingerprint=f"test-{idx}",
+        )
+        for idx in range(n_novels)
+    ]
+    for novel in novels:
+        novel.update(db)
+    return novels
+
+
+def test_translate_novels_metadata_caps_the_requests_in_flight_per_provider(db: Database, mock_llm: MockLLMServer):
+    mock_llm.config.latency = 0.2
+    Provider(url=mock_llm.url, key="mock-key", provider="mock", name="mock", model_names=["mock-model"], max_concurrent_requests=MAX_CONCURRENT_REQUESTS).update(db)
+    PromptSchema.load(db, query={"prompt_name": "novel_metadata_translation"}, load_from_file=True).update(db) # type: ignore
+    novels = seed_novels(db, n_novels=4 * MAX_CONCURRENT_REQUESTS)
+
+    assert tasks.translate_novels_metadata([str(novel.id) for novel in novels]) == len(novels)
+
+    # The novels are translated concurrently, but never more of them at once than the provider allows
+    assert mock_llm.max_in_flight == MAX_CONCURRENT_REQUESTS
+    assert mock_llm.n_requests == len(novels)
+    for novel in novels:
+        saved: NovelData = NovelData.load(db, query={"_id": novel.id}) # type: ignore
+        assert saved.all_data_parsed and saved.title == f"EN {novel.title_raw}"
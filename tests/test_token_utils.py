@@ -0,0 +1,52 @@
+import pytest
+
+from nos.utils.token_utils import PARAGRAPH_SEPARATOR, estimate_tokens, pack_by_token_budget, split_into_segments
+
+
+def test_estimate_tokens_counts_cjk_characters_one_by_one():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("修仙。") == 3
+    # Anything else is roughly 4 characters per token, rounded up
+    assert estimate_tokens("abcde") == 2
+    assert estimate_tokens("修仙 abc") == 3
+
+
+def test_items_are_packed_in_order_within_the_budget():
+    assert pack_by_token_budget([3, 4, 2, 5, 1], lambda x: x, budget=7) == [[3, 4], [2, 5], [1]]
+    # An item that fills the budget exactly still fits
+    assert pack_by_token_budget([7, 7], lambda x: x, budget=7) == [[7], [7]]
+
+
+def test_an_item_over_the_budget_gets_a_batch_of_its_own():
+    assert pack_by_token_budget([2, 10, 3], lambda x: x, budget=5) == [[2], [10], [3]]
+
+
+def test_the_batches_hold_at_most_max_items():
+    assert pack_by_token_budget([1] * 5, lambda x: x, budget=100, max_items=2) == [[1, 1], [1, 1], [1]]
+
+
+def test_nothing_to_pack_makes_no_batches():
+    assert pack_by_token_budget([], lambda x: x, budget=5) == []
+    assert split_into_segments("", budget=5) == []
+    assert split_into_segments("\n  \n\n", budget=5) == []
+
+
+def test_segments_are_cut_on_paragraph_boundaries():
+    paragraphs = ["第一段。", "第二段落。", "第三。"]
+    # Every paragraph and the separator between them cost a token each
+    segments = split_into_segments("\n".join(paragraphs), budget=11)
+    assert segments == [PARAGRAPH_SEPARATOR.join(paragraphs[:2]), paragraphs[2]]
+
+
+@pytest.mark.parametrize("budget", [3, 5, 8])
+def test_a_paragraph_over_the_budget_is_cut_on_sentence_boundaries(budget: int):
+    paragraph = "他走了。她说：“等等！”然后呢？没有了"
+    segments = split_into_segments(paragraph, budget=budget)
+    assert all(estimate_tokens(segment) <= budget for segment in segments)
+    # No text is lost, and nothing is added within a paragraph
+    assert "".join(segments) == paragraph
+
+
+def test_a_sentence_over_the_budget_is_cut_within():
+    sentence = "修" * 12 + "。"
+    assert split_into_segments(sentence, budget=5) == ["修" * 5, "修" * 5, "修修。"]
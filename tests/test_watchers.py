@@ -0,0 +1,153 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, List
+from unittest import mock
+
+import pytest
+from bson import ObjectId
+from pymongo.database import Database
+
+from nos.celery_tasks import watchers
+from nos.celery_tasks.watchers import NovelWatcher
+from nos.schemas.change_stream_schema import ChangeStreamState
+from nos.schemas.scraping_schema import NovelRawData
+
+WATCHER_NAME = "test_novel_watcher"
+
+
+def make_novel(idx: int, **fields) -> NovelRawData:
+    data = {
+        "source_name": "test",
+        "novel_source_id": str(idx),
+        "novel_url": f"https://www.1qxs.com/xs/{idx}.html",
+        "chapter_list_url": f"https://www.1qxs.com/list/{idx}.html",
+        "image_url": f"https://img.1qxs.com/cover/{idx}.jpg",
+        "title_raw": f"小说{idx}",
+        "author_raw": "作者",
+        "description_raw": "少年踏上修仙之路",
+        "classification_raw": ["玄幻"],
+        "tags_raw": ["修仙"],
+        "fingerprint": f"test-{idx}",
+        **fields,
+    }
+    return NovelRawData(**data)
+
+
+def scrape_again(db: Database, novel: NovelRawData):
+    """ Write the novel the way the scraper pipeline does """
+    NovelRawData.bulk_upsert_changes(db, [novel], key_fields=["fingerprint"], update_fields=NovelRawData._raw_fields, reset_on_change=NovelRawData._reset_on_change)
+
+
+def wait_until(check: Callable[[], bool], timeout: float=10):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the watcher")
+        time.sleep(0.05)
+
+
+class Dispatched:
+    """ The novels the watcher dispatched, instead of sending them to celery """
+
+    def __init__(self, send_novel_metadata_tasks: mock.MagicMock, beat_update_tags_of_novels: mock.MagicMock, get_novel_metadata_dispatch_size: mock.MagicMock):
+        self.send_novel_metadata_tasks = send_novel_metadata_tasks
+        self.beat_update_tags_of_novels = beat_update_tags_of_novels
+        # The capacity of the workers and the providers, plenty unless a test sets it
+        self.get_novel_metadata_dispatch_size = get_novel_metadata_dispatch_size
+
+    @property
+    def metadata(self) -> List[ObjectId]:
+        return [novel.id for call in self.send_novel_metadata_tasks.call_args_list for novel in call.args[0]]
+
+    @property
+    def tags(self) -> List[ObjectId]:
+        return [ObjectId(novel_id) for call in self.beat_update_tags_of_novels.delay.call_args_list for novel_id in call.args[0]]
+
+
+@pytest.fixture
+def dispatched() -> Iterator[Dispatched]:
+    with mock.patch.object(watchers, "send_novel_metadata_tasks") as send_novel_metadata_tasks, \
+            mock.patch.object(watchers, "beat_update_tags_of_novels") as beat_update_tags_of_novels, \
+            mock.patch.object(watchers, "get_novel_metadata_dispatch_size", return_value=100) as get_novel_metadata_dispatch_size:
+        yield Dispatched(send_novel_metadata_tasks, beat_update_tags_of_novels, get_novel_metadata_dispatch_size)
+
+
+@contextmanager
+def run_watcher(db: Database) -> Iterator[NovelWatcher]:
+    watcher = NovelWatcher(db, batch_size=1, max_wait=0.1, name=WATCHER_NAME)
+    thread = threading.Thread(target=watcher.watch, daemon=True)
+    thread.start()
+    try:
+        # The stream is open once the watcher saved a resume token, it does so as soon as the stream is idle
+        wait_until(lambda: ChangeStreamState.load_resume_token(db, WATCHER_NAME) is not None)
+        yield watcher
+    finally:
+        watcher.stop()
+        thread.join(timeout=10)
+    assert not thread.is_alive()
+
+
+def test_watcher_dispatches_new_and_changed_novels(db: Database, dispatched: Dispatched):
+    novel = make_novel(1)
+    with run_watcher(db):
+        novel.upsert(db)
+        wait_until(lambda: novel.id in dispatched.metadata and novel.id in dispatched.tags)
+
+        # New raw tags clear the translated tags, so the tags are translated again but the metadata is not
+        db[NovelRawData._collection_name].update_one({"_id": novel.id}, {"$set": {"tags": ["Cultivation"]}})
+        scrape_again(db, make_novel(1, tags_raw=["修仙", "系统"]))
+        wait_until(lambda: dispatched.tags.count(novel.id) == 2)
+        assert db[NovelRawData._collection_name].find_one({"_id": novel.id})["tags"] == []
+
+        # A new title resets the translation, so the novel is dispatched again although it was dispatched just now
+        db[NovelRawData._collection_name].update_one({"_id": novel.id}, {"$set": {"all_data_parsed": True}})
+        scrape_again(db, make_novel(1, title_raw="新小说", tags_raw=["修仙", "系统"]))
+        wait_until(lambda: dispatched.metadata.count(novel.id) == 2)
+
+        # Nothing is dispatched for a novel that is scraped again unchanged
+        n_calls = len(dispatched.metadata) + len(dispatched.tags)
+        scrape_again(db, make_novel(1, title_raw="新小说", tags_raw=["修仙", "系统"]))
+        time.sleep(0.5)
+        assert len(dispatched.metadata) + len(dispatched.tags) == n_calls
+
+
+def test_watcher_resumes_from_the_saved_resume_token(db: Database, dispatched: Dispatched):
+    before_first_run = make_novel(1)
+    before_first_run.upsert(db)
+    with run_watcher(db):
+        pass
+    resume_token = ChangeStreamState.load_resume_token(db, WATCHER_NAME)
+
+    # Scraped while the watcher was down
+    missed = make_novel(2)
+    missed.upsert(db)
+    assert dispatched.metadata == []
+
+    with run_watcher(db):
+        wait_until(lambda: missed.id in dispatched.metadata and missed.id in dispatched.tags)
+        wait_until(lambda: ChangeStreamState.load_resume_token(db, WATCHER_NAME) != resume_token)
+    # A watcher without a resume token starts from now, so only the missed novel was dispatched
+    assert dispatched.metadata == [missed.id]
+
+
+def test_watcher_leaves_the_novels_it_has_no_capacity_for_to_the_dispatcher(db: Database, dispatched: Dispatched):
+    novels = [make_novel(idx) for idx in range(3)]
+    for novel in novels:
+        novel.upsert(db)
+    watcher = NovelWatcher(db, name=WATCHER_NAME)
+
+    dispatched.get_novel_metadata_dispatch_size.return_value = 2
+    for novel in novels:
+        watcher.handle_change({"operationType": "insert", "documentKey": {"_id": novel.id}, "fullDocument": {"all_data_parsed": False}})
+    watcher.dispatch()
+    assert len(dispatched.metadata) == 2
+    left_id, = [novel.id for novel in novels if novel.id not in dispatched.metadata]
+    assert db[NovelRawData._collection_name].find_one({"_id": left_id}).get("dispatched_at") is None
+
+    # Without any capacity nothing is claimed
+    dispatched.get_novel_metadata_dispatch_size.return_value = 0
+    watcher.handle_change({"operationType": "update", "documentKey": {"_id": left_id}, "updateDescription": {"updatedFields": {"all_data_parsed": False}}})
+    watcher.dispatch()
+    assert len(dispatched.metadata) == 2
+    assert db[NovelRawData._collection_name].find_one({"_id": left_id}).get("dispatched_at") is None